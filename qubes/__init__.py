@@ -677,6 +677,20 @@ class PropertyHolder(qubes.events.Emitter):
 
         return memo[load_stage]
 
+    @classmethod
+    def vm_property_names(cls):
+        """Names of properties attached to this class, which refer to other
+        VMs (:py:class:`qubes.vm.VMProperty`)"""
+
+        # use cls.__dict__ since we must not look at parent classes
+        if "_vm_property_names" not in cls.__dict__:
+            cls._vm_property_names = tuple(
+                prop.__name__
+                for prop in cls.property_list()
+                if isinstance(prop, VMProperty)
+            )
+        return cls._vm_property_names
+
     def _property_init(self, prop, value):
         """Initialise property to a given value, without side effects.
 
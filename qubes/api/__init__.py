@@ -20,6 +20,7 @@
 # License along with this library; if not, see <https://www.gnu.org/licenses/>.
 
 import asyncio
+import collections
 import errno
 import functools
 import io
@@ -368,8 +369,30 @@ class AbstractQubesAPI:
 
 
 class QubesDaemonProtocol(asyncio.Protocol):
+    """Server side of qubesd socket protocol.
+
+    By default, a connection carries exactly one call: the request is read
+    until EOF, and the connection is closed after the response is sent.
+
+    A client may opt in to the framed mode by sending :py:attr:`framed_magic`
+    as the very first bytes. Then the connection carries a stream of
+    requests, each prefixed with :py:attr:`frame_header` (a client-chosen tag
+    and body length). Requests are executed one after another, in the order
+    received, and every message sent back (response, exception or event) is
+    framed the same way, with the tag of the request it belongs to. A call
+    that failed with an unhandled exception gets an empty frame. The server
+    closes the connection after the client sends EOF and all pending requests
+    are answered.
+    """
+
     buffer_size = 65536
     header = struct.Struct("Bx")
+    #: preamble selecting the framed mode; cannot start a valid request
+    framed_magic = b"\0qubesd-framed\0"
+    #: tag and length of a framed request or response
+    frame_header = struct.Struct("!II")
+    #: stop reading from the client while this many requests are queued
+    max_pending_frames = 16
 
     def __init__(
         self, handler, *args, app, debug=False, log_dom0_call=False, **kwargs
@@ -384,12 +407,22 @@ class QubesDaemonProtocol(asyncio.Protocol):
         self.log_dom0_call = log_dom0_call
         self.event_sent = False
         self.mgmt = None
+        self.framed = False
+        self.tag = None
+        self.pending_frames = collections.deque()
+        self.frames_task = None
+        self.reading_paused = False
+        self.eof = False
 
     def connection_made(self, transport):
         self.transport = transport
 
     def connection_lost(self, exc):
-        self.untrusted_buffer.close()
+        if self.framed:
+            self.untrusted_buffer.clear()
+        else:
+            self.untrusted_buffer.close()
+        self.pending_frames.clear()
         # for cancellable operation, interrupt it, otherwise it will do nothing
         if self.mgmt is not None:
             self.mgmt.cancel()
@@ -397,33 +430,129 @@ class QubesDaemonProtocol(asyncio.Protocol):
 
     # pylint: disable=arguments-differ,arguments-renamed
     def data_received(self, untrusted_data):
+        if self.framed:
+            self.framed_data_received(untrusted_data)
+            return
+
         if self.len_untrusted_buffer + len(untrusted_data) > self.buffer_size:
             self.app.log.warning("request too long")
             self.transport.abort()
             self.untrusted_buffer.close()
             return
 
+        len_before = self.len_untrusted_buffer
         self.len_untrusted_buffer += self.untrusted_buffer.write(untrusted_data)
 
+        magic_len = len(self.framed_magic)
+        if len_before < magic_len <= self.len_untrusted_buffer:
+            untrusted_buffer = self.untrusted_buffer.getvalue()
+            if untrusted_buffer.startswith(self.framed_magic):
+                self.untrusted_buffer.close()
+                self.framed = True
+                self.untrusted_buffer = bytearray()
+                self.framed_data_received(untrusted_buffer[magic_len:])
+
     # pylint: enable=arguments-differ,arguments-renamed
 
+    def framed_data_received(self, untrusted_data):
+        """Split incoming data into frames and queue them for execution"""
+        self.untrusted_buffer += untrusted_data
+        header_size = self.frame_header.size
+        while len(self.untrusted_buffer) >= header_size:
+            tag, untrusted_length = self.frame_header.unpack_from(
+                self.untrusted_buffer
+            )
+            if untrusted_length > self.buffer_size:
+                self.app.log.warning("request too long")
+                self.transport.abort()
+                return
+            length = untrusted_length
+            if len(self.untrusted_buffer) < header_size + length:
+                break
+            untrusted_request = bytes(
+                self.untrusted_buffer[header_size : header_size + length]
+            )
+            del self.untrusted_buffer[: header_size + length]
+            self.pending_frames.append((tag, untrusted_request))
+
+        if len(self.pending_frames) >= self.max_pending_frames:
+            self.transport.pause_reading()
+            self.reading_paused = True
+        if self.pending_frames and self.frames_task is None:
+            self.frames_task = asyncio.ensure_future(self.process_frames())
+
+    async def process_frames(self):
+        """Execute queued framed requests in order"""
+        try:
+            while self.pending_frames and self.transport is not None:
+                tag, untrusted_request = self.pending_frames.popleft()
+                if self.reading_paused and (
+                    len(self.pending_frames) < self.max_pending_frames
+                ):
+                    self.transport.resume_reading()
+                    self.reading_paused = False
+                try:
+                    src, meth, dest, arg, untrusted_payload = (
+                        self.parse_request(untrusted_request)
+                    )
+                except ValueError:
+                    self.app.log.warning("framing error")
+                    self.transport.abort()
+                    return
+                self.tag = tag
+                self.event_sent = False
+                await self.respond(
+                    src, meth, dest, arg, untrusted_payload=untrusted_payload
+                )
+                self.mgmt = None
+        finally:
+            self.frames_task = None
+        if self.eof and self.transport is not None:
+            self.close_framed()
+
+    def close_framed(self):
+        try:
+            self.transport.write_eof()
+        except NotImplementedError:
+            pass
+        self.transport.close()
+
+    @staticmethod
+    def parse_request(untrusted_request):
+        """Split request into its parts.
+
+        :raises ValueError: on malformed request
+        """
+        connection_params, untrusted_payload = untrusted_request.split(b"\0", 1)
+        meth_arg, src, dest_type, dest = connection_params.split(b" ", 3)
+        if dest_type == b"keyword" and dest == b"adminvm":
+            dest_type, dest = b"name", b"dom0"
+        if dest_type != b"name":
+            raise ValueError(
+                "got {} destination type, "
+                "while only explicit name supported".format(dest_type)
+            )
+        if b"+" in meth_arg:
+            meth, arg = meth_arg.split(b"+", 1)
+        else:
+            meth, arg = meth_arg, b""
+        return src, meth, dest, arg, untrusted_payload
+
     def eof_received(self):
+        if self.framed:
+            self.eof = True
+            if self.untrusted_buffer:
+                self.app.log.warning("framing error")
+                self.transport.abort()
+                return None
+            if self.frames_task is None:
+                self.close_framed()
+            return True
+
         try:
-            connection_params, untrusted_payload = (
-                self.untrusted_buffer.getvalue().split(b"\0", 1)
+            src, meth, dest, arg, untrusted_payload = self.parse_request(
+                self.untrusted_buffer.getvalue()
             )
-            meth_arg, src, dest_type, dest = connection_params.split(b" ", 3)
-            if dest_type == b"keyword" and dest == b"adminvm":
-                dest_type, dest = b"name", b"dom0"
-            if dest_type != b"name":
-                raise ValueError(
-                    "got {} destination type, "
-                    "while only explicit name supported".format(dest_type)
-                )
-            if b"+" in meth_arg:
-                meth, arg = meth_arg.split(b"+", 1)
-            else:
-                meth, arg = meth_arg, b""
         except ValueError:
             self.app.log.warning("framing error")
             self.transport.abort()
@@ -458,9 +587,13 @@ class QubesDaemonProtocol(asyncio.Protocol):
             self.mgmt = self.handler(
                 self.app, src, meth, dest, arg, self.send_event
             )
-            response = await self.mgmt.execute(
-                untrusted_payload=untrusted_payload
-            )
+            try:
+                response = await self.mgmt.execute(
+                    untrusted_payload=untrusted_payload
+                )
+            finally:
+                # changes must hit qubes.xml before the call is acknowledged
+                self.app.flush_save()
             assert not (self.event_sent and response)
             if self.transport is None:
                 return
@@ -477,7 +610,8 @@ class QubesDaemonProtocol(asyncio.Protocol):
             )
             if self.transport is not None:
                 self.send_exception(exc)
-                self.transport.write_eof()
+                if not self.framed:
+                    self.transport.write_eof()
 
         except qubes.exc.QubesException as exc:
             if self.debug:
@@ -493,8 +627,9 @@ class QubesDaemonProtocol(asyncio.Protocol):
                 )
             if self.transport is not None:
                 self.send_exception(exc)
-                self.transport.write_eof()
-                self.transport.close()
+                if not self.framed:
+                    self.transport.write_eof()
+                    self.transport.close()
             return
 
         except Exception:  # pylint: disable=broad-except
@@ -507,23 +642,30 @@ class QubesDaemonProtocol(asyncio.Protocol):
                 len(untrusted_payload),
                 "unhandled exception",
             )
+            if self.framed and self.transport is not None:
+                self.transport.write(self.frame_header.pack(self.tag, 0))
 
         else:
             if not self.event_sent:
                 self.send_response(response)
-            try:
-                self.transport.write_eof()
-            except NotImplementedError:
-                pass
+            if not self.framed:
+                try:
+                    self.transport.write_eof()
+                except NotImplementedError:
+                    pass
             success = True
         finally:
-            if success:
-                self.transport.close()
-            elif self.transport:
-                self.transport.abort()
+            if not self.framed:
+                if success:
+                    self.transport.close()
+                elif self.transport:
+                    self.transport.abort()
 
     def write(self, header: int, data: bytes):
-        self.transport.write(self.header.pack(header) + data)
+        message = self.header.pack(header) + data
+        if self.framed:
+            message = self.frame_header.pack(self.tag, len(message)) + message
+        self.transport.write(message)
 
     def send_response(self, content):
         assert not self.event_sent
@@ -645,3 +787,83 @@ async def create_servers(*args, force=False, loop=None, **kwargs):
         os.umask(old_umask)
 
     return servers
+
+
+class QubesdConnection:
+    """Client side of the framed mode of :py:class:`QubesDaemonProtocol`.
+
+    Many calls can be issued over a single connection, also concurrently from
+    different tasks. Calls producing events are not supported, use a separate
+    (not framed) connection for them.
+    """
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.next_tag = 0
+        self.pending = {}
+        self.reader_task = asyncio.ensure_future(self.read_responses())
+
+    @classmethod
+    async def connect(cls, sockpath):
+        """Connect to qubesd socket and switch it to the framed mode"""
+        reader, writer = await asyncio.open_unix_connection(sockpath)
+        writer.write(QubesDaemonProtocol.framed_magic)
+        return cls(reader, writer)
+
+    async def read_responses(self):
+        frame_header = QubesDaemonProtocol.frame_header
+        try:
+            while True:
+                tag, length = frame_header.unpack(
+                    await self.reader.readexactly(frame_header.size)
+                )
+                response = await self.reader.readexactly(length)
+                future = self.pending.pop(tag, None)
+                if future is not None and not future.done():
+                    future.set_result(response)
+        except (asyncio.IncompleteReadError, ConnectionError) as exc:
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(
+                        ConnectionError(
+                            "qubesd connection closed: {}".format(exc)
+                        )
+                    )
+            self.pending.clear()
+
+    async def call(self, src, method_name, dest, arg="", payload=b""):
+        """Call a method and return raw response.
+
+        The response is in the same format as in a one-call connection, or
+        empty if the call failed with an unhandled exception.
+        """
+        if self.reader_task.done():
+            raise ConnectionError("qubesd connection closed")
+        tag = self.next_tag
+        self.next_tag = (self.next_tag + 1) % 2**32
+        request = _format_request(src, method_name, dest, arg, payload)
+        future = asyncio.get_event_loop().create_future()
+        self.pending[tag] = future
+        self.writer.write(
+            QubesDaemonProtocol.frame_header.pack(tag, len(request)) + request
+        )
+        await self.writer.drain()
+        return await future
+
+    async def close(self):
+        """Finish sending requests, wait for responses and close connection"""
+        if self.writer.can_write_eof():
+            self.writer.write_eof()
+        await self.reader_task
+        self.writer.close()
+        await self.writer.wait_closed()
+
+
+def _format_request(src, method_name, dest, arg, payload):
+    meth_arg = method_name + "+" + arg if arg else method_name
+    return (
+        "{} {} name {}".format(meth_arg, src, dest).encode("ascii")
+        + b"\0"
+        + payload
+    )
@@ -59,6 +59,19 @@ from qubes.device_protocol import (
 # To validate & sanitise UTF8 strings
 LIBQUBES_PURE = "libqubes-pure.so.0"
 
+#: minimal change of a value, for a VM to be included in admin.vm.Stats
+#: events in delta mode; values not listed here are sent on any change,
+#: except cpu_time(_internal), which changes all the time
+STATS_DELTA_THRESHOLDS = {
+    "memory_kb": 1024,
+    "memory_assigned_total": 1024,
+    "memory_assigned_usable": 1024,
+    "memory_with_swap_used": 1024,
+    "swap_used": 1024,
+    "cpu_usage": 1,
+    "cpu_usage_internal": 1,
+}
+
 
 class QubesMgmtEventsDispatcher:
     def __init__(self, filters, send_event):
@@ -259,20 +272,58 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
         """Get value all global properties"""
         return self._property_get_all(self.app)
 
+    @qubes.api.method(
+        "admin.vm.property.GetAllForAll",
+        wants_payload=False,
+        wants_arg=False,
+        dest_adminvm=True,
+        scope="global",
+        read=True,
+    )
+    async def vm_property_get_all_for_all(self):
+        """Get values of all properties of all the domains
+
+        This is equivalent of calling admin.vm.property.GetAll for each
+        domain, but in a single call. Each line is prefixed with the domain
+        name. Domains for which the caller has no permission are skipped.
+        """
+        domains = self.fire_event_for_filter(self.app.domains)
+
+        result = []
+        for vm in sorted(domains):
+            try:
+                filters = self.src.fire_event(
+                    "admin-permission:admin.vm.property.GetAll",
+                    pre_event=True,
+                    dest=vm,
+                    arg="",
+                )
+            except qubes.exc.PermissionDenied:
+                continue
+            properties = qubes.api.apply_filters(vm.property_list(), filters)
+            result.append(
+                "".join(
+                    "{} {}".format(vm.name, line)
+                    for line in self._serialize_properties(vm, properties)
+                )
+            )
+        return "".join(result)
+
     def _property_get_all(self, dest):
         properties = dest.property_list()
 
         properties = self.fire_event_for_filter(properties)
 
-        return "".join(
-            "{} {}\n".format(
+        return "".join(self._serialize_properties(dest, properties))
+
+    def _serialize_properties(self, dest, properties):
+        for prop in sorted(properties):
+            yield "{} {}\n".format(
                 str(prop),
                 self._serialize_property(dest, prop)
                 .replace("\\", "\\\\")
                 .replace("\n", "\\n"),
             )
-            for prop in sorted(properties)
-        )
 
     @qubes.api.method(
         "admin.vm.property.GetDefault",
@@ -1325,6 +1376,77 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
         self.fire_event_for_permission()
         await self.dest.kill()
 
+    def _parse_vm_names(self, untrusted_payload):
+        """Get qubes named in the payload, separated by whitespace"""
+        try:
+            untrusted_names = untrusted_payload.decode(
+                "ascii", errors="strict"
+            ).split()
+        except UnicodeDecodeError:
+            raise qubes.exc.ProtocolError("Non-ASCII qube name")
+        self.enforce(untrusted_names, reason="No qubes given")
+        vms = []
+        for untrusted_name in untrusted_names:
+            qubes.vm.validate_name(None, None, untrusted_name)
+            name = untrusted_name
+            try:
+                vms.append(self.app.domains[name])
+            except KeyError:
+                raise qubes.exc.QubesVMNotFoundError(name)
+        return vms
+
+    def _enforce_vms_allowed(self, vms, **kwargs):
+        """Check permission for each of *vms*"""
+        allowed = set(self.fire_event_for_filter(vms, vms=vms, **kwargs))
+        if len(allowed) != len(set(vms)):
+            raise qubes.exc.PermissionDenied()
+
+    @qubes.api.method(
+        "admin.vm.StartMany",
+        wants_arg=False,
+        wants_payload=True,
+        dest_adminvm=True,
+        scope="global",
+        execute=True,
+    )
+    async def vm_start_many(self, untrusted_payload):
+        vms = self._parse_vm_names(untrusted_payload)
+        self._enforce_vms_allowed(vms)
+        failed = await self.app.start_vms(vms)
+        if failed:
+            raise qubes.exc.QubesException(
+                "Start failed: "
+                + "; ".join(
+                    "{}: {!s}".format(vm.name, failed[vm])
+                    for vm in sorted(failed)
+                )
+            )
+
+    @qubes.api.method(
+        "admin.vm.ShutdownMany",
+        wants_arg=None,
+        wants_payload=True,
+        dest_adminvm=True,
+        scope="global",
+        execute=True,
+    )
+    async def vm_shutdown_many(self, untrusted_payload):
+        self.enforce(
+            self.arg in ("", "force"), reason="Argument must match: force"
+        )
+        force = self.arg == "force"
+        vms = self._parse_vm_names(untrusted_payload)
+        self._enforce_vms_allowed(vms, force=force)
+        failed = await self.app.shutdown_vms(vms, force=force)
+        if failed:
+            raise qubes.exc.QubesException(
+                "Shutdown failed: "
+                + "; ".join(
+                    "{}: {!s}".format(vm.name, failed[vm])
+                    for vm in sorted(failed)
+                )
+            )
+
     @qubes.api.method(
         "admin.Events",
         wants_arg=False,
@@ -2323,6 +2445,8 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
             # convert old keywords to new keywords
             exclude_vms = [vm.replace("$", "@") for vm in exclude_vms]
             compression = profile_data.get("compression", True)
+            workers = profile_data.get("workers", 1)
+            incremental = profile_data.get("incremental", None)
         except KeyError as err:
             raise qubes.exc.QubesException(
                 "Invalid backup profile - missing {}".format(err)
@@ -2403,6 +2527,15 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
         }
         if isinstance(compression, str):
             kwargs["compression_filter"] = compression
+        if not isinstance(workers, int) or workers < 1:
+            raise qubes.exc.QubesException(
+                "Invalid backup profile - workers must be a positive integer"
+            )
+        if workers != 1:
+            kwargs["workers"] = workers
+        if incremental:
+            kwargs["incremental"] = True
+            kwargs["profile_name"] = profile_name
         backup = qubes.backup.Backup(
             self.app, vms_to_backup, vms_to_exclude, **kwargs
         )
@@ -2494,20 +2627,60 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
         backup = await self._load_backup_profile(self.arg, skip_passphrase=True)
         return backup.get_backup_summary()
 
-    def _send_stats_single(self, info_time, info, only_vm, filters):
-        """A single iteration of sending VM stats
+    @staticmethod
+    def _vm_stats_data(vm_info):
+        """Convert measurements of a single VM to vm-stats event arguments"""
+        data = {
+            "memory_kb": int(vm_info["memory_kb"]),
+            "memory_assigned_total": int(vm_info["memory_assigned_total"]),
+            "memory_assigned_usable": int(vm_info["memory_assigned_usable"]),
+            "memory_with_swap_used": int(vm_info["memory_with_swap_used"]),
+            "cpu_time": int(vm_info["cpu_time"] / 1000000),
+            "cpu_usage": int(vm_info["cpu_usage"]),
+            "online_vcpus": int(vm_info["online_vcpus"]),
+        }
 
-        :param info_time: time of previous iteration
-        :param info: information retrieved in previous iteration
-        :param only_vm: send information only about this VM
+        optional = {
+            "swap_used": int,
+            "cpu_time_internal": lambda x: int(x / 1000000),
+            "cpu_usage_internal": lambda x: round(float(x), 1),
+            "online_vcpus_internal": int,
+        }
+
+        for key, func in optional.items():
+            if key not in vm_info:
+                continue
+            data[key] = func(vm_info[key])
+        return data
+
+    @staticmethod
+    def _vm_stats_changed(old, new):
+        """Check if *new* stats differ from *old* enough to send them in
+        delta mode (see :py:data:`STATS_DELTA_THRESHOLDS`)"""
+        if old.keys() != new.keys():
+            return True
+        for key, value in new.items():
+            if key in ("cpu_time", "cpu_time_internal"):
+                continue
+            threshold = STATS_DELTA_THRESHOLDS.get(key, 0)
+            if value != old[key] and abs(value - old[key]) >= threshold:
+                return True
+        return False
+
+    def _send_stats(self, info, filters, cache=None, sent=None):
+        """Send vm-stats events for measurements *info*
+
+        :param info: measurements, as returned by
+            :py:meth:`qubes.app.QubesHost.get_vm_stats`
         :param filters: filters to apply on stats before sending
-        :return: tuple(info_time, info) - new information (to be passed to
-        the next iteration)
+        :param cache: dict with event arguments already computed for
+            *info* (by other subscribers); updated with the new ones
+        :param sent: dict of last sent event arguments per VM, to send only
+            changed ones (delta mode); :py:obj:`None` to send all
         """
-
-        info_time, info = self.app.host.get_vm_stats(
-            info_time, info, only_vm=only_vm
-        )
+        if cache is None:
+            cache = {}
+        seen = set()
         for vm_info in info.values():
             name = vm_info["name"]
             if name is None:
@@ -2517,44 +2690,64 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
             if not list(qubes.api.apply_filters([name], filters)):
                 continue
 
-            data = {
-                "memory_kb": int(vm_info["memory_kb"]),
-                "memory_assigned_total": int(vm_info["memory_assigned_total"]),
-                "memory_assigned_usable": int(
-                    vm_info["memory_assigned_usable"]
-                ),
-                "memory_with_swap_used": int(vm_info["memory_with_swap_used"]),
-                "cpu_time": int(vm_info["cpu_time"] / 1000000),
-                "cpu_usage": int(vm_info["cpu_usage"]),
-                "online_vcpus": int(vm_info["online_vcpus"]),
-            }
-
-            optional = {
-                "swap_used": int,
-                "cpu_time_internal": lambda x: int(value / 1000000),
-                "cpu_usage_internal": lambda x: round(float(x), 1),
-                "online_vcpus_internal": int,
-            }
-
-            for key, func in optional.items():
-                if key not in vm_info:
+            data = cache.get(name)
+            if data is None:
+                data = cache[name] = self._vm_stats_data(vm_info)
+
+            if sent is not None:
+                seen.add(name)
+                if name in sent and not self._vm_stats_changed(
+                    sent[name], data
+                ):
                     continue
-                value = vm_info[key]
-                data[key] = func(value)
+                sent[name] = data
 
             self.send_event(name, "vm-stats", **data)
 
+        if sent is not None:
+            for name in sent.keys() - seen:
+                # not running anymore, send full stats when started again
+                del sent[name]
+
+    def _send_stats_single(self, info_time, info, only_vm, filters, sent=None):
+        """A single iteration of sending VM stats
+
+        :param info_time: time of previous iteration
+        :param info: information retrieved in previous iteration
+        :param only_vm: send information only about this VM
+        :param filters: filters to apply on stats before sending
+        :param sent: last sent stats, for delta mode (see
+            :py:meth:`_send_stats`)
+        :return: tuple(info_time, info) - new information (to be passed to
+        the next iteration)
+        """
+
+        info_time, info = self.app.host.get_vm_stats(
+            info_time, info, only_vm=only_vm
+        )
+        self._send_stats(info, filters, sent=sent)
         return info_time, info
 
     @qubes.api.method(
         "admin.vm.Stats",
-        wants_arg=False,
+        wants_arg=None,
         wants_payload=False,
         dest_adminvm=None,
         scope="global",
         read=True,
     )
     async def vm_stats(self):
+        """Send VM stats every :py:attr:`qubes.Qubes.stats_interval`
+        seconds, until the client disconnects
+
+        With "delta" argument, stats of a VM are sent only if they changed
+        significantly since the last time they were sent (and on the first
+        measurement).
+        """
+        self.enforce(
+            self.arg in ("", "delta"), reason="Argument must match: delta"
+        )
+
         # run until client connection is terminated
         self.cancellable = True
 
@@ -2567,14 +2760,21 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
 
         self.send_event(self.app, "connection-established")
 
-        info_time = None
-        info = None
+        sent = {} if self.arg == "delta" else None
         try:
-            while True:
-                info_time, info = self._send_stats_single(
-                    info_time, info, only_vm, stats_filters
-                )
-                await asyncio.sleep(self.app.stats_interval)
+            if only_vm is None:
+                # measurements of all VMs are shared between subscribers
+                sampler = self.app.host.stats_sampler
+                async for _info_time, info, cache in sampler.subscribe():
+                    self._send_stats(info, stats_filters, cache, sent)
+            else:
+                info_time = None
+                info = None
+                while True:
+                    info_time, info = self._send_stats_single(
+                        info_time, info, only_vm, stats_filters, sent
+                    )
+                    await asyncio.sleep(self.app.stats_interval)
         except asyncio.CancelledError:
             # valid method to terminate this loop
             pass
@@ -24,6 +24,7 @@ import asyncio
 import json
 import os
 import subprocess
+from typing import Optional
 
 import qubes.api
 import qubes.api.admin
@@ -34,14 +35,48 @@ PREVIOUSLY_PAUSED = "/run/qubes/previously-paused.list"
 
 
 class SystemInfoCache:
-    cache = None
+    """System info (for qrexec policy evaluation), updated incrementally
+
+    Entries of individual domains are recomputed only after an event that
+    may change them, and their serialized form is kept too.
+    """
+
+    cache: Optional[dict] = None
     cache_for_app = None
+    #: serialized *cache*, see :py:meth:`get_system_info_json`
+    cache_json: Optional[str] = None
+    #: serialized entries of ``cache["domains"]``, by domain name
+    domains_json: dict[str, str] = {}
+    #: domains with outdated entry in *cache*, by name
+    outdated: dict[str, qubes.vm.BaseVM] = {}
+    #: incremented on every change of *cache* content
+    generation = 0
+    #: incremented on changes of *cache* content that may change the result
+    #: of policy evaluation, see :py:attr:`policy_keys`
+    policy_generation = 0
+    #: entries of domain info used when evaluating policy; others (like
+    #: power state) change often and don't affect it
+    policy_keys = (
+        "tags",
+        "type",
+        "template_for_dispvms",
+        "default_dispvm",
+        "guivm",
+        "relayvm",
+        "uuid",
+    )
 
     # list of VM events that may affect the content of system_info
     vm_events = (
         "domain-spawn",
         "domain-start",
+        "domain-start-failed",
+        "domain-paused",
+        "domain-unpaused",
+        "domain-resumed",
         "domain-shutdown",
+        "domain-shutdown-failed",
+        "domain-stopped",
         "domain-tag-add:*",
         "domain-tag-delete:*",
         "domain-feature-set:internal",
@@ -67,21 +102,28 @@ class SystemInfoCache:
 
     @classmethod
     def event_handler(cls, subject, event, **kwargs):
-        """Invalidate cache on specific events"""
+        """Mark domain entry as outdated on specific events"""
         # pylint: disable=unused-argument
-        cls.cache = None
+        cls.outdated[subject.name] = subject
 
     @classmethod
     def on_domain_add(cls, subject, event, vm):
         # pylint: disable=unused-argument
         cls.register_events_vm(vm)
-        cls.cache = None
+        cls.outdated[vm.name] = vm
 
     @classmethod
     def on_domain_delete(cls, subject, event, vm):
         # pylint: disable=unused-argument
         cls.unregister_events_vm(vm)
-        cls.cache = None
+        cls.outdated.pop(vm.name, None)
+        cached_domains = (cls.cache or {}).get("domains", {})
+        if vm.name in cached_domains:
+            del cached_domains[vm.name]
+            cls.domains_json.pop(vm.name, None)
+            cls.cache_json = None
+            cls.generation += 1
+            cls.policy_generation += 1
 
     @classmethod
     def register_events_vm(cls, vm):
@@ -117,48 +159,83 @@ class SystemInfoCache:
             if cls.cache_for_app is not None:
                 cls.unregister_events(cls.cache_for_app)
             cls.register_events(app)
-        if cls.cache is not None:
-            return cls.cache
-        system_info = {
-            "domains": {
-                domain.name: {
-                    "internal": domain.features.get("internal", None),
-                    "tags": list(domain.tags),
-                    "type": domain.__class__.__name__,
-                    "template_for_dispvms": getattr(
-                        domain, "template_for_dispvms", False
-                    ),
-                    "default_dispvm": (
-                        domain.default_dispvm.name
-                        if getattr(domain, "default_dispvm", None)
-                        else None
-                    ),
-                    "icon": str(domain.label.icon),
-                    "label": str(domain.label.color),
-                    "guivm": (
-                        domain.guivm.name
-                        if getattr(domain, "guivm", None)
-                        else None
-                    ),
-                    "relayvm": (
-                        domain.relayvm.name
-                        if getattr(domain, "relayvm", None)
-                        else None
-                    ),
-                    "transport_rpc": (
-                        domain.transport_rpc
-                        if getattr(domain, "transport_rpc", None)
-                        else None
-                    ),
-                    "power_state": domain.get_power_state(),
-                    "uuid": str(domain.uuid),
-                }
-                for domain in app.domains
-            }
-        }
+        cache = cls.cache
+        if cache is None:
+            cache = cls.cache = {"domains": {}}
+            cls.domains_json = {}
+            cls.cache_json = None
+            cls.outdated = {domain.name: domain for domain in app.domains}
         cls.cache_for_app = app
-        cls.cache = system_info
-        return system_info
+        if cls.outdated:
+            policy_changed = False
+            # collecting info may fire events too
+            for name, domain in list(cls.outdated.items()):
+                domain_info = cls.get_domain_info(domain)
+                old_domain_info = cache["domains"].get(name)
+                if old_domain_info is None or any(
+                    old_domain_info[key] != domain_info[key]
+                    for key in cls.policy_keys
+                ):
+                    policy_changed = True
+                cache["domains"][name] = domain_info
+                cls.domains_json.pop(name, None)
+                cls.outdated.pop(name, None)
+            cls.cache_json = None
+            cls.generation += 1
+            if policy_changed:
+                cls.policy_generation += 1
+        return cache
+
+    @classmethod
+    def get_system_info_json(cls, app):
+        """System info serialized to JSON, only outdated entries are
+        serialized again"""
+        system_info = cls.get_system_info(app)
+        if cls.cache_json is None:
+            parts = []
+            for name, domain_info in system_info["domains"].items():
+                part = cls.domains_json.get(name)
+                if part is None:
+                    part = json.dumps(name) + ": " + json.dumps(domain_info)
+                    cls.domains_json[name] = part
+                parts.append(part)
+            # same format as json.dumps(system_info)
+            cls.cache_json = '{"domains": {' + ", ".join(parts) + "}}"
+        return cls.cache_json
+
+    @staticmethod
+    def get_domain_info(domain):
+        """System info entry of a single domain"""
+        return {
+            "internal": domain.features.get("internal", None),
+            "tags": list(domain.tags),
+            "type": domain.__class__.__name__,
+            "template_for_dispvms": getattr(
+                domain, "template_for_dispvms", False
+            ),
+            "default_dispvm": (
+                domain.default_dispvm.name
+                if getattr(domain, "default_dispvm", None)
+                else None
+            ),
+            "icon": str(domain.label.icon),
+            "label": str(domain.label.color),
+            "guivm": (
+                domain.guivm.name if getattr(domain, "guivm", None) else None
+            ),
+            "relayvm": (
+                domain.relayvm.name
+                if getattr(domain, "relayvm", None)
+                else None
+            ),
+            "transport_rpc": (
+                domain.transport_rpc
+                if getattr(domain, "transport_rpc", None)
+                else None
+            ),
+            "power_state": domain.get_power_state(),
+            "uuid": str(domain.uuid),
+        }
 
 
 class QubesInternalAPI(qubes.api.AbstractQubesAPI):
@@ -174,8 +251,7 @@ class QubesInternalAPI(qubes.api.AbstractQubesAPI):
         wants_payload=False,
     )
     async def getsysteminfo(self):
-        system_info = SystemInfoCache.get_system_info(self.app)
-        return json.dumps(system_info)
+        return SystemInfoCache.get_system_info_json(self.app)
 
     @qubes.api.method(
         "internal.vm.volume.ImportBegin",
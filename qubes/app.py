@@ -24,12 +24,14 @@ import asyncio
 import collections.abc
 import copy
 import functools
+import graphlib
 import grp
 import itertools
 import logging
 import os
 import random
 import sys
+import threading
 import time
 import traceback
 import uuid
@@ -278,6 +280,154 @@ class VMMConnection:
         self._xc = None  # and pray it will get garbage-collected
 
 
+class XenstoreMemoryWatcher:
+    """Memory usage reported by domains in xenstore
+
+    Keeps ``memory/meminfo`` and ``memory/swapinfo`` of watched domains
+    up to date using xenstore watches, so they don't need to be read on
+    every stats measurement. Watches are processed in a separate thread,
+    using its own xenstore connection (like in :py:mod:`qubes.qmemman`).
+    Values are stored as reported by the domain, so they are still
+    untrusted.
+    """
+
+    keys = ("meminfo", "swapinfo")
+
+    def __init__(self):
+        self.xs = xen.lowlevel.xs.xs()
+        #: (domid, key) -> value, or None if not present
+        self._values = {}
+        self._watched = frozenset()
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(
+            target=self._watch_loop, name="xs-meminfo-watcher", daemon=True
+        )
+        self._thread.start()
+
+    @staticmethod
+    def _path(domid, key):
+        return f"/local/domain/{domid}/memory/{key}"
+
+    def watch_domains(self, domids):
+        """Watch exactly the domains given in *domids*"""
+        domids = frozenset(domids)
+        removed = self._watched - domids
+        added = domids - self._watched
+        self._watched = domids
+        for domid in removed:
+            for key in self.keys:
+                self.xs.unwatch(self._path(domid, key), (domid, key))
+        if removed:
+            with self._lock:
+                for domid in removed:
+                    for key in self.keys:
+                        self._values.pop((domid, key), None)
+        for domid in added:
+            for key in self.keys:
+                # the watch fires once right away, with the current value
+                self.xs.watch(self._path(domid, key), (domid, key))
+
+    def get(self, domid, key):
+        """Get cached value of memory/*key* of domain *domid*
+
+        :return: tuple (known, value) - *known* is :py:obj:`False` if the
+            value was not received (yet)
+        """
+        with self._lock:
+            try:
+                return True, self._values[(domid, key)]
+            except KeyError:
+                return False, None
+
+    def _watch_loop(self):
+        while True:
+            _path, (domid, key) = self.xs.read_watch()
+            if domid not in self._watched:
+                # unwatched in the meantime
+                continue
+            value = self.xs.read("", self._path(domid, key))
+            with self._lock:
+                self._values[(domid, key)] = value
+
+
+class VMStatsSampler:
+    """Measure stats of all domains periodically, for all the subscribers
+
+    Measurements (see :py:meth:`QubesHost.get_vm_stats`) are taken every
+    :py:attr:`Qubes.stats_interval` seconds, but only while there is at
+    least one subscriber. All the subscribers get the same measurements.
+
+    :param QubesHost host: host to measure
+    """
+
+    def __init__(self, host):
+        self.host = host
+        #: latest measurement: (time, measurements, cache), where cache is
+        #: a dict where subscribers can keep data derived from it
+        self.sample = None
+        self._subscribers = set()
+        self._task = None
+
+    async def subscribe(self):
+        """Iterate over measurements
+
+        The latest measurement (if any) is given right away. If the
+        subscriber is slower than the measurements, it gets only the most
+        recent one.
+        """
+        queue = asyncio.Queue(maxsize=1)
+        self._subscribers.add(queue)
+        try:
+            if self.sample is not None:
+                queue.put_nowait(self.sample)
+            if self._task is None or self._task.done():
+                self._task = asyncio.ensure_future(self._sample_loop())
+            while True:
+                sample = await queue.get()
+                if isinstance(sample, Exception):
+                    raise sample
+                yield sample
+        finally:
+            self._subscribers.discard(queue)
+            if not self._subscribers:
+                self.stop()
+
+    def stop(self):
+        """Stop measuring, forget the latest measurement"""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self.sample = None
+        self.host.unwatch_memory()
+
+    def _publish(self, sample):
+        for queue in self._subscribers:
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(sample)
+
+    async def _sample_loop(self):
+        info_time, info = None, None
+        while True:
+            try:
+                info_time, info = self.host.get_vm_stats(
+                    info_time, info, only_vm=None
+                )
+            except Exception as e:  # pylint: disable=broad-except
+                self.sample = None
+                self._publish(e)
+                return
+            self.host.watch_memory(
+                domid
+                for domid, domain in info.items()
+                if domain.get("name") is not None
+                and not domain.get("is_stubdom")
+            )
+            self.sample = (info_time, info, {})
+            self._publish(self.sample)
+            await asyncio.sleep(self.host.app.stats_interval)
+
+
 class QubesHost:
     """Basic information about host machine
 
@@ -295,6 +445,10 @@ class QubesHost:
         self._cpu_arch = None
         self._cpu_family = None
 
+        self._memory_watcher = None
+        #: shared measurements of all domains, see :py:meth:`get_vm_stats`
+        self.stats_sampler = VMStatsSampler(self)
+
     def _fetch(self):
         if self._no_cpus is not None:
             return
@@ -389,6 +543,20 @@ class QubesHost:
         self._fetch()
         return "hvm_directio" in self._physinfo["virt_caps"]
 
+    def watch_memory(self, domids):
+        """Watch memory usage reported in xenstore by domains *domids*
+        (and only them), instead of reading it on each measurement"""
+        if not self.app.vmm.is_xen or self.app.vmm.offline_mode:
+            return
+        if self._memory_watcher is None:
+            self._memory_watcher = XenstoreMemoryWatcher()
+        self._memory_watcher.watch_domains(domids)
+
+    def unwatch_memory(self):
+        """Stop watching memory usage of all domains"""
+        if self._memory_watcher is not None:
+            self._memory_watcher.watch_domains(())
+
     def get_vm_stats(self, previous_time=None, previous=None, only_vm=None):
         """Measure cpu usage for all domains at once.
 
@@ -478,6 +646,9 @@ class QubesHost:
            This function may return info about implementation-specific VMs,
            like stubdomains for HVM, aggregated to the connected domain.
 
+        Memory usage reported by domains is taken from
+        :py:meth:`watch_memory` cache when available.
+
         :param previous: previous measurement
         :param previous_time: time of previous measurement
         :param only_vm: get measurements only for this VM
@@ -590,9 +761,13 @@ class QubesHost:
                 and current[domid][f"xs_{key}"] is False
             ):
                 return None
-            untrusted_value = self.app.vmm.xs.read(
-                "", f"/local/domain/{domid}/memory/{key}"
-            )
+            known, untrusted_value = False, None
+            if self._memory_watcher is not None:
+                known, untrusted_value = self._memory_watcher.get(domid, key)
+            if not known:
+                untrusted_value = self.app.vmm.xs.read(
+                    "", f"/local/domain/{domid}/memory/{key}"
+                )
             if untrusted_value is None:
                 current[domid][f"xs_{key}"] = False
                 del untrusted_value
@@ -732,18 +907,44 @@ class VMCollection:
     Iterating over VMCollection will yield machine objects.
     """
 
+    #: VM events after which name/UUID indexes need to be updated
+    _index_events = ("property-set:name", "property-set:uuid")
+
     def __init__(self, app):
         self.app = app
         self._dict = {}
+        # Indexes for lookups by name and UUID, kept in sync with _dict
+        self._by_name = {}
+        self._by_uuid = {}
+        # Cached sorted views, dropped whenever the collection changes
+        self._sorted_qids = None
+        self._sorted_vms = None
+        # Dependency index: vm -> {property name: vm it refers to} and the
+        # reverse vm -> {property name: set of vms referring to it}; built on
+        # first use
+        self._dependencies = None
+        self._dependents = {}
+        # VMs with index handlers registered, by id() - VMs are hashed by qid,
+        # which is gone after vm.close()
+        self._handled_vms = {}
         # Recently used disposable IDs: dispid -> destroy seconds since epoch
         self._recent_dispids = {}
         # Avoid reuse of disposable IDs for one week
         self._no_dispid_reuse_period = 7 * 24 * 60 * 60
 
     def close(self):
+        for vm in self._dict.values():
+            self._unregister_index_handlers(vm)
+        self._handled_vms.clear()
         del self.app
         self._dict.clear()
         del self._dict
+        self._by_name.clear()
+        self._by_uuid.clear()
+        self._sorted_qids = None
+        self._sorted_vms = None
+        self._dependencies = None
+        self._dependents.clear()
 
     def __repr__(self):
         return "<{} {!r}>".format(
@@ -761,7 +962,11 @@ class VMCollection:
         qids are sorted by numerical order.
         """
 
-        return iter(sorted(self._dict.keys()))
+        if self._sorted_qids is None or len(self._sorted_qids) != len(
+            self._dict
+        ):
+            self._sorted_qids = tuple(sorted(self._dict.keys()))
+        return iter(self._sorted_qids)
 
     keys = qids
 
@@ -779,7 +984,9 @@ class VMCollection:
         vms are sorted by qid.
         """
 
-        return iter(sorted(self._dict.values()))
+        if self._sorted_vms is None or len(self._sorted_vms) != len(self._dict):
+            self._sorted_vms = tuple(sorted(self._dict.values()))
+        return iter(self._sorted_vms)
 
     __iter__ = vms
     values = vms
@@ -813,6 +1020,13 @@ class VMCollection:
             )
 
         self._dict[value.qid] = value
+        self._add_to_indexes(value)
+        self._register_index_handlers(value)
+        if not _enable_events:
+            # properties will be loaded without firing events
+            self.invalidate_dependencies()
+        elif self._dependencies is not None:
+            self._update_dependencies(value)
         if _enable_events:
             value.events_enabled = True
             self.app.fire_event("domain-add", vm=value)
@@ -824,20 +1038,13 @@ class VMCollection:
             return self._dict[key]
 
         if isinstance(key, str):
-            for vm in self:
-                if vm.name == key:
-                    return vm
-            raise KeyError(key)
+            return self._index_lookup(self._by_name, key)
 
         if isinstance(key, qubes.vm.BaseVM):
             key = key.uuid
 
         if isinstance(key, uuid.UUID):
-            for vm in self:
-                assert isinstance(vm.uuid, uuid.UUID)
-                if vm.uuid == key:
-                    return vm
-            raise KeyError(key)
+            return self._index_lookup(self._by_uuid, key)
 
         raise KeyError(key)
 
@@ -849,42 +1056,226 @@ class VMCollection:
         if isinstance(vm, qubes.vm.qubesvm.QubesVM):
             vm.libvirt_undefine()
         del self._dict[vm.qid]
+        self._unregister_index_handlers(vm)
+        self._remove_from_indexes(vm)
+        self._remove_dependencies(vm)
         self.app.fire_event("domain-delete", vm=vm)
         if getattr(vm, "dispid", None):
             self._recent_dispids[getattr(vm, "dispid")] = int(time.monotonic())
 
     def __contains__(self, key):
-        return any((key in (vm, vm.qid, vm.name, vm.uuid)) for vm in self)
+        if isinstance(key, qubes.vm.BaseVM):
+            return self._dict.get(getattr(key, "qid", None)) is key
+        if isinstance(key, int):
+            return key in self._dict
+        if isinstance(key, (str, uuid.UUID)):
+            try:
+                self[key]
+            except KeyError:
+                return False
+            return True
+        return False
 
     def __len__(self):
         return len(self._dict)
 
-    def get_vms_based_on(self, template):
-        template = self[template]
-        return set(
-            vm
-            for vm in self
-            if hasattr(vm, "template") and vm.template == template
-        )
+    def _add_to_indexes(self, vm):
+        self._by_name[vm.name] = vm
+        vm_uuid = getattr(vm, "uuid", None)
+        if vm_uuid is not None:
+            self._by_uuid[vm_uuid] = vm
+        self._sorted_qids = None
+        self._sorted_vms = None
+
+    def _remove_from_indexes(self, vm):
+        if self._by_name.get(vm.name) is vm:
+            del self._by_name[vm.name]
+        vm_uuid = getattr(vm, "uuid", None)
+        if self._by_uuid.get(vm_uuid) is vm:
+            del self._by_uuid[vm_uuid]
+        self._sorted_qids = None
+        self._sorted_vms = None
+
+    def _reindex(self):
+        """Rebuild name/UUID indexes from scratch
+
+        This is needed only if :py:attr:`_dict` was modified directly,
+        bypassing :py:meth:`add` and :py:meth:`__delitem__`.
+        """
+        self._by_name.clear()
+        self._by_uuid.clear()
+        for vm in self._dict.values():
+            self._add_to_indexes(vm)
+
+    def _index_lookup(self, index, key):
+        vm = index.get(key)
+        if vm is not None and self._dict.get(vm.qid) is vm:
+            return vm
+        if vm is not None or len(index) != len(self._dict):
+            # index out of sync with _dict
+            self._reindex()
+            vm = index.get(key)
+            if vm is not None:
+                return vm
+        raise KeyError(key)
 
-    def get_vms_connected_to(self, netvm):
-        new_vms = {self[netvm]}
-        dependent_vms = set()
+    def _register_index_handlers(self, vm):
+        self._handled_vms[id(vm)] = vm
+        for event in self._index_events:
+            vm.add_handler(event, self._on_vm_index_property_set)
+        for event in self._dependency_events(vm):
+            vm.add_handler(event, self._on_vm_dependency_property_set)
 
-        # Dependency resolving only makes sense on NetVM (or derivative)
-        #       if not self[netvm_qid].is_netvm():
-        #           return set([])
+    def _unregister_index_handlers(self, vm):
+        self._handled_vms.pop(id(vm), None)
+        for event in self._index_events:
+            try:
+                vm.remove_handler(event, self._on_vm_index_property_set)
+            except (KeyError, AttributeError):
+                pass
+        for event in self._dependency_events(vm):
+            try:
+                vm.remove_handler(event, self._on_vm_dependency_property_set)
+            except (KeyError, AttributeError):
+                pass
 
-        while new_vms:
-            cur_vm = new_vms.pop()
-            for vm in cur_vm.connected_vms:
-                if vm in dependent_vms:
+    def _on_vm_index_property_set(self, vm, event, name, newvalue, **kwargs):
+        """Update indexes after VM name or UUID got set"""
+        # pylint: disable=unused-argument
+        index = self._by_name if name == "name" else self._by_uuid
+        oldvalue = kwargs.get("oldvalue", None)
+        if oldvalue is not None and index.get(oldvalue) is vm:
+            del index[oldvalue]
+        index[newvalue] = vm
+        self._sorted_vms = None
+
+    @staticmethod
+    def _dependency_properties(vm):
+        """Names of properties of *vm* referring to other VMs"""
+        cls = type(vm)
+        if not issubclass(cls, qubes.PropertyHolder):
+            # mock objects in tests
+            return ()
+        return cls.vm_property_names()
+
+    def _dependency_events(self, vm):
+        for name in self._dependency_properties(vm):
+            yield "property-set:" + name
+            yield "property-reset:" + name
+
+    def invalidate_dependencies(self):
+        """Drop the dependency index, to be rebuilt on next use
+
+        Needed when VM properties referring to other VMs may change without
+        firing events, or when their default values change (like after
+        changing a global property).
+        """
+        self._dependencies = None
+        self._dependents.clear()
+
+    def _get_dependents_index(self):
+        if self._dependencies is None or len(self._dependencies) != len(
+            self._dict
+        ):
+            self.invalidate_dependencies()
+            self._dependencies = {}
+            for vm in self._dict.values():
+                if id(vm) not in self._handled_vms:
+                    # added to _dict directly, bypassing add()
+                    self._register_index_handlers(vm)
+                self._update_dependencies(vm)
+        return self._dependents
+
+    def _drop_dependencies(self, vm):
+        for name, target in self._dependencies.pop(vm, {}).items():
+            referring = self._dependents.get(target, {}).get(name)
+            if referring is not None:
+                referring.discard(vm)
+                if not referring:
+                    del self._dependents[target][name]
+
+    def _remove_dependencies(self, vm):
+        if self._dependencies is None:
+            return
+        self._drop_dependencies(vm)
+        self._dependents.pop(vm, None)
+
+    def _update_dependencies(self, vm):
+        self._drop_dependencies(vm)
+        dependencies = {}
+        for name in self._dependency_properties(vm):
+            target = getattr(vm, name, None)
+            if not isinstance(target, qubes.vm.BaseVM):
+                continue
+            dependencies[name] = target
+            target_dependents = self._dependents.setdefault(target, {})
+            target_dependents.setdefault(name, set()).add(vm)
+        self._dependencies[vm] = dependencies
+
+    def _on_vm_dependency_property_set(self, vm, event, name, **kwargs):
+        """Update dependency index after VM property got (re)set"""
+        # pylint: disable=unused-argument
+        if self._dependencies is None or vm not in self._dependencies:
+            return
+        # VMs based on this one may use its value as their default
+        pending = [vm]
+        seen = set()
+        while pending:
+            cur_vm = pending.pop()
+            if cur_vm in seen:
+                continue
+            seen.add(cur_vm)
+            self._update_dependencies(cur_vm)
+            pending.extend(self._dependents.get(cur_vm, {}).get("template", ()))
+
+    def get_vm_dependents(self, vm):
+        """Get VMs referring to *vm* by their properties
+
+        Effective values are considered, including default ones.
+
+        :param qubes.vm.BaseVM vm: VM referred to
+        :return: dict of property name -> set of VMs having it set to *vm*
+        """
+        return {
+            name: set(referring)
+            for name, referring in self._get_dependents_index()
+            .get(vm, {})
+            .items()
+        }
+
+    def get_vms_depending_on(self, vm, properties=None, recursive=False):
+        """Get VMs referring to *vm* by any of *properties*
+
+        :param qubes.vm.BaseVM vm: VM referred to
+        :param properties: names of properties to consider; all properties \
+            referring to other VMs by default
+        :param bool recursive: include also VMs depending on the found ones \
+            (transitive closure)
+        :rtype: set
+        """
+        index = self._get_dependents_index()
+        result = set()
+        pending = [vm]
+        while pending:
+            cur_vm = pending.pop()
+            for name, referring in index.get(cur_vm, {}).items():
+                if properties is not None and name not in properties:
                     continue
-                dependent_vms.add(vm)
-                #               if vm.is_netvm():
-                new_vms.add(vm)
+                for dependent_vm in referring:
+                    if dependent_vm in result:
+                        continue
+                    result.add(dependent_vm)
+                    if recursive:
+                        pending.append(dependent_vm)
+        return result
 
-        return dependent_vms
+    def get_vms_based_on(self, template):
+        return self.get_vms_depending_on(self[template], ("template",))
+
+    def get_vms_connected_to(self, netvm):
+        return self.get_vms_depending_on(
+            self[netvm], ("netvm",), recursive=True
+        )
 
     # XXX with Qubes Admin Api this will probably lead to race condition
     # whole process of creating and adding should be synchronised
@@ -1030,14 +1421,18 @@ def get_qube_prop_deps(
         qube_properties = []
     system_deps: list = []
     qube_deps: list = []
-    for obj in itertools.chain(qube.app.domains, (qube.app,)):
+    dependents = qube.app.domains.get_vm_dependents(qube)
+    dependent_vms = sorted(set().union(*dependents.values()))
+    for obj in itertools.chain(dependent_vms, (qube.app,)):
         if obj is qube:
             continue
         for prop in obj.property_list():
-            if not (
-                isinstance(prop, qubes.vm.VMProperty)
-                and getattr(obj, prop.__name__, None) == qube
-            ):
+            if not isinstance(prop, qubes.vm.VMProperty):
+                continue
+            if obj is qube.app:
+                if getattr(obj, prop.__name__, None) != qube:
+                    continue
+            elif obj not in dependents.get(prop.__name__, ()):
                 continue
             if getattr(obj, "is_preload", False) and (
                 prop.__name__ == "template"
@@ -1067,6 +1462,12 @@ def _default_no_cpus(self) -> int:
     return self.host.no_cpus
 
 
+#: properties referring to qubes that need to be started first
+START_DEPENDENCIES = ("netvm", "guivm", "audiovm")
+#: properties referring to qubes that need to be shut down last
+SHUTDOWN_DEPENDENCIES = START_DEPENDENCIES + ("template",)
+
+
 class Qubes(qubes.PropertyHolder):
     """Main Qubes application
 
@@ -1166,6 +1567,10 @@ class Qubes(qubes.PropertyHolder):
     Methods and attributes:
     """
 
+    # runtime state (save timer, caches, locks) lives next to the properties
+    # on purpose, it is used by nearly every method of this class
+    # pylint: disable=too-many-instance-attributes
+
     default_guivm = qubes.VMProperty(
         "default_guivm",
         load_stage=3,
@@ -1378,6 +1783,16 @@ class Qubes(qubes.PropertyHolder):
         self.__locked_fh = None
         self._domain_event_callback_id = None
 
+        #: if not :py:obj:`None`, :py:meth:`save` does not write qubes.xml
+        #: immediately, but waits this many seconds to coalesce further
+        #: changes; see :py:meth:`flush_save`
+        self.save_delay = None
+        self._save_timer = None
+
+        #: if :py:obj:`True`, every cached domain power state is compared
+        #: against libvirt before use; meant for tests
+        self.check_power_state_cache = False
+
         #: jinja2 environment for libvirt XML templates
         self.env = jinja2.Environment(
             loader=jinja2.FileSystemLoader(
@@ -1399,6 +1814,14 @@ class Qubes(qubes.PropertyHolder):
     def store(self):
         return self._store
 
+    @property
+    def domain_events_registered(self):
+        """Whether libvirt domain lifecycle events are delivered here.
+
+        Only then domains can rely on their cached power state.
+        """
+        return self._domain_event_callback_id is not None
+
     def _migrate_global_properties(self):
         """Migrate renamed/dropped properties or properties that had weak or no
         setter to a stricter setter, that would make current value invalid,
@@ -1522,6 +1945,7 @@ class Qubes(qubes.PropertyHolder):
         for vm in self.domains:
             vm.load_properties(load_stage=4)
             vm.load_extras()
+        self.domains.invalidate_dependencies()
 
         # stage 5: misc fixups
 
@@ -1578,10 +2002,28 @@ class Qubes(qubes.PropertyHolder):
         - Attempts to write two or more files concurrently. This is done by
           sophisticated locking.
 
+        When :py:attr:`save_delay` is set, the actual write is postponed and
+        all :py:meth:`save` calls made in the meantime result in a single
+        write. Call :py:meth:`flush_save` to write pending changes right away.
+
         :param bool lock: keep file locked after saving
         :throws EnvironmentError: failure on saving
         """
 
+        if self.save_delay is not None and lock:
+            if self._save_timer is None:
+                self._save_timer = asyncio.get_event_loop().call_later(
+                    self.save_delay, self._save_timer_expired, log_level
+                )
+            return
+
+        if self._save_timer is not None:
+            self._save_timer.cancel()
+            self._save_timer = None
+
+        self._write_store(lock=lock, log_level=log_level)
+
+    def _write_store(self, lock=True, log_level=logging.DEBUG):
         if not self.__locked_fh:
             self._acquire_lock(for_save=True)
 
@@ -1610,12 +2052,36 @@ class Qubes(qubes.PropertyHolder):
         if not lock:
             self._release_lock()
 
+    @property
+    def save_pending(self):
+        """Are there changes not yet written to qubes.xml?"""
+        return self._save_timer is not None
+
+    def flush_save(self, log_level=logging.DEBUG):
+        """Write changes postponed by :py:meth:`save`, if any
+
+        :throws EnvironmentError: failure on saving
+        """
+        if self._save_timer is None:
+            return
+        self._save_timer.cancel()
+        self._save_timer = None
+        self._write_store(log_level=log_level)
+
+    def _save_timer_expired(self, log_level):
+        self._save_timer = None
+        try:
+            self._write_store(log_level=log_level)
+        except Exception:  # pylint: disable=broad-except
+            self.log.exception("Failed to save qubes.xml")
+
     def close(self):
         """Deconstruct the object and break circular references
 
         After calling this the object is unusable, not even for saving."""
 
         self.log.debug("close() <- %#x", id(self))
+        self.flush_save()
         for frame in traceback.extract_stack():
             self.log.debug("%s", frame)
 
@@ -1942,6 +2408,129 @@ class Qubes(qubes.PropertyHolder):
                         "Stopping storage for a qube raised an exception"
                     )
 
+    async def start_vms(self, vms, concurrency=None):
+        """Start multiple qubes
+
+        Each qube is started only after the qubes it uses as netvm, guivm
+        or audiovm (if they are started too), unrelated qubes are started in
+        parallel. Progress is reported with the usual ``domain-pre-start``,
+        ``domain-start`` and ``domain-start-failed`` events.
+
+        :param vms: qubes to start
+        :param int concurrency: how many qubes to start at the same time, \
+            defaults to :py:data:`qubes.config.vm_batch_concurrency`
+        :return: qubes that failed to start (or were skipped, because a qube \
+            they depend on failed), mapped to the exception
+        :raises qubes.exc.QubesException: on a dependency loop
+        """
+        vms = set(vms)
+        dependencies = {
+            vm: {getattr(vm, prop, None) for prop in START_DEPENDENCIES}
+            & (vms - {vm})
+            for vm in vms
+        }
+
+        async def start(vm):
+            await vm.start()
+
+        return await self._run_vms_ordered(
+            dependencies, start, concurrency, "start"
+        )
+
+    async def shutdown_vms(self, vms, force=False, concurrency=None):
+        """Shutdown multiple qubes and wait for them to stop
+
+        A qube is shut down only after all the qubes using it as netvm,
+        guivm, audiovm or template (if they are shut down too), unrelated
+        qubes are shut down in parallel. Halted qubes are skipped.
+
+        :param vms: qubes to shut down
+        :param bool force: force shutdown, also of qubes used by ones that \
+            failed to shut down
+        :param int concurrency: how many qubes to shut down at the same \
+            time, defaults to :py:data:`qubes.config.vm_batch_concurrency`
+        :return: qubes that failed to shut down (or were skipped), mapped to \
+            the exception
+        :raises qubes.exc.QubesException: on a dependency loop
+        """
+        vms = set(vms)
+        dependencies = {vm: set() for vm in vms}
+        for vm in vms:
+            for prop in SHUTDOWN_DEPENDENCIES:
+                target = getattr(vm, prop, None)
+                if target in dependencies and target is not vm:
+                    dependencies[target].add(vm)
+
+        async def shutdown(vm):
+            if not vm.is_halted():
+                await vm.shutdown(force=force, wait=True)
+
+        return await self._run_vms_ordered(
+            dependencies,
+            shutdown,
+            concurrency,
+            "shut down",
+            skip_on_failure=not force,
+        )
+
+    async def _run_vms_ordered(
+        self, dependencies, func, concurrency, action, skip_on_failure=True
+    ):
+        """Call *func* for each qube, after it finished for all qubes it
+        depends on
+
+        :param dict dependencies: qube -> set of qubes it depends on
+        """
+        sorter = graphlib.TopologicalSorter(dependencies)
+        try:
+            sorter.prepare()
+        except graphlib.CycleError as e:
+            raise qubes.exc.QubesException(
+                "Dependency loop between qubes: {}".format(
+                    ", ".join(vm.name for vm in e.args[1])
+                )
+            )
+        limit = asyncio.Semaphore(
+            concurrency or qubes.config.vm_batch_concurrency
+        )
+
+        async def run(vm):
+            async with limit:
+                await func(vm)
+
+        failed = {}
+        tasks = {}
+        while sorter.is_active():
+            for vm in sorter.get_ready():
+                failed_deps = sorted(dependencies[vm] & failed.keys())
+                if failed_deps and skip_on_failure:
+                    failed[vm] = qubes.exc.QubesVMError(
+                        vm,
+                        "Qube {} not {}, because {} failed".format(
+                            vm.name,
+                            action,
+                            ", ".join(dep.name for dep in failed_deps),
+                        ),
+                    )
+                    sorter.done(vm)
+                    continue
+                tasks[asyncio.ensure_future(run(vm))] = vm
+            if not tasks:
+                continue
+            finished, _ = await asyncio.wait(
+                tasks, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in finished:
+                vm = tasks.pop(task)
+                exc = task.exception()
+                if exc is not None:
+                    self.log.error(
+                        "Failed to %s qube %s: %s", action, vm.name, str(exc)
+                    )
+                    failed[vm] = exc
+                sorter.done(vm)
+        return failed
+
     def register_event_handlers(self, old_connection=None):
         """Register libvirt event handlers, which will translate libvirt
         events into qubes.events. This function should be called only in
@@ -1969,6 +2558,8 @@ class Qubes(qubes.PropertyHolder):
             # were missed. on_libvirt_domain_stopped() can deal with duplicated
             # events.
             for vm in self.domains.values():
+                if isinstance(vm, qubes.vm.qubesvm.QubesVM):
+                    vm.invalidate_power_state()
                 if not vm.is_running():
                     vm.on_libvirt_domain_stopped()
 
@@ -1985,6 +2576,9 @@ class Qubes(qubes.PropertyHolder):
             # ignore events for unknown domains
             return
 
+        if isinstance(vm, qubes.vm.qubesvm.QubesVM):
+            vm.invalidate_power_state()
+
         if event == libvirt.VIR_DOMAIN_EVENT_STOPPED:
             vm.on_libvirt_domain_stopped()
         elif event == libvirt.VIR_DOMAIN_EVENT_SUSPENDED:
@@ -2049,6 +2643,15 @@ class Qubes(qubes.PropertyHolder):
                 vm, "VM has devices assigned to other VMs: " + desc
             )
 
+    @qubes.events.handler("property-set:*", "property-reset:*")
+    def on_property_set_invalidate_dependencies(self, event, name, **kwargs):
+        """Global properties are defaults of VM properties, drop the
+        dependency index"""
+        # pylint: disable=unused-argument
+        domains = getattr(self, "domains", None)
+        if domains is not None:
+            domains.invalidate_dependencies()
+
     @qubes.events.handler("domain-delete")
     def on_domain_deleted(self, event, vm):
         # pylint: disable=unused-argument
@@ -25,6 +25,7 @@ import datetime
 import fcntl
 import functools
 import grp
+import hashlib
 import itertools
 import logging
 import os
@@ -55,6 +56,13 @@ DEFAULT_CRYPTO_ALGORITHM = "aes-256-cbc"
 DEFAULT_HMAC_ALGORITHM = "scrypt"
 DEFAULT_COMPRESSION_FILTER = "gzip"
 CURRENT_BACKUP_FORMAT_VERSION = "4"
+# backups with "*.img.delta" members, which restore tools supporting only
+# version 4 would restore as incomplete volumes; restoring them requires
+# applying each delta (see qubes.tarwriter.apply_delta) on top of the volume
+# restored from the backup with the ID stored in the member, so the whole
+# chain of backups since the last full one is needed; incremental backups
+# without any delta member are written as version 4
+INCREMENTAL_BACKUP_FORMAT_VERSION = "5"
 # Maximum size of error message get from process stderr (including VM process)
 MAX_STDERR_BYTES = 1024
 # header + qubes.xml max size
@@ -323,6 +331,15 @@ class Backup:
             self.name = name
             #: function to call after processing the file
             self.cleanup_func = cleanup_func
+            #: volume to export with
+            #: :py:meth:`qubes.storage.Volume.export_changes` before the
+            #: backup starts (incremental backup)
+            self.volume = None
+            #: ID of the backup this file is a delta to (incremental backup)
+            self.base_id = None
+            #: regions changed since :py:attr:`base_id` backup, as a list of
+            #: (offset, size)
+            self.extents = None
 
     class VMToBackup:
         # pylint: disable=too-few-public-methods
@@ -342,9 +359,11 @@ class Backup:
         """
         super().__init__()
 
-        #: progress of the backup - bytes handled of the current VM
+        #: progress of the backup - bytes handled of VMs in progress
         self.chunk_size = 100 * 1024 * 1024
         self._current_vm_bytes = 0
+        #: bytes handled so far of each VM in progress
+        self._vm_bytes = {}
         #: progress of the backup - bytes handled of finished VMs
         self._done_vms_bytes = 0
         #: total backup size (set by :py:meth:`get_files_to_backup`)
@@ -362,6 +381,22 @@ class Backup:
         self.passphrase = None
         #: custom compression filter; a program which process stdin to stdout
         self.compression_filter = DEFAULT_COMPRESSION_FILTER
+        #: number of files (volumes) compressed and encrypted at the same
+        #: time; each worker may keep a few chunks in :py:attr:`tmpdir`
+        self.workers = 1
+        #: store only regions of volumes changed since the previous
+        #: incremental backup, if the storage driver supports it (see
+        #: :py:meth:`qubes.storage.Volume.export_changes`); such backups
+        #: are written with :py:data:`INCREMENTAL_BACKUP_FORMAT_VERSION`
+        self.incremental = False
+        #: name of the backup profile; incremental backups of different
+        #: profiles keep separate bases, so that they don't replace each
+        #: other's
+        self.profile_name = None
+        #: volumes exported with
+        #: :py:meth:`qubes.storage.Volume.export_changes`, as a list of
+        #: (volume, path)
+        self._volume_exports = []
         #: VM to which backup should be sent (if any)
         self.target_vm = None
         #: directory to save backup in (either in dom0 or target VM,
@@ -415,6 +450,16 @@ class Backup:
             for name, volume in vm.volumes.items():
                 if not volume.save_on_stop:
                     continue
+                if self.incremental:
+                    file_info = self.FileToBackup(
+                        volume.export, subdir, name + ".img", volume.usage
+                    )
+                    # both export and its end are handled by backup_do, as
+                    # the header depends on the result and bases can be
+                    # replaced only once the whole backup is successful
+                    file_info.volume = volume
+                    vm_files.append(file_info)
+                    continue
                 vm_files.append(
                     self.FileToBackup(
                         volume.export,
@@ -482,6 +527,50 @@ class Backup:
         )
         return files_to_backup
 
+    @property
+    def base_tag(self):
+        """Tag of incremental backup bases of :py:attr:`profile_name`,
+        consisting of hex digits only"""
+        digest = hashlib.sha256((self.profile_name or "").encode())
+        return digest.hexdigest()[:16]
+
+    async def _export_volumes_changes(self, files_to_backup):
+        """Export volumes for incremental backup.
+
+        Sets :py:attr:`FileToBackup.path` of all files with
+        :py:attr:`FileToBackup.volume`, and also
+        :py:attr:`FileToBackup.base_id` and :py:attr:`FileToBackup.extents`
+        if only changes since the previous backup need to be stored.
+        """
+        for vm_info in files_to_backup.values():
+            for file_info in vm_info.files:
+                if file_info.volume is None:
+                    continue
+                path, base_id, extents = await qubes.utils.coro_maybe(
+                    file_info.volume.export_changes(
+                        self.backup_id, self.base_tag
+                    )
+                )
+                self._volume_exports.append((file_info.volume, path))
+                file_info.path = path
+                if base_id is not None:
+                    file_info.base_id = base_id
+                    file_info.extents = extents
+
+    async def _finish_volume_exports(self, success):
+        """Call :py:meth:`qubes.storage.Volume.export_changes_end` on all
+        volumes exported for incremental backup"""
+        while self._volume_exports:
+            volume, path = self._volume_exports.pop()
+            try:
+                await qubes.utils.coro_maybe(
+                    volume.export_changes_end(path, success)
+                )
+            except Exception:  # pylint: disable=broad-except
+                self.log.exception(
+                    "Failed to finish export of {}".format(volume)
+                )
+
     def get_backup_summary(self):
         summary = ""
 
@@ -580,8 +669,17 @@ class Backup:
 
     async def _prepare_backup_header(self):
         header_file_path = os.path.join(self.tmpdir, HEADER_FILENAME)
+        # volumes are already exported, see _export_volumes_changes
+        if any(
+            file_info.extents is not None
+            for vm_info in self._files_to_backup.values()
+            for file_info in vm_info.files
+        ):
+            version = INCREMENTAL_BACKUP_FORMAT_VERSION
+        else:
+            version = CURRENT_BACKUP_FORMAT_VERSION
         backup_header = BackupHeader(
-            version=CURRENT_BACKUP_FORMAT_VERSION,
+            version=version,
             hmac_algorithm=DEFAULT_HMAC_ALGORITHM,
             encrypted=True,
             compressed=self.compressed,
@@ -624,11 +722,14 @@ class Backup:
                 # pylint: disable=not-callable
                 self.progress_callback(progress)
 
-    def _add_vm_progress(self, bytes_done):
+    def _add_vm_progress(self, bytes_done, vm_info=None):
         self._current_vm_bytes += bytes_done
+        self._vm_bytes[vm_info] = self._vm_bytes.get(vm_info, 0) + bytes_done
         self._send_progress_update()
 
-    async def _split_and_send(self, input_stream, file_basename, output_queue):
+    async def _split_and_send(
+        self, input_stream, file_basename, output_queue, progress=None
+    ):
         """Split *input_stream* into parts of max *chunk_size* bytes and send
         to *output_queue*.
 
@@ -637,7 +738,11 @@ class Backup:
         of output files
         :param output_queue: asyncio.Queue instance to put produced files to
         - queue will get only filenames of written chunks
+        :param progress: callable to report handled bytes to, defaults to
+        :py:meth:`_add_vm_progress`
         """
+        if progress is None:
+            progress = self._add_vm_progress
         # Wait for compressor (tar) process to finish or for any
         # error of other subprocesses
         i = 0
@@ -666,7 +771,7 @@ class Backup:
                     input_stream,
                     scrypt.stdin,
                     self.chunk_size,
-                    self._add_vm_progress,
+                    progress,
                 )
 
                 self.log.debug("handle_streams returned: {}".format(run_error))
@@ -682,106 +787,183 @@ class Backup:
             # Send the chunk to the backup target
             await output_queue.put(os.path.relpath(chunkfile, self.tmpdir))
 
-    async def _wrap_and_send_files(self, files_to_backup, output_queue):
-        for vm_info in files_to_backup:
-            for file_info in vm_info.files:
+    async def _wrap_and_send_file(self, file_info, output_queue, progress):
+        """Archive, compress and encrypt a single file.
 
-                self.log.debug("Backing up {}".format(file_info))
+        :param file_info: :py:class:`FileToBackup` to process
+        :param output_queue: asyncio.Queue instance to put produced chunks to
+        :param progress: callable to report handled bytes to
+        """
+        self.log.debug("Backing up {}".format(file_info))
+
+        path = file_info.path
+        if callable(path):
+            path = await qubes.utils.coro_maybe(path())
+
+        name = file_info.name
+        if file_info.extents is not None:
+            # only changed regions are stored, in a differently named file
+            name += ".delta"
+
+        backup_tempfile = os.path.join(self.tmpdir, file_info.subdir, name)
+        self.log.debug("Using temporary location: {}".format(backup_tempfile))
+
+        # Ensure the temporary directory exists
+        os.makedirs(os.path.dirname(backup_tempfile), exist_ok=True)
+
+        # The first tar cmd can use any complex feature as we want.
+        # Files will be verified before untaring this.
+        # Prefix the path in archive with filename["subdir"] to have it
+        # verified during untar
+        tar_cmdline = (
+            ["tar", "-Pc", "--sparse", "-C", os.path.dirname(path)]
+            + (["--dereference"] if file_info.subdir != "dom0-home/" else [])
+            + [
+                "--xform=s:^%s:%s\\0:"
+                % (os.path.basename(path), file_info.subdir),
+                os.path.basename(path),
+            ]
+        )
+        file_stat = os.stat(path)
+        if (
+            stat.S_ISBLK(file_stat.st_mode)
+            or name != os.path.basename(path)
+            or file_info.extents is not None
+        ):
+            # tar doesn't handle content of block device, use our
+            # writer
+            # also use our tar writer when renaming file
+            assert not stat.S_ISDIR(
+                file_stat.st_mode
+            ), "Renaming directories not supported"
+            tar_cmdline = [
+                "python3",
+                "-m",
+                "qubes.tarwriter",
+                "--override-name=%s"
+                % (
+                    os.path.join(
+                        file_info.subdir,
+                        os.path.basename(name),
+                    )
+                ),
+                path,
+            ]
+            if file_info.extents is not None:
+                extents_path = backup_tempfile + ".extents"
+                with open(extents_path, "w", encoding="ascii") as f_extents:
+                    for offset, size in file_info.extents:
+                        f_extents.write("{} {}\n".format(offset, size))
+                tar_cmdline[-1:-1] = [
+                    "--extents=" + extents_path,
+                    "--base-backup-id=" + file_info.base_id,
+                ]
+        if self.compressed:
+            tar_cmdline.insert(
+                -2,
+                "--use-compress-program=%s" % self.compression_filter,
+            )
 
-                backup_tempfile = os.path.join(
-                    self.tmpdir, file_info.subdir, file_info.name
-                )
-                self.log.debug(
-                    "Using temporary location: {}".format(backup_tempfile)
-                )
+        self.log.debug(" ".join(tar_cmdline))
 
-                # Ensure the temporary directory exists
-                if not os.path.isdir(os.path.dirname(backup_tempfile)):
-                    os.makedirs(os.path.dirname(backup_tempfile))
-
-                # The first tar cmd can use any complex feature as we want.
-                # Files will be verified before untaring this.
-                # Prefix the path in archive with filename["subdir"] to have it
-                # verified during untar
-                path = file_info.path
-                if callable(path):
-                    path = await qubes.utils.coro_maybe(path())
-                tar_cmdline = (
-                    ["tar", "-Pc", "--sparse", "-C", os.path.dirname(path)]
-                    + (
-                        ["--dereference"]
-                        if file_info.subdir != "dom0-home/"
-                        else []
-                    )
-                    + [
-                        "--xform=s:^%s:%s\\0:"
-                        % (os.path.basename(path), file_info.subdir),
-                        os.path.basename(path),
-                    ]
-                )
-                file_stat = os.stat(path)
-                if stat.S_ISBLK(
-                    file_stat.st_mode
-                ) or file_info.name != os.path.basename(path):
-                    # tar doesn't handle content of block device, use our
-                    # writer
-                    # also use our tar writer when renaming file
-                    assert not stat.S_ISDIR(
-                        file_stat.st_mode
-                    ), "Renaming directories not supported"
-                    tar_cmdline = [
-                        "python3",
-                        "-m",
-                        "qubes.tarwriter",
-                        "--override-name=%s"
-                        % (
-                            os.path.join(
-                                file_info.subdir,
-                                os.path.basename(file_info.name),
-                            )
-                        ),
-                        path,
-                    ]
-                if self.compressed:
-                    tar_cmdline.insert(
-                        -2,
-                        "--use-compress-program=%s" % self.compression_filter,
-                    )
+        # Pipe: tar-sparse | scrypt | tar | backup_target
+        # TODO: log handle stderr
+        tar_sparse = await asyncio.create_subprocess_exec(
+            *tar_cmdline, stdout=subprocess.PIPE
+        )
 
-                self.log.debug(" ".join(tar_cmdline))
+        try:
+            await self._split_and_send(
+                tar_sparse.stdout, backup_tempfile, output_queue, progress
+            )
+        except:
+            try:
+                tar_sparse.terminate()
+            except ProcessLookupError:
+                pass
+            raise
+        finally:
+            if file_info.cleanup_func is not None:
+                await qubes.utils.coro_maybe(file_info.cleanup_func(path))
 
-                # Pipe: tar-sparse | scrypt | tar | backup_target
-                # TODO: log handle stderr
-                tar_sparse = await asyncio.create_subprocess_exec(
-                    *tar_cmdline, stdout=subprocess.PIPE
-                )
+        await tar_sparse.wait()
+        if tar_sparse.returncode:
+            raise qubes.exc.QubesException(
+                "Failed to archive {} file".format(path)
+            )
 
-                try:
-                    await self._split_and_send(
-                        tar_sparse.stdout, backup_tempfile, output_queue
-                    )
-                except:
-                    try:
-                        tar_sparse.terminate()
-                    except ProcessLookupError:
-                        pass
-                    raise
-                finally:
-                    if file_info.cleanup_func is not None:
-                        await qubes.utils.coro_maybe(
-                            file_info.cleanup_func(path)
-                        )
+    async def _wrap_and_send_files(self, files_to_backup, output_queue):
+        """Archive files of all VMs and send chunks to *output_queue*.
 
-                await tar_sparse.wait()
-                if tar_sparse.returncode:
-                    raise qubes.exc.QubesException(
-                        "Failed to archive {} file".format(path)
+        Up to :py:attr:`workers` files are processed at the same time, each
+        into a small queue of its own. Those queues are forwarded to
+        *output_queue* one after another, in the order of *files_to_backup*,
+        so the archive layout does not depend on the number of workers.
+        """
+        workers = asyncio.Semaphore(max(1, self.workers))
+        # (vm_info, file task, file chunks queue); file task is None
+        # when all files of vm_info were queued
+        started = asyncio.Queue()
+        file_tasks = []
+
+        async def process_file(vm_info, file_info, chunks):
+            try:
+                await self._wrap_and_send_file(
+                    file_info,
+                    chunks,
+                    functools.partial(self._add_vm_progress, vm_info=vm_info),
+                )
+            finally:
+                workers.release()
+
+        async def start_files():
+            for vm_info in files_to_backup:
+                for file_info in vm_info.files:
+                    # acquired in order, so the file being forwarded
+                    # always has (or is first to get) a worker
+                    await workers.acquire()
+                    chunks = asyncio.Queue(1)
+                    task = asyncio.ensure_future(
+                        process_file(vm_info, file_info, chunks)
                     )
+                    file_tasks.append(task)
+                    await started.put((vm_info, task, chunks))
+                await started.put((vm_info, None, None))
+            await started.put(None)
 
-            # This VM done, update progress
-            self._done_vms_bytes += vm_info.size
-            self._current_vm_bytes = 0
-            self._send_progress_update()
+        start_task = asyncio.ensure_future(start_files())
+        try:
+            while True:
+                item = await started.get()
+                if item is None:
+                    break
+                vm_info, task, chunks = item
+                if task is None:
+                    # This VM done, update progress
+                    self._done_vms_bytes += vm_info.size
+                    self._current_vm_bytes -= self._vm_bytes.pop(vm_info, 0)
+                    self._send_progress_update()
+                    continue
+                while not (task.done() and chunks.empty()):
+                    get_chunk = asyncio.ensure_future(chunks.get())
+                    await asyncio.wait(
+                        [get_chunk, task], return_when=asyncio.FIRST_COMPLETED
+                    )
+                    if get_chunk.done():
+                        await output_queue.put(get_chunk.result())
+                    else:
+                        get_chunk.cancel()
+                # raise exception of the file task, if any
+                task.result()
+            await start_task
+        except:
+            start_task.cancel()
+            for task in file_tasks:
+                task.cancel()
+            await asyncio.gather(
+                start_task, *file_tasks, return_exceptions=True
+            )
+            raise
 
         await output_queue.put(QUEUE_FINISHED)
 
@@ -907,7 +1089,12 @@ class Backup:
 
         self.log.debug("Will backup: {}".format(files_to_backup))
 
-        header_files = await self._prepare_backup_header()
+        try:
+            await self._export_volumes_changes(files_to_backup)
+            header_files = await self._prepare_backup_header()
+        except:
+            await self._finish_volume_exports(False)
+            raise
 
         # Setup worker to send encrypted data chunks to the backup_target
         to_send = asyncio.Queue(10)
@@ -942,6 +1129,7 @@ class Backup:
             self._cancel_on_error(send_task, inner_archive_task)
         )
 
+        archived = False
         try:
             try:
                 await inner_archive_task
@@ -958,8 +1146,10 @@ class Backup:
                 raise
 
             await send_task
+            archived = True
 
         finally:
+            success = False
             if isinstance(backup_stdout, int):
                 os.close(backup_stdout)
             else:
@@ -967,8 +1157,10 @@ class Backup:
             try:
                 if vmproc_task:
                     await vmproc_task
+                success = archived
             finally:
                 shutil.rmtree(self.tmpdir)
+                await self._finish_volume_exports(success)
 
         # Save date of last backup, only when backup succeeded
         for qid, vm_info in files_to_backup.items():
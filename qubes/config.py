@@ -108,6 +108,17 @@ qubes_ipv6_prefix = "fd09:24ef:4179:0000"
 
 suspend_timeout = 60
 
+#: how long qubesd coalesces qubes.xml writes (seconds)
+save_delay = 0.1
+
+#: how many qubes admin.vm.StartMany and admin.vm.ShutdownMany handle at the
+# same time
+vm_batch_concurrency = 4
+
+#: period (in seconds) over which requests for disposables are counted to size
+# memory kept free by qmemman for new disposables
+dispvm_demand_window = 600
+
 #: amount of available memory on the system. Beware that the use of a file is
 # subject to change.
 qmemman_avail_mem_file = "/var/run/qubes/qmemman-avail-mem"
@@ -56,6 +56,102 @@ def handler(*events):
     return decorator
 
 
+#: incremented whenever a handler registered on any class changes; see
+#: :py:meth:`Emitter._get_class_handlers`
+_handlers_generation = 0
+
+
+def _invalidate_dispatch_cache():
+    global _handlers_generation  # pylint: disable=global-statement
+    _handlers_generation += 1
+
+
+def _is_wildcard(pattern):
+    return any(c in pattern for c in "*?[")
+
+
+class _Handlers(collections.defaultdict):
+    """Handlers keyed by event pattern.
+
+    Patterns containing wildcards are tracked separately, so events can be
+    matched by a plain dict lookup when there are none.
+    """
+
+    def __init__(self, default_factory=set):
+        super().__init__(default_factory)
+        self.wildcards = set()
+
+    def __setitem__(self, key, value):
+        if _is_wildcard(key):
+            self.wildcards.add(key)
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self.wildcards.discard(key)
+        super().__delitem__(key)
+
+    def match(self, event):
+        """Return handlers for *event*, bound handlers first."""
+        if not self.wildcards:
+            handlers = list(self.get(event, ()))
+        else:
+            handlers = [
+                h_func
+                for h_name, h_func_set in self.items()
+                if h_name == event
+                or (h_name in self.wildcards and fnmatch.fnmatch(event, h_name))
+                for h_func in h_func_set
+            ]
+        if len(handlers) > 1:
+            handlers.sort(
+                key=(lambda handler: hasattr(handler, "ha_bound")),
+                reverse=True,
+            )
+        return handlers
+
+
+class _ClassHandlerSet(set):
+    """Set of handlers of a single class, invalidating dispatch cache when
+    modified"""
+
+    def add(self, element):
+        _invalidate_dispatch_cache()
+        super().add(element)
+
+    def remove(self, element):
+        _invalidate_dispatch_cache()
+        super().remove(element)
+
+    def discard(self, element):
+        _invalidate_dispatch_cache()
+        super().discard(element)
+
+    def update(self, *others):
+        _invalidate_dispatch_cache()
+        super().update(*others)
+
+    def clear(self):
+        _invalidate_dispatch_cache()
+        super().clear()
+
+
+class _ClassHandlers(_Handlers):
+    """Handlers registered on a class"""
+
+    def __init__(self):
+        super().__init__(_ClassHandlerSet)
+
+    def __setitem__(self, key, value):
+        _invalidate_dispatch_cache()
+        if not isinstance(value, _ClassHandlerSet):
+            value = _ClassHandlerSet(value)
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        _invalidate_dispatch_cache()
+        super().__delitem__(key)
+
+
 def ishandler(obj):
     """Test if a method is hooked to an event.
 
@@ -72,7 +168,10 @@ class EmitterMeta(type):
 
     def __init__(cls, name, bases, dict_):
         super(EmitterMeta, cls).__init__(name, bases, dict_)
-        cls.__handlers__ = collections.defaultdict(set)
+        cls.__handlers__ = _ClassHandlers()
+        #: resolved class handlers, keyed by (event, pre_event)
+        cls._dispatch_cache = {}
+        cls._dispatch_cache_generation = None
 
         try:
             propnames = set(prop.__name__ for prop in cls.property_list())
@@ -104,7 +203,7 @@ class Emitter(metaclass=EmitterMeta):
         super().__init__(*args, **kwargs)
         if not hasattr(self, "events_enabled"):
             self.events_enabled = False
-        self.__handlers__ = collections.defaultdict(set)
+        self.__handlers__ = _Handlers()
 
     def close(self):
         self.events_enabled = False
@@ -136,42 +235,71 @@ class Emitter(metaclass=EmitterMeta):
         # pylint: disable=no-member
         self.__handlers__[event].remove(func)
 
-    def _fire_event(self, event, kwargs, pre_event=False):
-        """Fire event for classes in given order.
+    @classmethod
+    def _get_class_handlers(cls, event, pre_event):
+        """Return handlers registered on classes for given event.
 
-        Do not use this method. Use :py:meth:`fire_event`.
+        The result is a tuple of ``(handler, is_async)`` pairs in calling
+        order. It is cached per class until any class-level handler is added
+        or removed.
         """
 
-        if not self.events_enabled:
-            return [], []
+        if cls._dispatch_cache_generation != _handlers_generation:
+            cls._dispatch_cache = {}
+            cls._dispatch_cache_generation = _handlers_generation
+        try:
+            return cls._dispatch_cache[event, pre_event]
+        except KeyError:
+            pass
 
-        order = itertools.chain((self,), self.__class__.__mro__)
+        order = cls.__mro__
         if not pre_event:
-            order = reversed(list(order))
+            order = reversed(order)
 
-        effects = []
-        async_effects = []
+        handlers = []
         for i in order:
             try:
                 handlers_dict = i.__handlers__
             except AttributeError:
                 continue
-            handlers = [
-                h_func
-                for h_name, h_func_set in handlers_dict.items()
-                for h_func in h_func_set
-                if fnmatch.fnmatch(event, h_name)
+            handlers.extend(
+                (func, asyncio.iscoroutinefunction(func))
+                for func in handlers_dict.match(event)
+            )
+        handlers = tuple(handlers)
+        cls._dispatch_cache[event, pre_event] = handlers
+        return handlers
+
+    def _fire_event(self, event, kwargs, pre_event=False):
+        """Fire event for classes in given order.
+
+        Do not use this method. Use :py:meth:`fire_event`.
+        """
+
+        if not self.events_enabled:
+            return [], []
+
+        handlers = self._get_class_handlers(event, pre_event)
+        # pylint: disable=no-member
+        if self.__handlers__:
+            instance_handlers = [
+                (func, asyncio.iscoroutinefunction(func))
+                for func in self.__handlers__.match(event)
             ]
-            for func in sorted(
-                handlers,
-                key=(lambda handler: hasattr(handler, "ha_bound")),
-                reverse=True,
-            ):
-                effect = func(self, event, **kwargs)
-                if asyncio.iscoroutinefunction(func):
-                    async_effects.append(effect)
-                elif effect is not None:
-                    effects.extend(effect)
+            if instance_handlers:
+                if pre_event:
+                    handlers = itertools.chain(instance_handlers, handlers)
+                else:
+                    handlers = itertools.chain(handlers, instance_handlers)
+
+        effects = []
+        async_effects = []
+        for func, is_async in handlers:
+            effect = func(self, event, **kwargs)
+            if is_async:
+                async_effects.append(effect)
+            elif effect is not None:
+                effects.extend(effect)
         return effects, async_effects
 
     def fire_event(self, event, pre_event=False, **kwargs):
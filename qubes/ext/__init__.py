@@ -55,9 +55,22 @@ class Extension:
 
         return cls._instance
 
+    @classmethod
+    def get_instance(cls):
+        """Get the instance of the extension, or :py:obj:`None` if not
+        created yet.
+
+        Unlike calling the class, this does not re-run :py:meth:`__init__`,
+        which would reset the state of the extension.
+        """
+        return cls.__dict__.get("_instance")
+
     def __init__(self):
         #: This is to be implemented in extension handling devices
         self.devices_cache = collections.defaultdict(dict)
+        #: backend name -> pending device list change processing, see
+        #: :py:func:`qubes.ext.utils.schedule_device_list_change`
+        self.device_list_changes = {}
 
     #: This is to be implemented in extension handling devices
     def ensure_detach(self, vm, port):
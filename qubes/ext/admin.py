@@ -34,6 +34,9 @@ PROHIBITED_FEATURES = [
     "preload-dispvm-in-progress",
 ]
 
+#: maximum number of cached policy decisions
+POLICY_DECISIONS_MAX = 10000
+
 
 class JustEvaluateAskResolution(parser.AskResolution):
     async def execute(self):
@@ -55,6 +58,12 @@ class AdminExtension(qubes.ext.Extension):
         if not hasattr(self, "policy_cache"):
             self.policy_cache = utils.PolicyCache(lazy_load=True)
             self.policy_cache.initialize_watcher()
+        # results of policy evaluation, valid as long as the policy and
+        # system info they were computed with don't change
+        self._policy_decisions = {}
+        self._policy_decisions_for = (None, None)
+        self.policy_decision_hits = 0
+        self.policy_decision_misses = 0
 
     @qubes.ext.handler(
         "admin-permission:admin.vm.feature.Set",
@@ -94,7 +103,33 @@ class AdminExtension(qubes.ext.Extension):
         that the caller don't have permission to list
         """
         # pylint: disable=unused-argument
+        return self._filter_vms_by_policy(vm, "admin.vm.List", arg)
+
+    @qubes.ext.handler("admin-permission:admin.vm.property.GetAllForAll")
+    def admin_vm_property_get_all_for_all(self, vm, event, arg, **kwargs):
+        """Exclude domains that the caller don't have permission to call
+        admin.vm.property.GetAll on
+        """
+        # pylint: disable=unused-argument
+        return self._filter_vms_by_policy(vm, "admin.vm.property.GetAll", arg)
+
+    @qubes.ext.handler("admin-permission:admin.vm.StartMany")
+    def admin_vm_start_many(self, vm, event, arg, **kwargs):
+        """Allow starting only domains that the caller has permission to
+        call admin.vm.Start on
+        """
+        # pylint: disable=unused-argument
+        return self._filter_vms_by_policy(vm, "admin.vm.Start", arg)
 
+    @qubes.ext.handler("admin-permission:admin.vm.ShutdownMany")
+    def admin_vm_shutdown_many(self, vm, event, arg, **kwargs):
+        """Allow shutting down only domains that the caller has permission
+        to call admin.vm.Shutdown on
+        """
+        # pylint: disable=unused-argument
+        return self._filter_vms_by_policy(vm, "admin.vm.Shutdown", arg)
+
+    def _filter_vms_by_policy(self, vm, service, arg):
         if vm.klass == "AdminVM":
             # dom0 can always list everything
             return None
@@ -103,28 +138,65 @@ class AdminExtension(qubes.ext.Extension):
             # process cleanup, do not allow listing VMs anymore
             return ((lambda _vm: False),)
 
+        def filter_vms(dest_vm):
+            return self._policy_allows(vm, service, "+" + arg, dest_vm.name)
+
+        return (filter_vms,)
+
+    def _policy_allows(self, vm, service, arg, dest):
+        """Check if policy allows *vm* to call *service* with *arg* on
+        *dest*, without asking the user.
+
+        Decisions are cached until either the policy is reloaded, or system
+        info used to resolve tokens like ``@tag:`` changes (but not, for
+        example, power state of a domain).
+        """
         policy = self.policy_cache.get_policy()
         system_info = qubes.api.internal.SystemInfoCache.get_system_info(vm.app)
+        generation = qubes.api.internal.SystemInfoCache.policy_generation
+        cached_for = self._policy_decisions_for
+        if cached_for[0] is not policy or cached_for[1] != generation:
+            if self._policy_decisions:
+                vm.app.log.debug(
+                    "dropping %d cached policy decisions "
+                    "(%d hits, %d misses so far)",
+                    len(self._policy_decisions),
+                    self.policy_decision_hits,
+                    self.policy_decision_misses,
+                )
+            self._policy_decisions = {}
+            self._policy_decisions_for = (policy, generation)
 
-        def filter_vms(dest_vm):
-            request = parser.Request(
-                "admin.vm.List",
-                "+" + arg,
-                vm.name,
-                dest_vm.name,
-                system_info=system_info,
-                ask_resolution_type=JustEvaluateAskResolution,
-                allow_resolution_type=JustEvaluateAllowResolution,
-            )
-            try:
-                resolution = policy.evaluate(request)
-                # do not consider 'ask' as allow here,
-                # this needs to be not interactive
-                return isinstance(resolution, parser.AllowResolution)
-            except parser.AccessDenied:
-                return False
+        key = (vm.name, service, arg, dest)
+        try:
+            result = self._policy_decisions[key]
+        except KeyError:
+            pass
+        else:
+            self.policy_decision_hits += 1
+            return result
+        self.policy_decision_misses += 1
 
-        return (filter_vms,)
+        request = parser.Request(
+            service,
+            arg,
+            vm.name,
+            dest,
+            system_info=system_info,
+            ask_resolution_type=JustEvaluateAskResolution,
+            allow_resolution_type=JustEvaluateAllowResolution,
+        )
+        try:
+            resolution = policy.evaluate(request)
+            # do not consider 'ask' as allow here,
+            # this needs to be not interactive
+            result = isinstance(resolution, parser.AllowResolution)
+        except parser.AccessDenied:
+            result = False
+        if len(self._policy_decisions) >= POLICY_DECISIONS_MAX:
+            self._policy_decisions.clear()
+        self._policy_decisions[key] = result
+        return result
 
     @qubes.ext.handler("admin-permission:admin.Events")
     def admin_events(self, vm, event, arg, **kwargs):
@@ -153,27 +225,9 @@ class AdminExtension(qubes.ext.Extension):
                 # process cleanup, do not send events anymore
                 return False
 
-            policy = self.policy_cache.get_policy()
-            # TODO: cache system_info (based on last qubes.xml write time?)
-            system_info = qubes.api.internal.SystemInfoCache.get_system_info(
-                vm.app
+            return self._policy_allows(
+                vm, "admin.Events", "+" + event.replace(":", "_"), dest
             )
-            request = parser.Request(
-                "admin.Events",
-                "+" + event.replace(":", "_"),
-                vm.name,
-                dest,
-                system_info=system_info,
-                ask_resolution_type=JustEvaluateAskResolution,
-                allow_resolution_type=JustEvaluateAllowResolution,
-            )
-            try:
-                resolution = policy.evaluate(request)
-                # do not consider 'ask' as allow here,
-                # this needs to be not interactive
-                return isinstance(resolution, parser.AllowResolution)
-            except parser.AccessDenied:
-                return False
 
         return (filter_events,)
 
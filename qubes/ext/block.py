@@ -22,6 +22,8 @@
 """Qubes block devices extensions"""
 
 import asyncio
+import collections
+import functools
 import re
 import string
 import sys
@@ -215,33 +217,17 @@ class BlockDevice(qubes.device_protocol.DeviceInfo):
     @property
     def attachment(self) -> Optional[QubesVM]:
         """
-        Warning: this property is time-consuming, do not run in loop!
+        Frontend domain, looked up in the attachment index of
+        :py:class:`BlockDeviceExtension`.
         """
         if not self.backend_domain or not self.backend_domain.is_running():
             return None
-        for vm in self.backend_domain.app.domains:
-            if not vm.is_running() or not hasattr(vm, "libvirt_domain"):
-                continue
-            if self._is_attached_to(vm):
-                return vm
-
-        return None
-
-    def _is_attached_to(self, vm):
-        xml_desc = lxml.etree.fromstring(vm.libvirt_domain.XMLDesc())
-
-        for disk in xml_desc.findall("devices/disk"):
-            info = _try_get_block_device_info(vm.app, disk)
-            if not info:
-                continue
-            backend_domain, port_id = info
-
-            if backend_domain.name != self.backend_domain.name:
-                continue
-
-            if self.port_id == port_id:
-                return True
-        return False
+        ext = BlockDeviceExtension.get_instance()
+        if ext is None:
+            return None
+        return ext.get_device_attachments(self.backend_domain).get(
+            self.port_id, None
+        )
 
     @property  # type: ignore[misc]
     def device_id(self) -> str:
@@ -312,7 +298,55 @@ def _try_get_block_device_info(app, disk):
     return backend_domain, port_id
 
 
+def _get_block_disks(vm):
+    """List block devices attached to *vm*, according to its libvirt XML
+
+    :return: tuple (disks, frontends) - list of (backend_domain, port_id,
+        options) tuples, and set of frontend device names used by all disks
+        (not only block ones)
+    """
+    xml_desc = lxml.etree.fromstring(vm.libvirt_domain.XMLDesc())
+    disks = []
+    frontends = set()
+    for disk in xml_desc.findall("devices/disk"):
+        frontend_dev = None
+        target_node = disk.find("target")
+        if target_node is not None:
+            frontend_dev = target_node.get("dev")
+            frontends.add(frontend_dev)
+        try:
+            info = _try_get_block_device_info(vm.app, disk)
+        except KeyError:
+            continue
+        if not info:
+            continue
+        backend_domain, port_id = info
+
+        options = {}
+        if disk.find("readonly") is not None:
+            options["read-only"] = "yes"
+        else:
+            options["read-only"] = "no"
+        if frontend_dev:
+            options["frontend-dev"] = frontend_dev
+        if disk.get("device") != "disk":
+            options["devtype"] = disk.get("device")
+
+        disks.append((backend_domain, port_id, options))
+    return disks, frontends
+
+
 class BlockDeviceExtension(qubes.ext.Extension):
+    def __init__(self):
+        super().__init__()
+        #: frontend name -> block devices attached to it (see
+        #: :py:func:`_get_block_disks`)
+        self._frontend_disks = {}
+        #: backend name -> {port_id: frontend}
+        self._attachments = collections.defaultdict(dict)
+        #: whether all running domains are in :py:attr:`_frontend_disks`
+        self._attachments_synced = False
+        self.assigned_frontends = utils.AssignedFrontends("block")
 
     @qubes.ext.handler("domain-init", "domain-load")
     def on_domain_init_load(self, vm, event):
@@ -335,6 +369,13 @@ class BlockDeviceExtension(qubes.ext.Extension):
             self.devices_cache[vm.name] = {}
 
     @qubes.ext.handler("domain-qdb-change:/qubes-block-devices")
+    def on_qdb_watch(self, vm, event, path):
+        """Process QubesDB changes of a device list, after a burst of them
+        is over"""
+        utils.schedule_device_list_change(
+            self, vm, functools.partial(self.on_qdb_change, vm, event, path)
+        )
+
     def on_qdb_change(self, vm, event, path):
         """A change in QubesDB means a change in a device list."""
         # pylint: disable=unused-argument
@@ -343,30 +384,81 @@ class BlockDeviceExtension(qubes.ext.Extension):
             (dev.port_id, device_attachments.get(dev.port_id, None))
             for dev in self.on_device_list_block(vm, None)
         )
-        utils.device_list_change(self, current_devices, vm, path, BlockDevice)
+        utils.device_list_change(
+            self,
+            current_devices,
+            vm,
+            path,
+            BlockDevice,
+            frontends=self.assigned_frontends.get(vm),
+        )
 
-    @staticmethod
-    def get_device_attachments(vm_):
-        result = {}
-        for vm in vm_.app.domains:
-            if not vm.is_running() or isinstance(vm, RemoteVM):
-                continue
+    @qubes.ext.handler("device-assign:block", "device-unassign:block")
+    def on_device_assign_block(self, vm, event, device, **kwargs):
+        """Update index of domains with devices assigned"""
+        # pylint: disable=unused-argument
+        self.assigned_frontends.update(vm)
 
-            if vm.app.vmm.offline_mode:
-                return result
+    @qubes.ext.handler("domain-add", system=True)
+    def on_domain_add(self, app, event, vm, **kwargs):
+        # pylint: disable=unused-argument
+        self.assigned_frontends.update(vm)
 
-            xml_desc = lxml.etree.fromstring(vm.libvirt_domain.XMLDesc())
+    @qubes.ext.handler("domain-delete", system=True)
+    def on_domain_delete(self, app, event, vm, **kwargs):
+        # pylint: disable=unused-argument
+        self.assigned_frontends.remove(vm)
 
-            for disk in xml_desc.findall("devices/disk"):
-                info = _try_get_block_device_info(vm.app, disk)
-                if not info:
-                    continue
-                backend_domain, port_id = info
-                if backend_domain != vm_:
-                    continue
+    def get_device_attachments(self, vm_):
+        """Get frontends of block devices exposed by *vm_*
 
-                result[port_id] = vm
-        return result
+        :return: dict port_id -> frontend VM
+        """
+        if vm_.app.vmm.offline_mode:
+            return {}
+        if not self._attachments_synced:
+            self.resync_attachments(vm_.app)
+        return dict(self._attachments.get(vm_.name, {}))
+
+    def resync_attachments(self, app):
+        """Rebuild the attachment index from libvirt XML of all running
+        domains
+
+        The index is kept up to date on device attach/detach and domain
+        start/stop, so this is needed only if the domains were changed
+        outside of qubesd.
+        """
+        self._frontend_disks.clear()
+        self._attachments.clear()
+        for vm in app.domains:
+            if isinstance(vm, RemoteVM) or not vm.is_running():
+                continue
+            self._index_frontend(vm)
+        self._attachments_synced = True
+
+    def _get_frontend_disks(self, vm):
+        """Block devices attached to *vm*, see :py:func:`_get_block_disks`"""
+        try:
+            return self._frontend_disks[vm.name]
+        except KeyError:
+            return self._index_frontend(vm)
+
+    def _index_frontend(self, vm):
+        """(Re)load block devices attached to *vm* into the index"""
+        self._forget_frontend(vm)
+        disks, frontends = _get_block_disks(vm)
+        self._frontend_disks[vm.name] = disks, frontends
+        for backend_domain, port_id, _options in disks:
+            self._attachments[backend_domain.name][port_id] = vm
+        return disks, frontends
+
+    def _forget_frontend(self, vm):
+        """Remove block devices attached to *vm* from the index"""
+        disks, _frontends = self._frontend_disks.pop(vm.name, ((), None))
+        for backend_domain, port_id, _options in disks:
+            ports = self._attachments.get(backend_domain.name, {})
+            if ports.get(port_id) is vm:
+                del ports[port_id]
 
     @staticmethod
     def device_get(vm, port_id):
@@ -432,64 +524,23 @@ class BlockDeviceExtension(qubes.ext.Extension):
         system_disks = SYSTEM_DISKS
         if getattr(vm, "kernel", None):
             system_disks = SYSTEM_DISKS_DOM0_KERNEL
-        xml_desc = lxml.etree.fromstring(vm.libvirt_domain.XMLDesc())
+        disks, _frontends = self._get_frontend_disks(vm)
 
-        for disk in xml_desc.findall("devices/disk"):
-            if disk.get("type") != "block":
-                continue
-            dev_path_node = disk.find("source")
-            if dev_path_node is None:
-                continue
-            dev_path = dev_path_node.get("dev")
-
-            target_node = disk.find("target")
-            if target_node is not None:
-                frontend_dev = target_node.get("dev")
-                if not frontend_dev:
-                    continue
-                if frontend_dev in system_disks:
-                    continue
-            else:
+        for backend_domain, port_id, options in disks:
+            frontend_dev = options.get("frontend-dev")
+            if not frontend_dev or frontend_dev in system_disks:
                 continue
+            yield BlockDevice(Port(backend_domain, port_id, "block")), dict(
+                options
+            )
 
-            backend_domain_node = disk.find("backenddomain")
-            if backend_domain_node is not None:
-                backend_domain = vm.app.domains[backend_domain_node.get("name")]
-            else:
-                backend_domain = vm.app.domains[0]
-
-            options = {}
-            read_only_node = disk.find("readonly")
-            if read_only_node is not None:
-                options["read-only"] = "yes"
-            else:
-                options["read-only"] = "no"
-            options["frontend-dev"] = frontend_dev
-            if disk.get("device") != "disk":
-                options["devtype"] = disk.get("device")
-
-            if dev_path.startswith("/dev/"):
-                port_id = dev_path[len("/dev/") :]
-            else:
-                port_id = dev_path
-
-            port_id = port_id.replace("/", "_")
-
-            yield BlockDevice(Port(backend_domain, port_id, "block")), options
-
-    @staticmethod
-    def find_unused_frontend(vm, devtype="disk"):
+    def find_unused_frontend(self, vm, devtype="disk"):
         """
         Find unused block frontend device node for <target dev=.../> parameter
         """
         assert vm.is_running()
 
-        xml = vm.libvirt_domain.XMLDesc()
-        parsed_xml = lxml.etree.fromstring(xml)
-        used = [
-            target.get("dev", None)
-            for target in parsed_xml.xpath("//domain/devices/disk/target")
-        ]
+        _disks, used = self._get_frontend_disks(vm)
         if devtype == "cdrom" and "xvdd" not in used:
             # prefer 'xvdd' for CDROM if available; only first 4 disks are
             # emulated in HVM, which means only those are bootable
@@ -509,6 +560,7 @@ class BlockDeviceExtension(qubes.ext.Extension):
                 device=device, vm=vm, options=options
             )
         )
+        self._index_frontend(vm)
 
     def pre_attachment_internal(
         self, vm, device, options, expected_attachment=None
@@ -565,10 +617,13 @@ class BlockDeviceExtension(qubes.ext.Extension):
             )
             return
 
-        if device.attachment and device.attachment != expected_attachment:
+        attachment = self.get_device_attachments(device.backend_domain).get(
+            device.port_id
+        )
+        if attachment and attachment != expected_attachment:
             raise qubes.exc.DeviceAlreadyAttached(
                 "Device {!s} already attached to {!s}".format(
-                    device, device.attachment
+                    device, attachment
                 )
             )
 
@@ -590,6 +645,7 @@ class BlockDeviceExtension(qubes.ext.Extension):
     async def on_domain_start(self, vm, _event, **_kwargs):
         # pylint: disable=unused-argument
         to_attach = {}
+        attachments = {}
         assignments = vm.devices["block"].get_assigned_devices()
         # the most specific assignments first
         for assignment in reversed(sorted(assignments)):
@@ -599,7 +655,12 @@ class BlockDeviceExtension(qubes.ext.Extension):
             for device in assignment.devices:
                 if isinstance(device, qubes.device_protocol.UnknownDevice):
                     continue
-                if device.attachment:
+                backend = device.backend_domain
+                if backend.name not in attachments:
+                    attachments[backend.name] = self.get_device_attachments(
+                        backend
+                    )
+                if attachments[backend.name].get(device.port_id):
                     continue
                 if not assignment.matches(device):
                     print(
@@ -637,12 +698,26 @@ class BlockDeviceExtension(qubes.ext.Extension):
             "device-attach:block", device=device, options=assignment.options
         )
 
+    @qubes.ext.handler("domain-spawn")
+    def on_domain_spawn(self, vm, event, **kwargs):
+        """Index block devices attached to the vm already on start"""
+        # pylint: disable=unused-argument
+        if not vm.app.vmm.offline_mode:
+            self._index_frontend(vm)
+
+    @qubes.ext.handler("domain-start-failed")
+    def on_domain_start_failed(self, vm, event, **kwargs):
+        # pylint: disable=unused-argument
+        self._forget_frontend(vm)
+
     @qubes.ext.handler("domain-shutdown")
     async def on_domain_shutdown(self, vm, event, **_kwargs):
         """
         Remove from cache devices attached to or exposed by the vm.
         """
         # pylint: disable=unused-argument
+        self._forget_frontend(vm)
+        utils.cancel_device_list_change(self, vm)
 
         # devices exposed by the shutting-down backend vm:
         # notify that they are gone and detach them from frontend vms
@@ -674,6 +749,11 @@ class BlockDeviceExtension(qubes.ext.Extension):
     def on_qubes_close(self, app, event):
         # pylint: disable=unused-argument
         self.devices_cache.clear()
+        self._frontend_disks.clear()
+        self._attachments.clear()
+        self._attachments_synced = False
+        self.assigned_frontends.clear()
+        utils.cancel_device_list_change(self)
 
     @qubes.ext.handler("device-pre-detach:block")
     def on_device_pre_detached_block(self, vm, event, port):
@@ -693,4 +773,5 @@ class BlockDeviceExtension(qubes.ext.Extension):
                         device=attached_device, vm=vm, options=options
                     )
                 )
+                self._index_frontend(vm)
                 break
@@ -20,7 +20,7 @@
 # USA.
 import asyncio
 import sys
-from typing import Type, Dict
+from typing import Type, Dict, Iterable, Optional
 
 import qubes.ext
 from qrexec.server import call_socket_service
@@ -29,6 +29,102 @@ from qubes.device_protocol import VirtualDevice, Port
 
 SOCKET_PATH = "/var/run/qubes"
 
+#: time (in seconds) to wait for further changes of a backend's device list
+#: before processing them, see :py:func:`schedule_device_list_change`
+DEVICE_LIST_CHANGE_DELAY = 0.1
+
+
+def schedule_device_list_change(ext: qubes.ext.Extension, vm, callback):
+    """Process a change of device list of backend *vm* after a short delay
+
+    Devices often appear in bursts (like a hub with several partitions),
+    each causing a separate QubesDB watch notification. Notifications
+    received within :py:data:`DEVICE_LIST_CHANGE_DELAY` seconds are
+    coalesced, and *callback* (which should list the devices and call
+    :py:func:`device_list_change`) is called once for all of them.
+    """
+    if vm.name in ext.device_list_changes:
+        return
+
+    def process():
+        del ext.device_list_changes[vm.name]
+        try:
+            callback()
+        except Exception:  # pylint: disable=broad-except
+            vm.log.exception("Failed to process device list change")
+
+    ext.device_list_changes[vm.name] = asyncio.get_event_loop().call_later(
+        DEVICE_LIST_CHANGE_DELAY, process
+    )
+
+
+def cancel_device_list_change(ext: qubes.ext.Extension, vm=None):
+    """Cancel pending device list change processing of backend *vm* (or of
+    all backends)"""
+    names = [vm.name] if vm is not None else list(ext.device_list_changes)
+    for name in names:
+        handle = ext.device_list_changes.pop(name, None)
+        if handle is not None:
+            handle.cancel()
+
+
+class AssignedFrontends:
+    """Domains with devices assigned, indexed by backend
+
+    Lets :py:func:`device_list_change` check assignments only of domains
+    that may want a device of the given backend, instead of all of them.
+    The index is built from all domains on first use; after that, call
+    :py:meth:`update` when assignments of a domain change and
+    :py:meth:`remove` when a domain is removed.
+
+    :param str devclass: device class
+    """
+
+    def __init__(self, devclass: str):
+        self.devclass = devclass
+        #: backend name -> {frontend name: frontend}
+        self._frontends: Dict[str, Dict] = {}
+        #: frontend name -> backend names
+        self._backends: Dict[str, set] = {}
+        self._built = False
+
+    def get(self, backend) -> list:
+        """Domains with devices of *backend* assigned"""
+        if not self._built:
+            for vm in backend.app.domains:
+                if not hasattr(vm, "devices"):
+                    # RemoteVM
+                    continue
+                self.update(vm)
+            self._built = True
+        return list(self._frontends.get(backend.name, {}).values())
+
+    def update(self, vm):
+        """Reload assignments of *vm*"""
+        self.remove(vm)
+        if not hasattr(vm, "devices"):
+            # RemoteVM
+            return
+        backends = set(
+            assignment.backend_name
+            for assignment in vm.devices[self.devclass].get_assigned_devices()
+        )
+        if backends:
+            self._backends[vm.name] = backends
+        for backend_name in backends:
+            self._frontends.setdefault(backend_name, {})[vm.name] = vm
+
+    def remove(self, vm):
+        """Remove *vm* from the index"""
+        for backend_name in self._backends.pop(vm.name, ()):
+            self._frontends[backend_name].pop(vm.name, None)
+
+    def clear(self):
+        """Forget everything, the index will be rebuilt on next use"""
+        self._frontends.clear()
+        self._backends.clear()
+        self._built = False
+
 
 def device_list_change(
     ext: qubes.ext.Extension,
@@ -36,7 +132,14 @@ def device_list_change(
     vm,
     path,
     device_class: Type[qubes.device_protocol.DeviceInfo],
+    frontends: Optional[Iterable] = None,
 ):
+    """Compare current devices of backend *vm* with the cached ones, fire
+    events about the changes and auto-attach new devices
+
+    :param frontends: domains to check assignments of, for example from
+        :py:class:`AssignedFrontends`; all domains by default
+    """
     devclass = device_class.__name__[: -len("Device")].lower()
 
     if path is not None:
@@ -80,8 +183,14 @@ def device_list_change(
 
     ext.devices_cache[vm.name] = current_devices
 
+    if not added:
+        # nothing to auto-attach
+        frontends = ()
+    elif frontends is None:
+        frontends = vm.app.domains
+
     to_attach: Dict[str, Dict] = {}
-    for front_vm in vm.app.domains:
+    for front_vm in frontends:
         if front_vm.klass == "RemoteVM":
             continue
         if not front_vm.is_running():
@@ -95,16 +204,16 @@ def device_list_change(
                     and device.port_id in added
                     and device.port_id not in attached
                 ):
-                    frontends = to_attach.get(device.port_id, {})
+                    candidates = to_attach.get(device.port_id, {})
                     # make it unique
                     ass = assignment.clone(
                         device=VirtualDevice(device.port, device.device_id)
                     )
-                    curr = frontends.get(front_vm, None)
+                    curr = candidates.get(front_vm, None)
                     if curr is None or curr < ass:
                         # chose the most specific assignment
-                        frontends[front_vm] = ass
-                    to_attach[device.port_id] = frontends
+                        candidates[front_vm] = ass
+                    to_attach[device.port_id] = candidates
 
     asyncio.ensure_future(resolve_conflicts_and_attach(ext, to_attach))
 
@@ -30,6 +30,9 @@ DOM0_MEM_BOOST = 350 * 1024 * 1024
 # yields a bit less than requested, due to e.g. rounding errors, we will not
 # get stuck. The surplus will return to the VM during "balance" call.
 REQ_SAFETY_NET_FACTOR = 1.05
+# Implementation of balance(): "iterative" (balance_when_enough_mem and
+# balance_when_low_on_mem) or "waterfill" (balance_waterfill).
+BALANCE_ALGORITHM = "iterative"
 
 log = logging.getLogger("qmemman.daemon.algo")
 
@@ -210,6 +213,100 @@ def balance_when_low_on_mem(
     return donors_rq + acceptors_rq
 
 
+def waterfill(prefs, maxs, total) -> list:
+    """Split *total* memory proportionally to *prefs*, but give no more than
+    *maxs* (lists indexed by domain)
+
+    Returns per-domain targets, not rounded. Single pass over domains sorted
+    by max/pref ratio: those with the lowest ratio hit their max first.
+    """
+    targets = list(maxs)
+    order = sorted(range(len(prefs)), key=lambda i: maxs[i] / prefs[i])
+    capped_mem = 0
+    uncapped_pref = sum(prefs)
+    for pos, i in enumerate(order):
+        # scale at which domain i would reach its max
+        if capped_mem + maxs[i] / prefs[i] * uncapped_pref >= total:
+            scale = (total - capped_mem) / uncapped_pref
+            for j in order[pos:]:
+                targets[j] = prefs[j] * scale
+            break
+        capped_mem += maxs[i]
+        uncapped_pref -= prefs[i]
+    return targets
+
+
+# Same as balance(), but computes all targets in one pass over domains (see
+# waterfill()), calling pref_mem() once per domain. When there is enough
+# memory, the leftover from domains at their max is distributed
+# proportionally to pref_mem, instead of equally.
+def balance_waterfill(xen_free_mem, dom_dict) -> list:
+    log.debug(
+        "balance_waterfill(xen_free_mem={!r}, dom_dict={!r})".format(
+            xen_free_mem, dom_dict
+        )
+    )
+    domids = []
+    prefs = []
+    actuals = []
+    maxs = []
+    for domid, dom in dom_dict.items():
+        if dom.mem_used is None or dom.no_progress:
+            continue
+        domids.append(domid)
+        prefs.append(pref_mem(dom))
+        actuals.append(dom.mem_actual)
+        maxs.append(dom.mem_max)
+    total_available_mem = xen_free_mem - (sum(prefs) - sum(actuals))
+
+    targets: list[Optional[int]] = []
+    if total_available_mem > 0:
+        total_mem = sum(prefs) + total_available_mem
+        for target, maximum in zip(waterfill(prefs, maxs, total_mem), maxs):
+            if target < maximum:
+                # Prevent rounding errors.
+                target = int(0.999 * target)
+            targets.append(target)
+    else:
+        # Make donors be at pref_mem, and redistribute anything left between
+        # acceptors.
+        squeezed_mem = xen_free_mem
+        acceptors_pref = 0
+        for pref, actual, maximum in zip(prefs, actuals, maxs):
+            if pref < actual or actual >= maximum:
+                if actual - pref < 10 * 1024 * 1024:
+                    # Probably already at pref_mem, give up.
+                    targets.append(None)
+                    continue
+                squeezed_mem -= actual - pref
+                targets.append(pref)
+            else:
+                acceptors_pref += pref
+                targets.append(-1)
+        for i, target in enumerate(targets):
+            if target != -1:
+                continue
+            if squeezed_mem < 0:
+                # Can happen if initially xen free memory is below 50M.
+                targets[i] = None
+                continue
+            scale = 1.0 * prefs[i] / acceptors_pref
+            target_nonint = actuals[i] + scale * squeezed_mem
+            targets[i] = min(int(0.999 * target_nonint), maxs[i])
+
+    # Get memory from donors first and only then give it to acceptors.
+    donors_rq = []
+    acceptors_rq = []
+    for domid, target, actual in zip(domids, targets, actuals):
+        if target is None:
+            continue
+        if target < actual:
+            donors_rq.append((domid, target))
+        else:
+            acceptors_rq.append((domid, target))
+    return donors_rq + acceptors_rq
+
+
 # Get memory information.
 # Called before and after domain balances.
 # Return a dictionary of various memory data points.
@@ -265,12 +362,14 @@ def mem_info(xen_free_mem, dom_dict) -> dict:
 # Called when one of domains update its 'meminfo' xenstore key.
 # Return the list of (domain, mem_target) pairs to be passed to "xm memset"
 # equivalent
-def balance(xen_free_mem, dom_dict) -> dict:
+def balance(xen_free_mem, dom_dict) -> list:
     log.debug(
         "balance(xen_free_mem={!r}, dom_dict={!r})".format(
             xen_free_mem, dom_dict
         )
     )
+    if BALANCE_ALGORITHM == "waterfill":
+        return balance_waterfill(xen_free_mem, dom_dict)
     mem_dict = mem_info(xen_free_mem, dom_dict)
 
     if mem_dict["total_available_mem"] > 0:
@@ -17,8 +17,12 @@
 # License along with this library; if not, see <https://www.gnu.org/licenses/>.
 #
 
+import itertools
 import socket
 import fcntl
+import threading
+
+SOCK_PATH = "/var/run/qubes/qmemman.sock"
 
 
 class QMemmanClient:
@@ -30,7 +34,7 @@ class QMemmanClient:
         flags = fcntl.fcntl(self.sock.fileno(), fcntl.F_GETFD)
         flags |= fcntl.FD_CLOEXEC
         fcntl.fcntl(self.sock.fileno(), fcntl.F_SETFD, flags)
-        self.sock.connect("/var/run/qubes/qmemman.sock")
+        self.sock.connect(SOCK_PATH)
         self.sock.send(data.encode("ascii"))
         received = self.sock.recv(1024).strip()
         return bool(received == b"OK")
@@ -47,3 +51,153 @@ class QMemmanClient:
     def close(self) -> None:
         assert isinstance(self.sock, socket.socket)
         self.sock.close()
+
+
+class QMemmanReservation:  # pylint: disable=too-few-public-methods
+    """Memory reserved with :py:meth:`QMemmanConnection.request_mem`
+
+    Has the same :py:meth:`close` method as :py:class:`QMemmanClient`, to
+    release the memory once it is used.
+    """
+
+    def __init__(self, connection: "QMemmanConnection", req_id: str) -> None:
+        self.connection = connection
+        self.req_id = req_id
+
+    def close(self) -> None:
+        """Release the memory, without waiting for qmemman to confirm it"""
+        try:
+            self.connection.release(self.req_id, wait=False)
+        except OSError:
+            # qmemman will release it after the reservation timeout
+            pass
+
+
+class QMemmanConnection:
+    """Long-lived connection to qmemman, with multiplexed requests
+
+    Unlike :py:class:`QMemmanClient`, requests can be issued concurrently
+    from multiple threads, over one connection. Reserved memory is not bound
+    to the connection, but released explicitly (or by qmemman, after
+    *timeout*). The connection is (re)established on demand.
+    """
+
+    def __init__(self, path: str = SOCK_PATH) -> None:
+        self.path = path
+        self.sock: socket.socket | None = None
+        self._lock = threading.Lock()
+        self._ids = itertools.count()
+        #: request id -> [event, response]
+        self._pending: dict[str, list] = {}
+        #: memory qmemman is asked to keep free, see :py:meth:`set_headroom`
+        self.headroom = 0
+
+    def _connect(self) -> socket.socket:
+        sock = socket.socket(socket.AF_UNIX)
+        flags = fcntl.fcntl(sock.fileno(), fcntl.F_GETFD)
+        flags |= fcntl.FD_CLOEXEC
+        fcntl.fcntl(sock.fileno(), fcntl.F_SETFD, flags)
+        sock.connect(self.path)
+        if self.headroom:
+            # qmemman may have been restarted
+            sock.sendall(
+                "{} headroom {}\n".format(
+                    next(self._ids), self.headroom
+                ).encode("ascii")
+            )
+        threading.Thread(
+            target=self._read_responses, args=(sock,), daemon=True
+        ).start()
+        return sock
+
+    def _read_responses(self, sock: socket.socket) -> None:
+        with sock.makefile("rb") as rfile:
+            for line in rfile:
+                try:
+                    req_id, resp = line.decode("ascii").split()
+                except ValueError:
+                    continue
+                with self._lock:
+                    request = self._pending.pop(req_id, None)
+                if request is not None:
+                    request[1] = resp
+                    request[0].set()
+        # connection lost, fail requests still waiting for response
+        with self._lock:
+            if self.sock is sock:
+                self.sock = None
+            pending = list(self._pending.values())
+            self._pending.clear()
+        for request in pending:
+            request[0].set()
+
+    def _call(self, command: str, wait: bool = True) -> tuple[str, bool]:
+        event = threading.Event()
+        request: list = [event, None]
+        with self._lock:
+            req_id = str(next(self._ids))
+            if self.sock is None:
+                self.sock = self._connect()
+            if wait:
+                self._pending[req_id] = request
+            try:
+                self.sock.sendall(
+                    "{} {}\n".format(req_id, command).encode("ascii")
+                )
+            except OSError:
+                self._pending.pop(req_id, None)
+                self.sock.close()
+                self.sock = None
+                raise
+        if not wait:
+            return req_id, True
+        event.wait()
+        if request[1] is None:
+            raise IOError("Connection to qmemman lost")
+        return req_id, request[1] == "OK"
+
+    def request_mem(
+        self, amount: int | float, timeout: float | None = None
+    ) -> QMemmanReservation | None:
+        """Reserve *amount* bytes of memory, for at most *timeout* seconds
+
+        :return: reservation to close, or :py:obj:`None` if there is not
+            enough memory
+        """
+        command = "reserve {}".format(int(amount))
+        if timeout is not None:
+            command += " {}".format(timeout)
+        req_id, result = self._call(command)
+        if not result:
+            return None
+        return QMemmanReservation(self, req_id)
+
+    def release(self, req_id: str, wait: bool = True) -> bool:
+        """Release memory reserved by request *req_id*"""
+        return self._call("release {}".format(req_id), wait)[1]
+
+    def set_mem(self, dom_memset: dict[int | str, int | float]) -> bool:
+        dom_memset_str = " ".join(
+            "{}:{}".format(key, int(value)) for key, value in dom_memset.items()
+        )
+        return self._call("set_mem {}".format(dom_memset_str))[1]
+
+    def set_headroom(self, amount: int | float) -> None:
+        """Ask qmemman to keep *amount* bytes of memory free (if domains have
+        more than they prefer), so future requests can be satisfied quickly
+
+        Does not wait for qmemman to confirm it. The value is sent again
+        after reconnection.
+        """
+        self.headroom = int(amount)
+        self._call("headroom {}".format(self.headroom), wait=False)
+
+    def close(self) -> None:
+        with self._lock:
+            if self.sock is not None:
+                try:
+                    self.sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                self.sock.close()
+                self.sock = None
@@ -37,6 +37,8 @@ class DomainState:  # pylint: disable=too-few-public-methods
         self.last_target: int = 0
         # Use memory hotplug for mem-set.
         self.use_hotplug: bool = False
+        # mem_max and use_hotplug need to be re-read from xenstore.
+        self.mem_max_stale: bool = True
         # No reaction to memset.
         self.no_progress: bool = False
         # Slow react to memset (after few tries still above target).
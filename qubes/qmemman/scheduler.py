@@ -0,0 +1,269 @@
+#
+# The Qubes OS Project, https://www.qubes-os.org/
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this library; if not, see <https://www.gnu.org/licenses/>.
+
+import logging
+import threading
+import time
+from typing import Callable, Optional
+
+import qubes.qmemman.algo
+from qubes.qmemman.systemstate import (
+    BALLOON_DELAY,
+    CHECK_DELTA,
+    CHECK_PERIOD,
+    XEN_FREE_MEM_LEFT,
+    XEN_FREE_MEM_MIN,
+    SystemState,
+)
+
+#: time (in seconds) after which a reservation not released by its client
+#: is released anyway
+RESERVATION_TIMEOUT = 300
+
+
+class BalloonRequest:  # pylint: disable=too-few-public-methods
+    """Request for *mem_size* bytes of free Xen memory"""
+
+    def __init__(self, mem_size: int) -> None:
+        self.mem_size = mem_size
+        self.result: Optional[bool] = None
+        self.done = threading.Event()
+
+    def finish(self, result: bool) -> None:
+        self.result = result
+        self.done.set()
+
+
+class BalloonScheduler:
+    """Serve memory requests of concurrent clients with one ballooning loop
+
+    Requests pending at the same time are summed into one balloon target,
+    and each of them is granted (in order) as soon as there is enough free
+    memory for it. Granted memory is kept in
+    :py:attr:`SystemState.reserved_mem` until the client releases it, and
+    balancing is suspended in the meantime - like when the whole request
+    was served under the lock.
+
+    *lock* (protecting *system_state*) is released between ballooning
+    iterations, so xenstore watches are still processed while waiting for
+    domains to give memory back.
+    """
+
+    def __init__(self, system_state: SystemState, lock: threading.Lock):
+        self.log = logging.getLogger("qmemman.scheduler")
+        self.system_state = system_state
+        self.lock = lock
+        self._cond = threading.Condition()
+        self._pending: list[BalloonRequest] = []
+
+    def request(self, mem_size: int) -> bool:
+        """Wait until *mem_size* bytes of memory are reserved
+
+        :return: :py:obj:`False` if the memory could not be freed
+        """
+        req = BalloonRequest(mem_size)
+        with self._cond:
+            self._pending.append(req)
+            self._cond.notify()
+        req.done.wait()
+        assert req.result is not None
+        return req.result
+
+    def release(self, mem_size: int) -> None:
+        """Return memory granted by :py:meth:`request`"""
+        with self.lock:
+            self.system_state.reserved_mem -= mem_size
+
+    def run(self) -> None:
+        """Main loop, to be run in a separate thread"""
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+            try:
+                self.balloon()
+            except:  # pylint: disable=bare-except
+                self.log.exception("balloon() failed")
+                self._finish(len(self._pending), False)
+
+    def _finish(self, count: int, result: bool) -> None:
+        with self._cond:
+            finished = self._pending[:count]
+            del self._pending[:count]
+        for req in finished:
+            req.finish(result)
+
+    def balloon(self) -> None:
+        """Balloon domains down until all pending requests are granted, or
+        no more progress is made (then fail the remaining ones)"""
+        with self.lock:
+            self.system_state.balloon_in_progress = True
+            for dom in self.system_state.dom_dict.values():
+                dom.no_progress = False
+        try:
+            self._balloon()
+        finally:
+            with self.lock:
+                self.system_state.balloon_in_progress = False
+
+    def _balloon(self) -> None:
+        state = self.system_state
+        niter = 0
+        prev_mem_actual: dict[str, Optional[int]] = {}
+        #: memory granted so far, to not count it as lack of progress
+        granted_mem = 0
+        #: helper array for holding free memory size, CHECK_PERIOD_S seconds
+        #: ago, at every loop iteration
+        xenfree_ring = [0] * CHECK_PERIOD
+
+        while True:
+            with self.lock:
+                with self._cond:
+                    pending = list(self._pending)
+                if not pending:
+                    return
+                self.log.debug(
+                    "niter={:d} pending={!r}".format(
+                        niter, [req.mem_size for req in pending]
+                    )
+                )
+                state.refresh_mem_actual()
+                xenfree = state.get_free_xen_mem()
+                self.log.info("xenfree={!r}".format(xenfree))
+
+                granted = 0
+                for req in pending:
+                    if xenfree < req.mem_size + XEN_FREE_MEM_MIN:
+                        break
+                    xenfree -= req.mem_size
+                    state.reserved_mem += req.mem_size
+                    granted_mem += req.mem_size
+                    granted += 1
+                if granted:
+                    state.inhibit_balloon_up()
+                    self._finish(granted, True)
+                    del pending[:granted]
+                    if not pending:
+                        continue
+
+                # fail the requests if over past CHECK_PERIOD_S seconds,
+                # we got less than CHECK_MB_S MB/s on average
+                ring_slot = niter % CHECK_PERIOD
+                if (
+                    niter >= CHECK_PERIOD
+                    and xenfree + granted_mem
+                    < xenfree_ring[ring_slot] + CHECK_DELTA
+                ):
+                    self._finish(len(pending), False)
+                    return
+                xenfree_ring[ring_slot] = xenfree + granted_mem
+                for domid, prev_mem in prev_mem_actual.items():
+                    dom = state.dom_dict.get(domid)
+                    if dom is not None and prev_mem == dom.mem_actual:
+                        # domain not responding to memset requests, remove
+                        # it from donors
+                        dom.no_progress = True
+                        self.log.info(
+                            "domain {} stuck at {}".format(
+                                domid, dom.mem_actual
+                            )
+                        )
+                mem_size = sum(req.mem_size for req in pending)
+                memset_reqs = qubes.qmemman.algo.balloon(
+                    mem_size + XEN_FREE_MEM_LEFT - xenfree, state.dom_dict
+                )
+                self.log.info("memset_reqs={!r}".format(memset_reqs))
+                if len(memset_reqs) == 0:
+                    self._finish(len(pending), False)
+                    return
+                prev_mem_actual = {}
+                for domid, memset in memset_reqs:
+                    state.mem_set(domid, memset)
+                    prev_mem_actual[domid] = state.dom_dict[domid].mem_actual
+            self.log.debug("sleeping for {} s".format(BALLOON_DELAY))
+            time.sleep(BALLOON_DELAY)
+            niter = niter + 1
+
+
+class Reservations:
+    """Memory reservations identified by client-chosen keys
+
+    A reservation is kept until released with :py:meth:`release`, regardless
+    of the connection it was requested over. If the client does not release
+    it within its timeout (for example because it was restarted), it is
+    released automatically.
+    """
+
+    def __init__(
+        self,
+        scheduler: BalloonScheduler,
+        release_callback: Optional[Callable[[], None]] = None,
+    ) -> None:
+        self.log = logging.getLogger("qmemman.reservations")
+        self.scheduler = scheduler
+        self.release_callback = release_callback
+        self._lock = threading.Lock()
+        #: key -> (mem_size, expiry timer), timer is None while still pending
+        self._reservations: dict[str, tuple[int, Optional[threading.Timer]]] = (
+            {}
+        )
+
+    def reserve(
+        self, key: str, mem_size: int, timeout: Optional[float] = None
+    ) -> bool:
+        """Reserve *mem_size* bytes under *key*, for at most *timeout*
+        seconds (:py:data:`RESERVATION_TIMEOUT` by default)
+
+        :return: :py:obj:`False` if the memory could not be freed, or *key*
+            is already used
+        """
+        if timeout is None:
+            timeout = RESERVATION_TIMEOUT
+        with self._lock:
+            if key in self._reservations:
+                self.log.warning("duplicate reservation %s", key)
+                return False
+            self._reservations[key] = (mem_size, None)
+        if not self.scheduler.request(mem_size):
+            with self._lock:
+                del self._reservations[key]
+            return False
+        timer = threading.Timer(timeout, self._expire, (key,))
+        timer.daemon = True
+        with self._lock:
+            self._reservations[key] = (mem_size, timer)
+        timer.start()
+        return True
+
+    def release(self, key: str) -> bool:
+        """Release reservation *key*
+
+        :return: :py:obj:`False` if there is no such (granted) reservation
+        """
+        with self._lock:
+            mem_size, timer = self._reservations.get(key, (0, None))
+            if timer is None:
+                return False
+            del self._reservations[key]
+        timer.cancel()
+        self.scheduler.release(mem_size)
+        if self.release_callback is not None:
+            self.release_callback()
+        return True
+
+    def _expire(self, key: str) -> None:
+        if self.release(key):
+            self.log.warning("reservation %s expired", key)
@@ -57,6 +57,12 @@ class SystemState:
         self.xc: xen.lowlevel.xc.xc = None
         self.xs: xen.lowlevel.xs.xs = None
         self.all_phys_mem: int = 0
+        #: memory granted to clients, not to be given to domains
+        self.reserved_mem: int = 0
+        #: set while ballooning for memory requests, inhibits balancing
+        self.balloon_in_progress: bool = False
+        #: memory to keep free when balancing, for expected requests
+        self.headroom_mem: int = 0
 
     def init(self) -> None:
         self.xc = xen.lowlevel.xc.xc()
@@ -114,10 +120,18 @@ class SystemState:
                     xen_free, assigned_but_unused, self.dom_dict
                 )
             )
-        return xen_free - assigned_but_unused
+        return xen_free - assigned_but_unused - self.reserved_mem
 
-    # Refresh information on memory assigned to all or specific domains
-    def refresh_mem_actual(self, domid_list: Optional[list] = None) -> None:
+    def refresh_mem_actual(
+        self, domid_list: Optional[list] = None, fresh: bool = False
+    ) -> None:
+        """Refresh information on memory assigned to all or specific domains
+
+        Memory limits are read from xenstore only for domains for which they
+        were invalidated (see :py:meth:`invalidate_mem_max`), unless *fresh*
+        is set.
+        """
+        stale = []
         for domain in self.xc.domain_getinfo():
             domid = str(domain["domid"])
             if domid in self.dom_dict:
@@ -131,11 +145,21 @@ class SystemState:
                     dom.mem_current,
                     dom.last_target,
                 )
+                if fresh or dom.mem_max_stale:
+                    stale.append(dom)
+        if stale:
+            self.refresh_mem_max(stale)
+
+    def refresh_mem_max(self, dom_list: list[DomainState]) -> None:
+        """Read memory limits of given domains, in one xenstore transaction"""
+        trans = self.xs.transaction_start()
+        try:
+            for dom in dom_list:
                 hotplug_max = self.xs.read(
-                    "", self.get_xs_path(domid, "hotplug-max")
+                    trans, self.get_xs_path(dom.domid, "hotplug-max")
                 )
                 static_max = self.xs.read(
-                    "", self.get_xs_path(domid, "static-max")
+                    trans, self.get_xs_path(dom.domid, "static-max")
                 )
                 if hotplug_max:
                     dom.mem_max = int(hotplug_max) * 1024
@@ -151,6 +175,17 @@ class SystemState:
                     # and this results in the memory never increasing in fact,
                     # the only possible case of nonexisting memory/static-max
                     # is dom0, see #307
+                dom.mem_max_stale = False
+        finally:
+            # nothing was written, abort is enough
+            self.xs.transaction_end(trans, True)
+
+    def invalidate_mem_max(self, domid: str) -> None:
+        """Memory limits of *domid* changed in xenstore, re-read them on next
+        :py:meth:`refresh_mem_actual`"""
+        dom = self.dom_dict.get(domid)
+        if dom is not None:
+            dom.mem_max_stale = True
 
     def clear_outdated_error_markers(self) -> None:
         # Clear outdated errors.
@@ -214,60 +249,6 @@ class SystemState:
                 )
                 self.mem_set(domid, dom.mem_actual)
 
-    # Perform memory ballooning, across all domains, to add "mem_size" to Xen
-    # free memory
-    def do_balloon(self, mem_size) -> bool:
-        self.log.info("do_balloon(mem_size={!r})".format(mem_size))
-        niter = 0
-        prev_mem_actual: dict[str, Optional[int]] = {}
-
-        for dom in self.dom_dict.values():
-            dom.no_progress = False
-
-        #: helper array for holding free memory size, CHECK_PERIOD_S seconds
-        #: ago, at every loop iteration
-        xenfree_ring = [0] * CHECK_PERIOD
-
-        while True:
-            self.log.debug("niter={:d}".format(niter))
-            self.refresh_mem_actual()
-            xenfree = self.get_free_xen_mem()
-            self.log.info("xenfree={!r}".format(xenfree))
-            if xenfree >= mem_size + XEN_FREE_MEM_MIN:
-                self.inhibit_balloon_up()
-                return True
-            # fail the request if over past CHECK_PERIOD_S seconds,
-            # we got less than CHECK_MB_S MB/s on average
-            ring_slot = niter % CHECK_PERIOD
-            if (
-                niter >= CHECK_PERIOD
-                and xenfree < xenfree_ring[ring_slot] + CHECK_DELTA
-            ):
-                return False
-            xenfree_ring[ring_slot] = xenfree
-            for domid, prev_mem in prev_mem_actual.items():
-                dom = self.dom_dict[domid]
-                if prev_mem == dom.mem_actual:
-                    # domain not responding to memset requests, remove it
-                    #  from donors
-                    dom.no_progress = True
-                    self.log.info(
-                        "domain {} stuck at {}".format(domid, dom.mem_actual)
-                    )
-            memset_reqs = qubes.qmemman.algo.balloon(
-                mem_size + XEN_FREE_MEM_LEFT - xenfree, self.dom_dict
-            )
-            self.log.info("memset_reqs={!r}".format(memset_reqs))
-            if len(memset_reqs) == 0:
-                return False
-            prev_mem_actual = {}
-            for domid, memset in memset_reqs:
-                self.mem_set(domid, memset)
-                prev_mem_actual[domid] = self.dom_dict[domid].mem_actual
-            self.log.debug("sleeping for {} s".format(BALLOON_DELAY))
-            time.sleep(BALLOON_DELAY)
-            niter = niter + 1
-
     def do_balloon_dom(self, dom_memset: dict) -> bool:
         self.log.info("do_balloon_dom(dom_memset={!r})".format(dom_memset))
         niter = 0
@@ -325,7 +306,8 @@ class SystemState:
 
         actual_mem_ring: dict[str, list[int]] = {}
         while True:
-            self.refresh_mem_actual(domid_list)
+            # limits may have just been changed by the requester
+            self.refresh_mem_actual(domid_list, fresh=niter == 0)
             for domid, dom in dom_dict.items():
                 if domid in succeeded:
                     continue
@@ -477,19 +459,39 @@ class SystemState:
                     )
                     dom.slow_memset_react = True
 
+    def get_headroom(self, xenfree: int) -> int:
+        """Part of :py:attr:`headroom_mem` which can be kept free without
+        leaving any domain below its preferred memory"""
+        if not self.headroom_mem:
+            return 0
+        mem_dict = qubes.qmemman.algo.mem_info(
+            xenfree - XEN_FREE_MEM_LEFT, self.dom_dict
+        )
+        return max(0, min(self.headroom_mem, mem_dict["total_available_mem"]))
+
     def do_balance(self) -> None:
         self.log.debug("do_balance()")
         if os.path.isfile("/var/run/qubes/do-not-membalance"):
             self.log.debug("do-not-membalance file present, returning")
             return
+        if self.balloon_in_progress:
+            self.log.debug("ballooning in progress, returning")
+            return
+        if self.reserved_mem:
+            # memory granted to a domain being started is taken from Xen
+            # when the domain is created, so until the reservation is
+            # released it is not known whether free memory includes it
+            self.log.debug("memory reserved for domains, returning")
+            return
 
         self.refresh_mem_actual()
         self.clear_outdated_error_markers()
         xenfree = self.get_free_xen_mem()
+        headroom = self.get_headroom(xenfree)
         memset_reqs = qubes.qmemman.algo.balance(
-            xenfree - XEN_FREE_MEM_LEFT, self.dom_dict
+            xenfree - XEN_FREE_MEM_LEFT - headroom, self.dom_dict
         )
-        if not self.is_balance_req_significant(memset_reqs, xenfree):
+        if not self.is_balance_req_significant(memset_reqs, xenfree - headroom):
             return
 
         self.print_stats(xenfree, memset_reqs)
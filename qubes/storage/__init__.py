@@ -330,6 +330,48 @@ class Volume:
         """
         # do nothing by default (optional method)
 
+    async def export_changes(self, backup_id, base_tag):
+        """Returns a path to read the volume data from, together with
+        regions changed since the previous backup with the same *base_tag*.
+
+        Data at the returned path is the same as with :py:meth:`export`. The
+        pool may keep it as a base for the next incremental backup, tagged
+        with *backup_id* and *base_tag*, until :py:meth:`export_changes_end`
+        is called.
+
+        The default implementation does not track changes and always
+        exports full data.
+
+        This can be implemented as a coroutine.
+
+        :param str backup_id: ID of the backup in progress
+        :param str base_tag: tag of the series of incremental backups (for \
+            example of a backup profile), consisting of hex digits only; \
+            bases with different tags are independent
+        :return: tuple of the path, ID of the base backup and a list of \
+            (offset, size) regions changed since the base backup; the two \
+            latter are :py:obj:`None` if there is no usable base
+        """
+        # pylint: disable=unused-argument
+        path = await qubes.utils.coro_maybe(self.export())
+        return path, None, None
+
+    async def export_changes_end(self, path, success):
+        """Finish exporting data with :py:meth:`export_changes`.
+
+        This method is called after the whole backup finishes. If it was
+        successful, the exported data becomes the base for the next
+        incremental backup with the same tag, replacing the previous one.
+        Otherwise, the previous base is kept.
+
+        This can be implemented as a coroutine.
+
+        :param path: path returned by :py:meth:`export_changes`
+        :param success: True if the backup was successful
+        """
+        # pylint: disable=unused-argument
+        await qubes.utils.coro_maybe(self.export_end(path))
+
     async def import_data(self, size):
         """Returns a path to overwrite volume data.
 
@@ -19,21 +19,31 @@
 
 """Driver for storing vm images in a LVM thin pool"""
 
+import functools
 import logging
 import os
+import re
 import subprocess
 
 import time
 
 import asyncio
+from typing import Optional
 
 import qubes
 import qubes.exc
 import qubes.storage
 import qubes.utils
 import json
+import lxml.etree
 
 _sudo, _dd, _lvm = "sudo", "dd", "lvm"
+_dmsetup, _thin_delta = "dmsetup", "thin_delta"
+
+#: format of :py:attr:`qubes.backup.Backup.backup_id`
+_backup_id_re = re.compile(r"[0-9]{8}T[0-9]{6}-[0-9]+")
+#: format of :py:attr:`qubes.backup.Backup.base_tag`
+_base_tag_re = re.compile(r"[0-9a-f]+")
 
 
 class ThinPool(qubes.storage.Pool):
@@ -53,6 +63,9 @@ class ThinPool(qubes.storage.Pool):
         old revisions (in addition to the current one) should be stored
         "" (no suffix) - the most recent committed volume state; also volatile
         volume (snap_on_start=False, save_on_stop=False)
+        "-{base_tag}-{backup_id}-backup" - volume state saved by the last
+        backup, used as a base for the next incremental backup with the same
+        tag
 
     On VM startup, new volume is created, depending on volume type,
     according to the table below:
@@ -93,6 +106,13 @@ class ThinPool(qubes.storage.Pool):
 
         self._volume_objects_cache = {}
 
+        try:
+            start_cache_load()
+        except RuntimeError:
+            # no running event loop (like when loading qubes.xml), see
+            # qubes.tools.qubesd
+            pass
+
     def __repr__(self):
         return (
             "<{} at {:#x} name={!r} volume_group={!r} thin_pool={!r}>".format(
@@ -145,7 +165,10 @@ class ThinPool(qubes.storage.Pool):
         return volume
 
     async def setup(self):
-        await reset_cache_coro()
+        if size_cache_time:
+            await reset_cache_coro(self.volume_group)
+        else:
+            await ensure_cache_coro()
         cache_key = self.volume_group + "/" + self.thin_pool
         if cache_key not in size_cache:
             raise qubes.exc.StoragePoolException(
@@ -173,13 +196,18 @@ class ThinPool(qubes.storage.Pool):
 
     def list_volumes(self):
         """Return a list of volumes managed by this pool"""
+        ensure_cache()
         volumes = []
         for vid, vol_info in size_cache.items():
             if not vid.startswith(self.volume_group + "/"):
                 continue
             if vol_info["pool_lv"] != self.thin_pool:
                 continue
-            if vid.endswith("-snap") or vid.endswith("-import"):
+            if (
+                vid.endswith("-snap")
+                or vid.endswith("-import")
+                or vid.endswith("-backup")
+            ):
                 # implementation detail volume
                 continue
             if vid.endswith("-back"):
@@ -193,6 +221,7 @@ class ThinPool(qubes.storage.Pool):
 
     @property
     def size(self):
+        ensure_cache()
         try:
             return qubes.storage.lvm.size_cache[
                 self.volume_group + "/" + self.thin_pool
@@ -308,8 +337,12 @@ def init_cache(log=logging.getLogger("qubes.storage.lvm")):
     return _parse_lvm_cache(out)
 
 
-async def init_cache_coro(log=logging.getLogger("qubes.storage.lvm")):
+async def init_cache_coro(
+    log=logging.getLogger("qubes.storage.lvm"), volume_group=None
+):
     cmd = _init_cache_cmd
+    if volume_group is not None:
+        cmd = cmd + ["--", volume_group]
     environ = {"LC_ALL": "C.UTF-8", **os.environ}
     p = await asyncio.create_subprocess_exec(
         *cmd,
@@ -328,8 +361,76 @@ async def init_cache_coro(log=logging.getLogger("qubes.storage.lvm")):
     return _parse_lvm_cache(out)
 
 
-size_cache_time = 0
-size_cache = init_cache()
+#: LVM volumes info, indexed by "volume_group/name"; loaded on first use,
+#: see :py:func:`ensure_cache_coro`
+size_cache: dict[str, dict] = {}
+#: when *size_cache* was last loaded in full, 0 if not yet
+size_cache_time = 0.0
+
+_cache_init_task: Optional[asyncio.Task] = None
+
+
+def _cache_load_done(task):
+    if not task.cancelled() and task.exception() is not None:
+        logging.getLogger("qubes.storage.lvm").warning(
+            "Failed to load LVM cache: %s", str(task.exception())
+        )
+
+
+def start_cache_load(loop=None):
+    """Start loading size cache in the background, if it isn't loaded (or
+    being loaded) yet, so that the first synchronous accessor doesn't need
+    to wait for :program:`lvs`.
+
+    :param loop: event loop to run the load in, the running one by default
+    """
+    # pylint: disable=global-statement
+    global _cache_init_task
+    if size_cache_time:
+        return
+    if loop is None:
+        loop = asyncio.get_running_loop()
+    if (
+        _cache_init_task is not None
+        and not _cache_init_task.done()
+        and _cache_init_task.get_loop() is loop
+    ):
+        return
+    _cache_init_task = loop.create_task(reset_cache_coro())
+    _cache_init_task.add_done_callback(_cache_load_done)
+
+
+async def ensure_cache_coro():
+    """Load size cache, if it wasn't loaded yet. Concurrent calls share
+    a single load."""
+    if size_cache_time:
+        return
+    start_cache_load()
+    assert _cache_init_task is not None
+    # do not abort the load for other callers if this one is cancelled
+    await asyncio.shield(_cache_init_task)
+
+
+def ensure_cache():
+    """Load size cache, if it wasn't loaded yet
+
+    This blocks on :program:`lvs`, so coroutines should call
+    :py:func:`ensure_cache_coro` first. qubesd loads the cache in the
+    background on startup (see :py:func:`start_cache_load`).
+    """
+    if not size_cache_time:
+        reset_cache()
+
+
+def _cache_loaded(method):
+    """Decorator loading size cache before running given coroutine"""
+
+    @functools.wraps(method)
+    async def wrapper(*args, **kwargs):
+        await ensure_cache_coro()
+        return await method(*args, **kwargs)
+
+    return wrapper
 
 
 def _revision_sort_key(revision):
@@ -367,6 +468,7 @@ class ThinVolume(qubes.storage.Volume):
 
     @property
     def _vid_current(self):
+        ensure_cache()
         if self.vid in size_cache:
             return self.vid
         vol_revisions = self.revisions
@@ -380,6 +482,7 @@ class ThinVolume(qubes.storage.Volume):
 
     @property
     def revisions(self):
+        ensure_cache()
         name_prefix = self.vid + "-"
         revisions = {}
         for revision_vid in size_cache:
@@ -497,11 +600,9 @@ class ThinVolume(qubes.storage.Volume):
                 "{}-{}-back".format(self.vid, int(time.time())),
             ]
             await qubes_lvm_coro(cmd, self.log)
-            await reset_cache_coro()
 
         cmd = ["clone" if keep else "rename", vid_to_commit, self.vid]
         await qubes_lvm_coro(cmd, self.log)
-        await reset_cache_coro()
         # make sure the one we've committed right now is properly
         # detected as the current one - before removing anything
         assert self._vid_current == self.vid
@@ -511,6 +612,7 @@ class ThinVolume(qubes.storage.Volume):
         return True
 
     @qubes.storage.Volume.locked
+    @_cache_loaded
     async def create(self):
         assert self.vid
         assert self.size
@@ -526,10 +628,10 @@ class ThinVolume(qubes.storage.Volume):
                     str(self.size),
                 ]
             await qubes_lvm_coro(cmd, self.log)
-            await reset_cache_coro()
         return self
 
     @qubes.storage.Volume.locked
+    @_cache_loaded
     async def remove(self):
         assert self.vid
         try:
@@ -547,14 +649,16 @@ class ThinVolume(qubes.storage.Volume):
             pass
 
         await self._remove_revisions(self.revisions.keys())
+        for vid in self._vids_backup_bases():
+            await self._remove_if_exists(vid)
         if not os.path.exists(self.path):
             return
         cmd = ["remove", self._vid_current]
         await qubes_lvm_coro(cmd, self.log)
-        await reset_cache_coro()
         # pylint: disable=protected-access
         self.pool._volume_objects_cache.pop(self.vid, None)
 
+    @_cache_loaded
     async def export(self):
         """Returns an object that can be `open()`."""
         # make sure the device node is available
@@ -562,7 +666,94 @@ class ThinVolume(qubes.storage.Volume):
         await qubes_lvm_coro(cmd, self.log)
         return self.path
 
+    def _vid_backup_base(self, base_tag, backup_id):
+        return "{}-{}-{}-backup".format(self.vid, base_tag, backup_id)
+
+    def _vids_backup_bases(self):
+        """Volumes kept as bases for incremental backups, of all tags"""
+        ensure_cache()
+        name_prefix = self.vid + "-"
+        vids = []
+        for vid in size_cache:
+            if not vid.startswith(name_prefix) or not vid.endswith("-backup"):
+                continue
+            base_tag, _, backup_id = vid[
+                len(name_prefix) : -len("-backup")
+            ].partition("-")
+            if _base_tag_re.fullmatch(base_tag) and _backup_id_re.fullmatch(
+                backup_id
+            ):
+                vids.append(vid)
+        return vids
+
+    def _backup_bases(self, base_tag):
+        """IDs of backups with a base of *base_tag* kept for an incremental
+        backup"""
+        name_prefix = "{}-{}-".format(self.vid, base_tag)
+        return sorted(
+            vid[len(name_prefix) : -len("-backup")]
+            for vid in self._vids_backup_bases()
+            if vid.startswith(name_prefix)
+        )
+
+    @qubes.storage.Volume.locked
+    @_cache_loaded
+    async def export_changes(self, backup_id, base_tag):
+        """Snapshot the volume as a base for the next incremental backup,
+        and compare it with the previous base with the same tag using
+        :program:`thin_delta`.
+        """
+        if (
+            not self.save_on_stop
+            or not _backup_id_re.fullmatch(backup_id)
+            or not _base_tag_re.fullmatch(base_tag)
+        ):
+            return await super().export_changes(backup_id, base_tag)
+        bases = self._backup_bases(base_tag)
+        vid = self._vid_backup_base(base_tag, backup_id)
+        cmd = ["clone", self._vid_current, vid]
+        await qubes_lvm_coro(cmd, self.log)
+        path = "/dev/" + vid
+        if not bases:
+            return path, None, None
+        try:
+            extents = await thin_delta_coro(
+                self.pool._pool_id,  # pylint: disable=protected-access
+                self._vid_backup_base(base_tag, bases[-1]),
+                vid,
+                size_cache[vid]["size"],
+                self.log,
+            )
+        except qubes.exc.StoragePoolException as e:
+            self.log.warning(
+                "Failed to compare %s with previous backup, exporting full "
+                "data: %s",
+                self.vid,
+                e,
+            )
+            return path, None, None
+        return path, bases[-1], extents
+
     @qubes.storage.Volume.locked
+    @_cache_loaded
+    async def export_changes_end(self, path, success):
+        vid = path[len("/dev/") :]
+        if not vid.endswith("-backup"):
+            return await super().export_changes_end(path, success)
+        if not success:
+            await self._remove_if_exists(vid)
+        else:
+            # keep bases of other tags, they are used by other backup profiles
+            base_tag = vid[len(self.vid + "-") :].partition("-")[0]
+            for backup_id in self._backup_bases(base_tag):
+                if self._vid_backup_base(base_tag, backup_id) != vid:
+                    await self._remove_if_exists(
+                        self._vid_backup_base(base_tag, backup_id)
+                    )
+        return None
+
+    @qubes.storage.Volume.locked
+    @_cache_loaded
     async def import_volume(self, src_volume):
         if not src_volume.save_on_stop:
             return self
@@ -582,7 +773,6 @@ class ThinVolume(qubes.storage.Volume):
         ):  # NOQA
             # pylint: disable=protected-access
             await self._commit(src_volume._vid_current, keep=True)
-            await reset_cache_coro()
         else:
             cmd = [
                 "create",
@@ -591,7 +781,6 @@ class ThinVolume(qubes.storage.Volume):
                 str(src_volume.size),
             ]
             await qubes_lvm_coro(cmd, self.log)
-            await reset_cache_coro()
             src_path = await qubes.utils.coro_maybe(src_volume.export())
             try:
                 cmd = [
@@ -620,11 +809,11 @@ class ThinVolume(qubes.storage.Volume):
                     )
                 )
             await self._commit(self._vid_import)
-            await reset_cache_coro()
 
         return self
 
     @qubes.storage.Volume.locked
+    @_cache_loaded
     async def import_data(self, size):
         """Returns an object that can be `open()`."""
         if self.is_dirty():
@@ -641,11 +830,11 @@ class ThinVolume(qubes.storage.Volume):
             str(size),
         ]
         await qubes_lvm_coro(cmd, self.log)
-        await reset_cache_coro()
         devpath = "/dev/" + self._vid_import
         return devpath
 
     @qubes.storage.Volume.locked
+    @_cache_loaded
     async def import_data_end(self, success):
         """Either commit imported data, or discard temporary volume"""
         if not os.path.exists("/dev/" + self._vid_import):
@@ -654,13 +843,12 @@ class ThinVolume(qubes.storage.Volume):
             )
         if success:
             await self._commit(self._vid_import)
-            await reset_cache_coro()
         else:
             cmd = ["remove", self._vid_import]
             await qubes_lvm_coro(cmd, self.log)
-            await reset_cache_coro()
 
     def abort_if_import_in_progress(self):
+        ensure_cache()
         try:
             if self._vid_import in size_cache:
                 raise qubes.exc.StoragePoolException(
@@ -671,6 +859,7 @@ class ThinVolume(qubes.storage.Volume):
             pass
 
     def is_dirty(self):
+        ensure_cache()
         if self.save_on_stop:
             return self._vid_snap in size_cache
         return False
@@ -678,6 +867,7 @@ class ThinVolume(qubes.storage.Volume):
     def is_outdated(self):
         if not self.snap_on_start:
             return False
+        ensure_cache()
         if self._vid_snap not in size_cache:
             return False
         # pylint: disable=protected-access
@@ -687,6 +877,7 @@ class ThinVolume(qubes.storage.Volume):
         )
 
     @qubes.storage.Volume.locked
+    @_cache_loaded
     async def revert(self, revision=None):
         if self.is_dirty():
             raise qubes.exc.StoragePoolException(
@@ -707,10 +898,10 @@ class ThinVolume(qubes.storage.Volume):
             await qubes_lvm_coro(cmd, self.log)
         cmd = ["clone", self.vid + "-" + revision, self.vid]
         await qubes_lvm_coro(cmd, self.log)
-        await reset_cache_coro()
         return self
 
     @qubes.storage.Volume.locked
+    @_cache_loaded
     async def resize(self, size):
         """Expands volume, throws
         :py:class:`qubst.storage.qubes.storage.StoragePoolException` if
@@ -736,7 +927,6 @@ class ThinVolume(qubes.storage.Volume):
             await qubes_lvm_coro(cmd, self.log)
 
         self._size = size
-        await reset_cache_coro()
 
     async def _snapshot(self):
         try:
@@ -770,40 +960,34 @@ class ThinVolume(qubes.storage.Volume):
         return True
 
     @qubes.storage.Volume.locked
+    @_cache_loaded
     async def start(self):
         self.abort_if_import_in_progress()
-        try:
-            if self.snap_on_start or self.save_on_stop:
-                if not self.save_on_stop or not self.is_dirty():
-                    if self.snapshots_disabled and self.revisions:
-                        await self._remove_revisions(self.revisions)
-                    if not self.snapshots_disabled:
-                        await self._snapshot()
-                else:
-                    await self._activate()
+        if self.snap_on_start or self.save_on_stop:
+            if not self.save_on_stop or not self.is_dirty():
+                if self.snapshots_disabled and self.revisions:
+                    await self._remove_revisions(self.revisions)
+                if not self.snapshots_disabled:
+                    await self._snapshot()
             else:
-                await self._reset()
-        finally:
-            await reset_cache_coro()
+                await self._activate()
+        else:
+            await self._reset()
         return self
 
     @qubes.storage.Volume.locked
+    @_cache_loaded
     async def stop(self):
-        # assume something was changed in case of exception too
-        changed = True
-        try:
-            if self.save_on_stop:
-                if not self.snapshots_disabled:
-                    changed = await self._commit()
-            elif self.snap_on_start:
-                changed = await self._remove_if_exists(self._vid_snap)
-            else:
-                changed = await self._remove_if_exists(self.vid)
-        finally:
-            if changed:
-                await reset_cache_coro()
+        if self.save_on_stop:
+            if not self.snapshots_disabled:
+                await self._commit()
+        elif self.snap_on_start:
+            await self._remove_if_exists(self._vid_snap)
+        else:
+            await self._remove_if_exists(self.vid)
         return self
 
+    @_cache_loaded
     async def verify(self):
         """Verifies the volume."""
         if not self.save_on_stop and not self.snap_on_start:
@@ -857,6 +1041,7 @@ class ThinVolume(qubes.storage.Volume):
 
 def pool_exists(pool_id):
     """Return true if pool exists"""
+    ensure_cache()
     try:
         vol_info = size_cache[pool_id]
         return vol_info["attr"][0] == "t"
@@ -872,6 +1057,20 @@ def _get_lvm_cmdline(cmd):
     :param cmd: array of str, where cmd[0] is action and the rest are arguments
     :return array of str appropriate for subprocess.Popen
     """
+    return _get_lvm_shell_cmdline() + _get_lvm_args(cmd)
+
+
+def _get_lvm_shell_cmdline():
+    """Command line of :program:`lvm` itself (without any command, it reads
+    commands from stdin)"""
+    if os.getuid() != 0:
+        return [_sudo, _lvm]
+    return [_lvm]
+
+
+def _get_lvm_args(cmd):
+    """Build :program:`lvm` command (without :program:`lvm` itself) for
+    *cmd*, see :py:func:`_get_lvm_cmdline`"""
     action = cmd[0]
     if action == "remove":
         assert len(cmd) == 2, "wrong number of arguments for remove"
@@ -913,25 +1112,24 @@ def _get_lvm_cmdline(cmd):
         lvm_cmd = ["lvrename", "--", cmd[1], cmd[2]]
     else:
         raise NotImplementedError("unsupported action: " + action)
-    if os.getuid() != 0:
-        cmd = [_sudo, _lvm] + lvm_cmd
-    else:
-        cmd = [_lvm] + lvm_cmd
-
-    return cmd
+    return lvm_cmd
 
 
-def _process_lvm_output(returncode, stdout, stderr, log):
-    """Process output of LVM, determine if the call was successful and
-    possibly log warnings."""
+def _filter_lvm_stderr(stderr):
     # Filter out warning about intended over-provisioning.
     # Upstream discussion about missing option to silence it:
     # https://bugzilla.redhat.com/1347008
-    err = "\n".join(
+    return "\n".join(
         line
         for line in stderr.decode().splitlines()
         if "exceeds the size of thin pool" not in line
     )
+
+
+def _process_lvm_output(returncode, stdout, stderr, log):
+    """Process output of LVM, determine if the call was successful and
+    possibly log warnings."""
+    err = _filter_lvm_stderr(stderr)
     if stdout:
         log.debug(stdout)
     if returncode == 0 and err:
@@ -943,6 +1141,177 @@ def _process_lvm_output(returncode, stdout, stderr, log):
     return True
 
 
+#: options added to each command run in :program:`lvm` shell, to get
+#: its result in JSON
+_lvm_shell_options = [
+    "--reportformat=json",
+    "--config",
+    "'log/report_command_log=1 log/command_log_selection=\"all\"'",
+]
+#: LVM commands waiting to be run, with futures for their results
+_lvm_queue: list[tuple[list[str], asyncio.Future]] = []
+_lvm_queue_task: Optional[asyncio.Task] = None
+
+
+async def _queue_lvm_command(cmd, log):
+    """Run LVM operation *cmd* (see :py:func:`_get_lvm_cmdline`)
+
+    Commands queued while another :program:`lvm` call is in progress (for
+    example by other volumes of the same qube) are then run together, in
+    a single :program:`lvm` shell process.
+    """
+    # pylint: disable=global-statement
+    global _lvm_queue_task
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    _lvm_queue.append((cmd, future))
+    if (
+        _lvm_queue_task is None
+        or _lvm_queue_task.done()
+        or _lvm_queue_task.get_loop() is not loop
+    ):
+        # drop leftovers of a previous event loop, if any
+        _lvm_queue[:] = [
+            (cmd, future)
+            for cmd, future in _lvm_queue
+            if future.get_loop() is loop
+        ]
+        _lvm_queue_task = loop.create_task(_run_lvm_queue(log))
+    return await future
+
+
+async def _run_lvm_queue(log):
+    # let other coroutines started at the same time queue their commands
+    await asyncio.sleep(0)
+    while _lvm_queue:
+        batch = [
+            (cmd, future) for cmd, future in _lvm_queue if not future.done()
+        ]
+        _lvm_queue.clear()
+        if not batch:
+            continue
+        try:
+            if len(batch) == 1:
+                results = [await _run_lvm_command(batch[0][0], log)]
+            else:
+                results = await _run_lvm_shell([cmd for cmd, _ in batch], log)
+        except Exception as e:  # pylint: disable=broad-except
+            results = [e] * len(batch)
+        except BaseException:
+            for _, future in batch:
+                future.cancel()
+            raise
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if result is None:
+                future.set_result(True)
+            else:
+                future.set_exception(result)
+
+
+async def _run_lvm_command(cmd, log):
+    """Run single LVM operation, return exception if it failed"""
+    environ = {"LC_ALL": "C.UTF-8", **os.environ}
+    cmdline = _get_lvm_cmdline(cmd)
+    log.debug("Invoked with arguments %r", cmdline)
+    p = await asyncio.create_subprocess_exec(
+        *cmdline,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        close_fds=True,
+        env=environ
+    )
+    out, err = await p.communicate()
+    try:
+        _process_lvm_output(p.returncode, out, err, log)
+    except qubes.exc.StoragePoolException as e:
+        return e
+    return None
+
+
+async def _run_lvm_shell(cmds, log):
+    """Run multiple LVM operations in one :program:`lvm` shell, return list
+    of exceptions (or :py:obj:`None` for successful ones)"""
+    environ = {"LC_ALL": "C.UTF-8", **os.environ}
+    lines = []
+    for cmd in cmds:
+        args = _get_lvm_args(cmd)
+        assert not any(
+            c.isspace() or c in "'\"#" for arg in args for c in arg
+        ), "unsupported characters in lvm arguments"
+        lines.append(" ".join(args[:1] + _lvm_shell_options + args[1:]))
+    log.debug("Invoked lvm shell with commands %r", lines)
+    p = await asyncio.create_subprocess_exec(
+        *_get_lvm_shell_cmdline(),
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        close_fds=True,
+        env=environ
+    )
+    out, err = await p.communicate("\n".join(lines + ["exit", ""]).encode())
+    err = _filter_lvm_stderr(err)
+    reports = _parse_lvm_shell_output(out)
+    if not reports:
+        # no report, can't tell which command failed
+        if p.returncode == 0 and not err:
+            return [None] * len(cmds)
+        exc = qubes.exc.StoragePoolException(
+            err.replace("%", "%%") or "LVM commands failed"
+        )
+        return [exc] * len(cmds)
+    if err:
+        log.warning(err)
+    results = []
+    for i in range(len(cmds)):
+        if i < len(reports):
+            error = _lvm_report_error(reports[i])
+        else:
+            error = "LVM command was not run"
+        if error is None:
+            results.append(None)
+        else:
+            results.append(
+                qubes.exc.StoragePoolException(error.replace("%", "%%"))
+            )
+    return results
+
+
+def _parse_lvm_shell_output(stdout):
+    """Extract JSON reports of consecutive commands from :program:`lvm`
+    shell output"""
+    decoder = json.JSONDecoder()
+    text = stdout.decode(errors="replace")
+    reports = []
+    pos = text.find("{")
+    while pos != -1:
+        try:
+            report, end = decoder.raw_decode(text, pos)
+        except ValueError:
+            break
+        if isinstance(report, dict):
+            reports.append(report)
+        pos = text.find("{", end)
+    return reports
+
+
+def _lvm_report_error(report):
+    """Return error message from command log in :program:`lvm` JSON report,
+    or :py:obj:`None` if the command was successful"""
+    entries = report.get("log", [])
+    status = [entry for entry in entries if entry.get("log_type") == "status"]
+    # 1 is ECMD_PROCESSED
+    if status and str(status[-1].get("log_ret_code")) == "1":
+        return None
+    errors = [
+        entry["log_message"]
+        for entry in entries
+        if entry.get("log_type") == "error" and entry.get("log_message")
+    ]
+    return "\n".join(errors) or "LVM command failed"
+
+
 async def qubes_lvm_coro(cmd, log=logging.getLogger("qubes.storage.lvm")):
     """Call :program:`lvm` to execute an LVM operation"""
     environ = {"LC_ALL": "C.UTF-8", **os.environ}
@@ -959,7 +1328,23 @@ async def qubes_lvm_coro(cmd, log=logging.getLogger("qubes.storage.lvm")):
             env=environ
         )
         _, _ = await p.communicate()
-    cmd = _get_lvm_cmdline(cmd)
+    volume_group = cmd[1].removeprefix("/dev/").split("/")[0]
+    try:
+        await _queue_lvm_command(cmd, log)
+    except qubes.exc.StoragePoolException:
+        # the operation may have been done partially
+        await reset_cache_coro(volume_group)
+        raise
+    _update_cache(cmd)
+    schedule_cache_reconcile(volume_group, log)
+    return True
+
+
+async def _run_coro(cmd, log):
+    """Run a command (as root) and return its output"""
+    if os.getuid() != 0:
+        cmd = [_sudo] + cmd
+    environ = {"LC_ALL": "C.UTF-8", **os.environ}
     log.debug("Invoked with arguments %r", cmd)
     p = await asyncio.create_subprocess_exec(
         *cmd,
@@ -969,7 +1354,75 @@ async def qubes_lvm_coro(cmd, log=logging.getLogger("qubes.storage.lvm")):
         env=environ
     )
     out, err = await p.communicate()
-    return _process_lvm_output(p.returncode, out, err, log)
+    if p.returncode != 0:
+        raise qubes.exc.StoragePoolException(
+            "{} failed: {}".format(cmd[0], err.decode(errors="replace"))
+        )
+    return out
+
+
+def _dm_name(vid):
+    """Device-mapper name of LVM volume *vid*"""
+    return vid.replace("-", "--").replace("/", "-")
+
+
+def _parse_thin_delta(thin_delta_output, size):
+    """Parse :program:`thin_delta` XML output into a list of (offset, size)
+    regions, limited to *size* bytes.
+    """
+    superblock = lxml.etree.fromstring(thin_delta_output)
+    block_size = int(superblock.get("data_block_size")) * 512
+    changed = []
+    for entry in superblock.iterfind("diff/*"):
+        if entry.tag == "same":
+            continue
+        start = int(entry.get("begin")) * block_size
+        end = min(size, start + int(entry.get("length")) * block_size)
+        if start >= end:
+            continue
+        if changed and changed[-1][0] + changed[-1][1] == start:
+            changed[-1] = (changed[-1][0], end - changed[-1][0])
+        else:
+            changed.append((start, end - start))
+    return changed
+
+
+async def thin_delta_coro(pool_id, base_vid, vid, size, log):
+    """Return (offset, size) regions of thin volume *vid* different than
+    in *base_vid*, both in thin pool *pool_id*.
+
+    Uses :program:`thin_delta` on a snapshot of the pool metadata, so it
+    works on an active pool.
+    """
+    thin_ids = []
+    for thin_vid in (base_vid, vid):
+        out = await _run_coro(
+            [_lvm, "lvs", "--noheadings", "-o", "thin_id", "--", thin_vid],
+            log,
+        )
+        thin_ids.append(out.decode().strip())
+    tpool = _dm_name(pool_id) + "-tpool"
+    await _run_coro(
+        [_dmsetup, "message", tpool, "0", "reserve_metadata_snap"], log
+    )
+    try:
+        out = await _run_coro(
+            [
+                _thin_delta,
+                "--metadata-snap",
+                "--snap1",
+                thin_ids[0],
+                "--snap2",
+                thin_ids[1],
+                "/dev/mapper/" + _dm_name(pool_id + "_tmeta"),
+            ],
+            log,
+        )
+    finally:
+        await _run_coro(
+            [_dmsetup, "message", tpool, "0", "release_metadata_snap"], log
+        )
+    return _parse_thin_delta(out, size)
 
 
 def reset_cache():
@@ -977,12 +1430,159 @@ def reset_cache():
     qubes.storage.lvm.size_cache_time = time.monotonic()
 
 
-async def reset_cache_coro():
-    qubes.storage.lvm.size_cache = await init_cache_coro()
-    qubes.storage.lvm.size_cache_time = time.monotonic()
+#: volume group (or None for all) -> number of cache refreshes started
+_cache_refreshes: dict[Optional[str], int] = {}
+#: volume group (or None for all) -> lock serializing its cache refreshes
+_cache_locks: dict[Optional[str], asyncio.Lock] = {}
+_cache_locks_loop: Optional[asyncio.AbstractEventLoop] = None
+#: number of changes applied by :py:func:`_update_cache`, to detect
+#: :program:`lvs` output made stale by them
+_cache_changes = 0
+#: volume groups with a background refresh scheduled
+_cache_reconcile_scheduled: set[Optional[str]] = set()
+#: background refresh tasks, see :py:func:`schedule_cache_reconcile`
+_cache_reconcile_tasks: set[asyncio.Task] = set()
+#: how long to wait for more changes before a background refresh (seconds)
+_cache_reconcile_delay = 1
+
+
+async def reset_cache_coro(volume_group=None):
+    """Reload size cache from :program:`lvs`, only for *volume_group* if
+    given.
+
+    Concurrent calls are coalesced - if a refresh is already in progress,
+    wait for it and then share one that is started after this call.
+    """
+    # pylint: disable=global-statement
+    global _cache_locks_loop
+    loop = asyncio.get_running_loop()
+    if _cache_locks_loop is not loop:
+        # asyncio.Lock can't be shared between event loops
+        _cache_locks.clear()
+        _cache_locks_loop = loop
+    lock = _cache_locks.setdefault(volume_group, asyncio.Lock())
+    wanted = _cache_refreshes.get(volume_group, 0) + 1
+    async with lock:
+        started = _cache_refreshes.get(volume_group, 0)
+        if started >= wanted:
+            # other refresh started after this call and is finished already
+            return
+        _cache_refreshes[volume_group] = started + 1
+        try:
+            while True:
+                changes = _cache_changes
+                new_cache = await init_cache_coro(volume_group=volume_group)
+                if changes == _cache_changes:
+                    break
+                # some operation finished while lvs was running, it's not
+                # known if its result is included
+        except:
+            _cache_refreshes[volume_group] = started
+            raise
+        if volume_group is None:
+            qubes.storage.lvm.size_cache = new_cache
+            qubes.storage.lvm.size_cache_time = time.monotonic()
+        else:
+            prefix = volume_group + "/"
+            for vid in [vid for vid in size_cache if vid.startswith(prefix)]:
+                del size_cache[vid]
+            size_cache.update(new_cache)
+
+
+async def _reconcile_cache(volume_group, log):
+    try:
+        await asyncio.sleep(_cache_reconcile_delay)
+        _cache_reconcile_scheduled.discard(volume_group)
+        await reset_cache_coro(volume_group)
+    except qubes.exc.StoragePoolException as e:
+        log.warning("Failed to refresh LVM cache: %s", str(e))
+    finally:
+        _cache_reconcile_scheduled.discard(volume_group)
+
+
+def schedule_cache_reconcile(
+    volume_group=None, log=logging.getLogger("qubes.storage.lvm")
+):
+    """Refresh size cache of *volume_group* (or all) in the background
+
+    Volume operations update the cache directly (see
+    :py:func:`_update_cache`), this catches what they can't know, like space
+    usage. Multiple calls in a short time result in a single refresh.
+    """
+    if volume_group in _cache_reconcile_scheduled:
+        return
+    _cache_reconcile_scheduled.add(volume_group)
+    task = asyncio.ensure_future(_reconcile_cache(volume_group, log))
+    _cache_reconcile_tasks.add(task)
+    task.add_done_callback(_cache_reconcile_tasks.discard)
+
+
+def cancel_cache_reconcile():
+    """Cancel background refreshes scheduled by
+    :py:func:`schedule_cache_reconcile`, for example on shutdown"""
+    for task in list(_cache_reconcile_tasks):
+        task.cancel()
+    # tasks cancelled before they started do not clean up after themselves
+    _cache_reconcile_scheduled.clear()
 
 
 def refresh_cache():
-    """Reset size cache, if it's older than 30sec"""
+    """Reset size cache, if it's older than 30sec
+
+    When called from within an event loop, the refresh is done in the
+    background, so the current values are returned meanwhile.
+    """
+    ensure_cache()
     if size_cache_time + 30 < time.monotonic():
-        reset_cache()
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            reset_cache()
+        else:
+            schedule_cache_reconcile()
+
+
+def _update_cache(cmd):
+    """Update size cache after successful LVM operation *cmd* (as given to
+    :py:func:`qubes_lvm_coro`), instead of reloading it.
+
+    Values not known in advance (space usage) are approximated, and updated
+    on the next refresh.
+    """
+    # pylint: disable=global-statement
+    global _cache_changes
+    _cache_changes += 1
+    action = cmd[0]
+    if action == "remove":
+        size_cache.pop(cmd[1], None)
+    elif action == "rename":
+        if cmd[1] in size_cache:
+            size_cache[cmd[2]] = size_cache.pop(cmd[1])
+    elif action == "clone":
+        if cmd[1] in size_cache:
+            size_cache[cmd[2]] = {
+                **size_cache[cmd[1]],
+                "attr": "Vwi-a-tz--",
+                "origin": cmd[1].split("/")[-1],
+                "metadata_size": "",
+                "metadata_usage": None,
+            }
+    elif action == "create":
+        volume_group, pool_lv = cmd[1].split("/", 1)
+        size_cache[volume_group + "/" + cmd[2]] = {
+            "size": int(cmd[3]),
+            "usage": 0,
+            "pool_lv": pool_lv,
+            "attr": "Vwi-a-tz--",
+            "origin": "",
+            "metadata_size": "",
+            "metadata_usage": None,
+        }
+    elif action == "resize":
+        if cmd[1] in size_cache:
+            size_cache[cmd[1]]["size"] = int(cmd[2])
+    elif action == "activate":
+        vid = cmd[1].removeprefix("/dev/")
+        if vid in size_cache:
+            attr = size_cache[vid]["attr"]
+            size_cache[vid]["attr"] = attr[:4] + "a" + attr[5:]
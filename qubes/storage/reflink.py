@@ -23,6 +23,7 @@ but not required.
 """
 
 import asyncio
+import bisect
 import errno
 import fcntl
 import functools
@@ -30,6 +31,7 @@ import glob
 import logging
 import os
 import platform
+import struct
 import subprocess
 import tempfile
 from contextlib import contextmanager, suppress
@@ -49,6 +51,15 @@ FICLONE = {
     "ppc64le": 0x80049409,
 }[platform.machine()]
 
+FS_IOC_FIEMAP = 0xC020660B
+FIEMAP_FLAG_SYNC = 0x1
+FIEMAP_EXTENT_LAST = 0x1
+# physical location of extents with any of those flags cannot be compared:
+# UNKNOWN, DELALLOC, ENCODED, NOT_ALIGNED, DATA_INLINE, DATA_TAIL
+FIEMAP_EXTENT_UNCOMPARABLE = 0x2 | 0x4 | 0x8 | 0x100 | 0x200 | 0x400
+_FIEMAP_HEADER = struct.Struct("=QQIIII")
+_FIEMAP_EXTENT = struct.Struct("=QQQ16xI12x")
+
 
 def _async_thread(function):
     """Wrap a synchronous function in an async function that runs the
@@ -233,6 +244,8 @@ class ReflinkVolume(qubes.storage.Volume):
     def _remove_all_images(self):
         self._remove_incomplete_images()
         self._prune_revisions(keep=0)
+        for path in self._paths_backup_bases():
+            _remove_file(path)
         _remove_file(self._path_clean)
         _remove_file(self._path_precache)
         _remove_file(self._path_dirty)
@@ -364,6 +377,49 @@ class ReflinkVolume(qubes.storage.Volume):
             )
         return self._path_clean
 
+    @_async_thread
+    def export_changes(
+        self, backup_id, base_tag
+    ):  # pylint: disable=invalid-overridden-method
+        """Reflink the clean image as a base for the next incremental backup,
+        and compare its extents with the previous base with the same tag.
+        """
+        if not self.save_on_stop:
+            raise NotImplementedError(
+                f"Cannot export: {self.vid} is not save_on_stop"
+            )
+        bases = self._backup_bases(base_tag)
+        path = self._path_backup_base(base_tag, backup_id)
+        if not _reflink_file(self._path_clean, path):
+            # without reflinks, keeping a base would take a full copy
+            return self._path_clean, None, None
+        if not bases:
+            return path, None, None
+        try:
+            extents = _changed_extents(
+                self._path_backup_base(base_tag, bases[-1]), path
+            )
+        except OSError as ex:
+            if ex.errno not in (errno.EOPNOTSUPP, errno.ENOTTY):
+                raise
+            return path, None, None
+        return path, bases[-1], extents
+
+    @_async_thread
+    def export_changes_end(
+        self, path, success
+    ):  # pylint: disable=invalid-overridden-method
+        if path == self._path_clean:
+            return
+        if not success:
+            _remove_file(path)
+            return
+        # keep bases of other tags, they are used by other backup profiles
+        base_tag = path[len(self._path_clean + ".backup@") :].split("@")[0]
+        for backup_id in self._backup_bases(base_tag):
+            if self._path_backup_base(base_tag, backup_id) != path:
+                _remove_file(self._path_backup_base(base_tag, backup_id))
+
     @qubes.storage.Volume.locked
     @_async_thread
     def import_data(self, size):  # pylint: disable=invalid-overridden-method
@@ -408,6 +464,22 @@ class ReflinkVolume(qubes.storage.Volume):
                 timestamp = self.revisions[revision]
         return self._path_clean + "." + revision + "@" + timestamp + "Z"
 
+    def _path_backup_base(self, base_tag, backup_id):
+        return self._path_clean + ".backup@" + base_tag + "@" + backup_id
+
+    def _paths_backup_bases(self):
+        """Paths of bases kept for incremental backups, of all tags"""
+        prefix = self._path_clean + ".backup@"
+        paths = glob.iglob(glob.escape(prefix) + "*")
+        return [path for path in paths if "~" not in path]
+
+    def _backup_bases(self, base_tag):
+        """IDs of backups with a base of *base_tag* kept for an incremental
+        backup"""
+        prefix = self._path_clean + ".backup@" + base_tag + "@"
+        paths = glob.iglob(glob.escape(prefix) + "*")
+        return sorted(path[len(prefix) :] for path in paths if "~" not in path)
+
     @property
     def _next_revision(self):
         revisions = self.revisions.keys()
@@ -567,6 +639,101 @@ def _copy_file(src, dst, *, dst_size=None, copy_mtime=False):
     return reflinked
 
 
+def _reflink_file(src, dst):
+    """Reflink src to a new inode at dst. Return whether it was possible
+    (if not, dst is not created).
+    """
+    try:
+        with open(src, "rb") as src_fh, _replace_file(dst) as tmp_fh:
+            if not _attempt_ficlone(src_fh, tmp_fh):
+                raise OSError(errno.EOPNOTSUPP, "Reflink not supported")
+    except OSError as ex:
+        if ex.errno != errno.EOPNOTSUPP:
+            raise
+        return False
+    LOGGER.info("Reflinked file: %r -> %r", src, dst)
+    return True
+
+
+def _fiemap(path, count=512):
+    """Return list of (logical, physical, length, flags) extents of
+    a file.
+    """
+    extents = []
+    buf_size = _FIEMAP_HEADER.size + count * _FIEMAP_EXTENT.size
+    with open(path, "rb") as path_fh:
+        start = 0
+        while True:
+            buf = bytearray(buf_size)
+            _FIEMAP_HEADER.pack_into(
+                buf, 0, start, 2**64 - 1 - start, FIEMAP_FLAG_SYNC, 0, count, 0
+            )
+            fcntl.ioctl(path_fh.fileno(), FS_IOC_FIEMAP, buf)
+            mapped = _FIEMAP_HEADER.unpack_from(buf)[3]
+            if not mapped:
+                break
+            for i in range(mapped):
+                extents.append(
+                    _FIEMAP_EXTENT.unpack_from(
+                        buf, _FIEMAP_HEADER.size + i * _FIEMAP_EXTENT.size
+                    )
+                )
+            logical, _, length, flags = extents[-1]
+            if flags & FIEMAP_EXTENT_LAST:
+                break
+            start = logical + length
+    return extents
+
+
+def _changed_extents(base_path, path):
+    """Return (offset, size) regions of file at path with data different
+    than in file at base_path, which path was reflinked from (directly or
+    not).
+    """
+    return _diff_extents(
+        _fiemap(base_path), _fiemap(path), os.path.getsize(path)
+    )
+
+
+def _diff_extents(base_extents, extents, size):
+    """Compare extent lists as returned by :py:func:`_fiemap`. Regions
+    mapped to the same physical location in both, or to none, are
+    unchanged.
+    """
+
+    def lookup(extent_list, starts, offset):
+        idx = bisect.bisect_right(starts, offset) - 1
+        if idx < 0:
+            return None
+        logical, physical, length, flags = extent_list[idx]
+        if offset >= logical + length:
+            return None
+        if flags & FIEMAP_EXTENT_UNCOMPARABLE:
+            # never equal to anything
+            return object()
+        return physical + offset - logical
+
+    base_starts = [extent[0] for extent in base_extents]
+    starts = [extent[0] for extent in extents]
+    bounds = {0, size}
+    for logical, _, length, _ in base_extents + extents:
+        bounds.update(
+            bound for bound in (logical, logical + length) if bound < size
+        )
+    bounds = sorted(bounds)
+    changed = []
+    for start, end in zip(bounds, bounds[1:]):
+        if lookup(base_extents, base_starts, start) == lookup(
+            extents, starts, start
+        ):
+            continue
+        if changed and changed[-1][0] + changed[-1][1] == start:
+            changed[-1] = (changed[-1][0], end - changed[-1][0])
+        else:
+            changed.append((start, end - start))
+    return changed
+
+
 def is_supported(dst_dir, *, src_dir=None):
     """Return whether destination directory supports reflink copies
     from source directory. (A temporary file is created in each
@@ -1,3 +1,4 @@
+# pylint: disable=too-many-lines
 """
 Driver for storing qube images in ZFS pool volumes.
 """
@@ -7,6 +8,7 @@ import contextlib
 import dataclasses
 import logging
 import os
+import re
 import secrets
 import shlex
 import shutil
@@ -46,6 +48,10 @@ TMP = ".tmp"
 REVISION_PREFIX = "qubes"
 QUBES_POOL_FLAG = "org.qubes-os:part-of-qvm-pool"
 CLEAN_SNAPSHOT = "qubes-clean"
+# Prefix of bookmarks kept as bases for incremental backups.
+BACKUP_BASE_BOOKMARK = "qubes-backup"
+# Object holding the data of a zvol, see zvol.h.
+ZVOL_DATA_OBJECT = 1
 # Controls whether `qvm-pool remove` destroys a pool if
 # the pool is the root of a ZFS pool.  By default it
 # is false because the user may have created a Qubes
@@ -68,6 +74,16 @@ NO_AUTO_SNAPSHOT = {"com.sun:auto-snapshot": "false"}
 DEF_AUTO_SNAPSHOT: Dict[str, str] = {}
 
 _sudo, _dd, _zfs, _zpool, _ionice = "sudo", "dd", "zfs", "zpool", "ionice"
+_zstream = "zstream"
+
+#: format of :py:attr:`qubes.backup.Backup.backup_id`
+_backup_id_re = re.compile(r"[0-9]{8}T[0-9]{6}-[0-9]+")
+#: format of :py:attr:`qubes.backup.Backup.base_tag`
+_base_tag_re = re.compile(r"[0-9a-f]+")
+#: first line of a record in :program:`zstream dump -v` output
+_zstream_record_re = re.compile(r"(?P<type>[A-Z_]+) object = (?P<object>\d+)")
+#: fields of a record in :program:`zstream dump -v` output
+_zstream_field_re = re.compile(r"\b(offset|logical_size|length) = (-?\d+)")
 
 
 async def fail_unless_exists_async(path: str) -> None:
@@ -324,6 +340,127 @@ async def zfs_async(
     )
 
 
+def _parse_zstream_dump(
+    output: str,
+    size: int,
+) -> List[Tuple[int, int]]:
+    """
+    Parse the output of :program:`zstream dump -v` of an incremental
+    send stream of a volume into a sorted list of (offset, size) regions
+    written or freed by the stream, limited to `size` bytes.
+
+    >>> _parse_zstream_dump("FREE object = 1 offset = 0 length = 512", 1024)
+    [(0, 512)]
+    """
+    regions = []
+    record: Optional[Dict[str, int]] = None
+    for line in output.splitlines():
+        match = _zstream_record_re.match(line)
+        if match:
+            record = None
+            if match["type"] in (
+                "WRITE",
+                "WRITE_BYREF",
+                "WRITE_EMBEDDED",
+                "FREE",
+            ):
+                if int(match["object"]) == ZVOL_DATA_OBJECT:
+                    record = {}
+                    regions.append(record)
+        elif not line[:1].isspace():
+            # other records, like BEGIN, do not describe volume data
+            record = None
+        if record is not None:
+            record.update(
+                (key, int(value))
+                for key, value in _zstream_field_re.findall(line)
+            )
+    changed: List[Tuple[int, int]] = []
+    for start, length in sorted(
+        (record["offset"], record.get("logical_size", record.get("length", -1)))
+        for record in regions
+        if "offset" in record
+    ):
+        # FREE records up to the end of the volume have length -1
+        end = size if length < 0 else min(size, start + length)
+        if start >= end:
+            continue
+        if changed and changed[-1][0] + changed[-1][1] >= start:
+            last_start = changed[-1][0]
+            end = max(end, last_start + changed[-1][1])
+            changed[-1] = (last_start, end - last_start)
+        else:
+            changed.append((start, end - start))
+    return changed
+
+
+async def zfs_send_changes_async(
+    base: str,
+    snapshot: str,
+    size: int,
+    log: logging.Logger,
+) -> List[Tuple[int, int]]:
+    """
+    Return (offset, size) regions of volume `snapshot` different than
+    in `base`, a snapshot or bookmark of the same volume.
+
+    Generates an incremental stream with :program:`zfs send -i` and lists
+    the records in it with :program:`zstream dump`, without keeping the
+    data itself.
+
+    Raises a `qubes.storage.StoragePoolException` if either fails.
+    """
+    send_cmd, environ = _generate_zfs_command(("send", "-i", base, snapshot))
+    dump_cmd = [_zstream, "dump", "-v"]
+    read_fd, write_fd = os.pipe()
+    try:
+        with _enoent_is_spe():
+            send = await asyncio.create_subprocess_exec(
+                *send_cmd,
+                stdin=subprocess.DEVNULL,
+                stdout=write_fd,
+                stderr=subprocess.PIPE,
+                env=environ,
+                close_fds=True,
+            )
+        try:
+            with _enoent_is_spe():
+                dump = await asyncio.create_subprocess_exec(
+                    *dump_cmd,
+                    stdin=read_fd,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE,
+                    env=environ,
+                    close_fds=True,
+                )
+        except Exception:
+            send.kill()
+            await send.wait()
+            raise
+    finally:
+        os.close(read_fd)
+        os.close(write_fd)
+    (_, send_stderr), (dump_stdout, dump_stderr) = await asyncio.gather(
+        send.communicate(),
+        dump.communicate(),
+    )
+    _process_zfs_output(
+        send_cmd,
+        await send.wait(),
+        b"",
+        send_stderr,
+        log=log,
+    )
+    output = _process_zfs_output(
+        dump_cmd,
+        await dump.wait(),
+        dump_stdout,
+        dump_stderr,
+        log=log,
+    )
+    return _parse_zstream_dump(output, size)
+
+
 def _generate_zfs_command(
     cmd: Tuple[str, ...],
 ) -> Tuple[List[str], Dict[str, str]]:
@@ -1672,6 +1809,93 @@ class ZFSAccessor:
                 log=log,
             )
 
+    async def get_volume_bookmarks_async(
+        self,
+        volume: Volume,
+        log: logging.Logger,
+    ) -> Dict[str, str]:
+        """
+        Get all bookmarks of the volume, as a dictionary of bookmark
+        name (without the volume name) to the GUID of the snapshot
+        it was made from.
+
+        The volume must exist.
+
+        This property is not cached, bookmarks are only used by
+        incremental backups.
+        """
+        assert dataset_in_root(volume, self.root)
+        lines = [
+            s.split("\t")
+            for s in (
+                await zfs_async(
+                    "list",
+                    "-Hp",
+                    "-o",
+                    "name,guid",
+                    "-t",
+                    "bookmark",
+                    volume,
+                    log=log,
+                )
+            ).splitlines()
+            if s
+        ]
+        return {s.split("#")[1]: g for s, g in lines}
+
+    async def bookmark_snapshot_async(
+        self,
+        vsnapshot: VolumeSnapshot,
+        bookmark: str,
+        log: logging.Logger,
+    ) -> None:
+        """
+        Bookmark a snapshot, so it can be used as the source of an
+        incremental send after the snapshot itself is destroyed.
+
+        The snapshot must exist.
+        """
+        assert dataset_in_root(vsnapshot.volume, self.root)
+        await zfs_async(
+            "bookmark",
+            vsnapshot,
+            "%s#%s" % (vsnapshot.volume, bookmark),
+            log=log,
+        )
+
+    async def remove_bookmark_async(
+        self,
+        volume: Volume,
+        bookmark: str,
+        log: logging.Logger,
+    ) -> None:
+        """
+        Remove a bookmark of the volume.
+        """
+        assert dataset_in_root(volume, self.root)
+        await zfs_async("destroy", "%s#%s" % (volume, bookmark), log=log)
+
+    async def get_changes_since_bookmark_async(
+        self,
+        bookmark: str,
+        vsnapshot: VolumeSnapshot,
+        log: logging.Logger,
+    ) -> List[Tuple[int, int]]:
+        """
+        Get (offset, size) regions of the snapshot different than in
+        the bookmark of the same volume.
+
+        Both must exist, and the bookmark must be older than the snapshot.
+        """
+        assert dataset_in_root(vsnapshot.volume, self.root)
+        size = int(await self._get_prop_async(vsnapshot, "volsize", log=log))
+        return await zfs_send_changes_async(
+            "%s#%s" % (vsnapshot.volume, bookmark),
+            vsnapshot,
+            size,
+            log=log,
+        )
+
     def get_volume_usage(
         self,
         volume: Volume,
@@ -2505,12 +2729,23 @@ class ZFSVolume(qubes.storage.Volume):
         which time the exported volume will be destroyed.
         """
         self.log.debug("Start of export of %s", self.volume)
+        path, _ = await self._export(get_random_string(8))
+        return path
+
+    async def _export(self, suffix: str) -> Tuple[str, VolumeSnapshot]:
+        """
+        Clones the latest clean state of the volume to the exported
+        volume named with `suffix`.
+
+        Returns the path to the exported volume, and the snapshot it
+        was cloned from.
+        """
         if not self.save_on_stop:
             raise NotImplementedError(
                 f"Cannot export {self.vid} — volumes where save_on_stop=False"
                 " do not feature snapshots to export from"
             )
-        exported = self.exported_volume_name(get_random_string(8))
+        exported = self.exported_volume_name(suffix)
         dest_dset = Volume.make(exported)
         if self.snapshots_disabled:
             if self.is_running():
@@ -2537,7 +2772,7 @@ class ZFSVolume(qubes.storage.Volume):
         )
         if self.snapshots_disabled:
             await self._mark_clean()
-        return os.path.join(ZVOL_DIR, exported)
+        return os.path.join(ZVOL_DIR, exported), src
 
     async def export_end(self, path: str) -> None:
         """
@@ -2555,6 +2790,115 @@ class ZFSVolume(qubes.storage.Volume):
         # but their removal could help have a neater `zfs list`.
         await self._remove_volume_export_if_exists(suffix)
 
+    async def export_changes(
+        self,
+        backup_id: str,
+        base_tag: str,
+    ) -> Tuple[str, Optional[str], Optional[List[Tuple[int, int]]]]:
+        """
+        Exports the volume like `export()`, bookmarking the exported
+        snapshot as a base for the next incremental backup, and compares
+        it with the previous base with the same tag using an incremental
+        `zfs send`.
+
+        Bookmarks do not keep the data of the snapshot, so the snapshot
+        can still be purged as usual.
+        """
+        if (
+            not self.save_on_stop
+            or not _backup_id_re.fullmatch(backup_id)
+            or not _base_tag_re.fullmatch(base_tag)
+        ):
+            return await super().export_changes(backup_id, base_tag)
+        bookmark = self._backup_base_bookmark(base_tag, backup_id)
+        # the exported volume is named after the bookmark, so that
+        # export_changes_end() knows which one to keep
+        path, src = await self._export(bookmark)
+        try:
+            await self.pool.accessor.bookmark_snapshot_async(
+                src,
+                bookmark,
+                log=self.log,
+            )
+        except Exception:
+            await self.export_end(path)
+            raise
+        bases = await self._backup_bases(base_tag)
+        previous = sorted(b for b in bases if b != backup_id)
+        if not previous:
+            return path, None, None
+        if bases[previous[-1]] == bases[backup_id]:
+            # unchanged since the previous backup
+            return path, previous[-1], []
+        try:
+            extents = await self.pool.accessor.get_changes_since_bookmark_async(
+                self._backup_base_bookmark(base_tag, previous[-1]),
+                src,
+                log=self.log,
+            )
+        except qubes.exc.StoragePoolException as e:
+            self.log.warning(
+                "Failed to compare %s with previous backup, exporting full "
+                "data: %s",
+                self.volume,
+                e,
+            )
+            return path, None, None
+        return path, previous[-1], extents
+
+    async def export_changes_end(self, path: str, success: bool) -> None:
+        """
+        Removes the export, and either the bases of previous backups with
+        the same tag (if the backup succeeded) or the new one.
+        """
+        suffix = os.path.basename(path)
+        if not suffix.startswith(BACKUP_BASE_BOOKMARK + "-"):
+            return await super().export_changes_end(path, success)
+        await self.export_end(path)
+        if not await self.pool.accessor.volume_exists_async(
+            self.volume,
+            log=self.log,
+        ):
+            return None
+        base_tag, _, backup_id = suffix[
+            len(BACKUP_BASE_BOOKMARK + "-") :
+        ].partition("-")
+        # keep bases of other tags, they are used by other backup profiles
+        bases = await self._backup_bases(base_tag)
+        if success:
+            obsolete = [b for b in bases if b != backup_id]
+        else:
+            obsolete = [b for b in bases if b == backup_id]
+        for obsolete_id in obsolete:
+            await self.pool.accessor.remove_bookmark_async(
+                self.volume,
+                self._backup_base_bookmark(base_tag, obsolete_id),
+                log=self.log,
+            )
+        return None
+
+    @staticmethod
+    def _backup_base_bookmark(base_tag: str, backup_id: str) -> str:
+        return "%s-%s-%s" % (BACKUP_BASE_BOOKMARK, base_tag, backup_id)
+
+    async def _backup_bases(self, base_tag: str) -> Dict[str, str]:
+        """
+        Returns a dictionary of IDs of backups with a base of `base_tag`
+        kept for an incremental backup, to the GUID of the snapshot
+        bookmarked as the base.
+        """
+        prefix = self._backup_base_bookmark(base_tag, "")
+        bookmarks = await self.pool.accessor.get_volume_bookmarks_async(
+            self.volume,
+            log=self.log,
+        )
+        return {
+            name[len(prefix) :]: guid
+            for name, guid in bookmarks.items()
+            if name.startswith(prefix)
+            and _backup_id_re.fullmatch(name[len(prefix) :])
+        }
+
     def block_device(self) -> qubes.storage.BlockDevice:
         """Return :py:class:`qubes.storage.BlockDevice` for serialization in
         the libvirt XML template as <disk>.
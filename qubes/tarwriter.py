@@ -17,6 +17,7 @@
 # You should have received a copy of the GNU Lesser General Public
 # License along with this library; if not, see <https://www.gnu.org/licenses/>.
 import argparse
+import errno
 import functools
 import os
 import subprocess
@@ -25,6 +26,13 @@ import io
 
 BUF_SIZE = 409600
 
+#: PAX header with ID of the backup a delta (see :py:func:`apply_delta`)
+#: applies to
+BASE_BACKUP_ID_HEADER = "QUBES.base-backup-id"
+
+_ZERO_BLOCK = bytes(tarfile.BLOCKSIZE)
+_ZERO_BUF = memoryview(bytes(BUF_SIZE))
+
 
 class TarSparseInfo(tarfile.TarInfo):
     def __init__(self, name="", sparsemap=None):
@@ -86,7 +94,147 @@ def get_sparse_map(input_file):
     blocks. Last entry of the map spans to the end of file, even if that part is
     zero-size (when file ends with zeros).
 
-    This function is performance critical.
+    This function is performance critical. Holes are skipped without reading
+    them (using :py:data:`os.SEEK_DATA` and :py:data:`os.SEEK_HOLE`), and data
+    regions are searched for zero blocks in large buffers. If the file does
+    not support that, :py:func:`get_sparse_map_read` is used.
+
+    :param input_file: io.File object
+    :return: iterable of (offset, size)
+    """
+    try:
+        size, data_regions = get_data_regions(input_file)
+    except (OSError, AttributeError):
+        yield from get_sparse_map_read(input_file)
+        return
+
+    buf = bytearray(BUF_SIZE)
+    data_start = data_end = 0
+    for region_start, region_end in data_regions:
+        offset = region_start
+        input_file.seek(offset)
+        while offset < region_end:
+            buf_len = input_file.readinto(
+                memoryview(buf)[: min(BUF_SIZE, region_end - offset)]
+            )
+            if not buf_len:
+                break
+            for start, end in find_data_blocks(buf, buf_len):
+                if offset + start != data_end:
+                    if data_end:
+                        yield (data_start, data_end - data_start)
+                    data_start = offset + start
+                data_end = offset + end
+            offset += buf_len
+    if data_end == size and data_end:
+        yield (data_start, data_end - data_start)
+    else:
+        if data_end:
+            yield (data_start, data_end - data_start)
+        # always emit last slice to the input end - otherwise extracted file
+        # will be truncated
+        yield (size, 0)
+
+
+def get_data_regions(input_file):
+    """Find regions of the file that are not holes.
+
+    Returned regions are aligned to :py:data:`tarfile.BLOCKSIZE`.
+
+    :param input_file: io.File object
+    :return: tuple of file size and list of (start, end)
+    :raises OSError: when the file does not support searching for holes
+    """
+    size = input_file.seek(0, os.SEEK_END)
+    regions = []
+    offset = 0
+    while offset < size:
+        try:
+            start = input_file.seek(offset, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                # no more data
+                break
+            raise
+        end = input_file.seek(start, os.SEEK_HOLE)
+        start -= start % tarfile.BLOCKSIZE
+        end = min(size, -(-end // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE)
+        if regions and regions[-1][1] >= start:
+            regions[-1] = (regions[-1][0], end)
+        else:
+            regions.append((start, end))
+        offset = end
+    input_file.seek(0)
+    return size, regions
+
+
+def find_data_blocks(buf, buf_len):
+    """Find blocks of *buf* that are not all zeros.
+
+    Zero blocks are searched for with :py:meth:`bytearray.find` and skipped
+    with comparisons over growing slices, instead of comparing each block
+    separately. A trailing partial block is data unless it is all zeros.
+
+    :param buf: bytearray with data, starting at a block boundary
+    :param buf_len: length of valid data in *buf*
+    :return: iterable of (start, end) of data ranges within *buf*
+    """
+    full_end = buf_len - buf_len % tarfile.BLOCKSIZE
+    data_start = 0
+    while True:
+        zero_start = _find_zero_block(buf, data_start, full_end)
+        if zero_start is None:
+            break
+        if zero_start > data_start:
+            yield (data_start, zero_start)
+        data_start = _find_zero_blocks_end(buf, zero_start, full_end)
+    if buf[full_end:buf_len] == _ZERO_BUF[: buf_len - full_end]:
+        data_end = full_end
+    else:
+        data_end = buf_len
+    if data_start < data_end:
+        yield (data_start, data_end)
+
+
+def _find_zero_block(buf, start, end):
+    """Find first block-aligned zero block in buf[start:end]"""
+    while True:
+        found = buf.find(_ZERO_BLOCK, start, end)
+        if found == -1:
+            return None
+        aligned = -(-found // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+        if aligned + tarfile.BLOCKSIZE > end:
+            return None
+        if buf[aligned : aligned + tarfile.BLOCKSIZE] == _ZERO_BLOCK:
+            return aligned
+        # zero blocks found later must start after this (non-zero) one
+        start = aligned + 1
+
+
+def _find_zero_blocks_end(buf, start, end):
+    """Find end of zero blocks run starting at *start* in buf[:end]"""
+    step = tarfile.BLOCKSIZE
+    offset = start + tarfile.BLOCKSIZE
+    while offset < end:
+        length = min(step, end - offset)
+        if buf[offset : offset + length] == _ZERO_BUF[:length]:
+            offset += length
+            step *= 2
+        elif length == tarfile.BLOCKSIZE:
+            break
+        else:
+            step = tarfile.BLOCKSIZE
+    return offset
+
+
+def get_sparse_map_read(input_file):
+    """
+    Return map of the file where actual data is present, ignoring zero-ed
+    blocks. Last entry of the map spans to the end of file, even if that part is
+    zero-size (when file ends with zeros).
+
+    This is a fallback for :py:func:`get_sparse_map`, reading and comparing
+    every block of the file.
 
     :param input_file: io.File object
     :return: iterable of (offset, size)
@@ -147,6 +295,53 @@ def copy_sparse_data(input_stream, output_stream, sparse_map):
                 raise EOFError("premature EOF")
 
 
+def read_extents(extents_file, size):
+    """Read sparse map from a file with one "offset size" pair per line.
+
+    Last entry of the map spans to *size*, like in :py:func:`get_sparse_map`.
+
+    :param extents_file: text file object
+    :param size: size of the whole file
+    :return: list of (offset, size)
+    """
+    sparse_map = []
+    for line in extents_file:
+        offset, length = map(int, line.split())
+        sparse_map.append((offset, length))
+    if not sparse_map or sum(sparse_map[-1]) < size:
+        sparse_map.append((size, 0))
+    return sparse_map
+
+
+def apply_delta(input_stream, output_file):
+    """Apply delta archive to a file.
+
+    Delta is a sparse file archived with ``--extents`` option. Its data
+    regions are written at their offsets to *output_file*, and other
+    regions are left untouched. *output_file* is resized to the size of the
+    archived file.
+
+    :param input_stream: (uncompressed) tar stream with the delta
+    :param output_file: file object, opened for writing, with data of the \
+        base backup
+    :return: ID of the base backup, if stored in the archive
+    """
+    with tarfile.open(fileobj=input_stream, mode="r|") as tar:
+        member = tar.next()
+        if member is None or not member.issparse():
+            raise ValueError("Not a sparse file archive")
+        for offset, size in member.sparse:
+            output_file.seek(offset)
+            while size:
+                buf = tar.fileobj.read(min(size, BUF_SIZE))
+                if not buf:
+                    raise EOFError("premature EOF")
+                output_file.write(buf)
+                size -= len(buf)
+        output_file.truncate(member.size)
+        return member.pax_headers.get(BASE_BACKUP_ID_HEADER)
+
+
 def finalize(output):
     """Write EOF blocks"""
     output.write(b"\0" * 512)
@@ -169,17 +364,38 @@ def main(args=None):
         dest="use_compress_program",
         help="Filter data through COMMAND.",
     )
+    parser.add_argument(
+        "--extents",
+        metavar="FILE",
+        action="store",
+        help="archive only regions listed in FILE, one 'offset size' pair "
+        "per line, as a delta to be applied with apply_delta()",
+    )
+    parser.add_argument(
+        "--base-backup-id",
+        metavar="ID",
+        action="store",
+        help="store ID of the backup the delta applies to",
+    )
     parser.add_argument("input_file", help="input file name")
     parser.add_argument(
         "output_file", default="-", nargs="?", help="output file name"
     )
     args = parser.parse_args(args)
     with io.open(args.input_file, "rb") as input_file:
-        sparse_map = list(get_sparse_map(input_file))
+        if args.extents:
+            with open(args.extents, encoding="ascii") as extents_file:
+                sparse_map = read_extents(
+                    extents_file, input_file.seek(0, os.SEEK_END)
+                )
+        else:
+            sparse_map = list(get_sparse_map(input_file))
         header_name = args.input_file
         if args.override_name:
             header_name = args.override_name
         tar_info = TarSparseInfo(header_name, sparse_map)
+        if args.base_backup_id:
+            tar_info.pax_headers[BASE_BACKUP_ID_HEADER] = args.base_backup_id
         with io.open(
             ("/dev/stdout" if args.output_file == "-" else args.output_file),
             "wb",
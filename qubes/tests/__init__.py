@@ -539,6 +539,7 @@ class QubesTestCase(unittest.TestCase):
     def cleanup_gc(self):
         # remove cached references to Qubes() object
         qubes.api.internal.SystemInfoCache.cache_for_app = None
+        qubes.api.internal.SystemInfoCache.outdated.clear()
 
         gc.collect()
         leaked = [
@@ -896,6 +897,7 @@ class SystemTestCase(QubesTestCase):
         self.app = qubes.Qubes(XMLPATH)
         os.environ["QUBES_XML_PATH"] = XMLPATH
         self.app.register_event_handlers()
+        self.app.check_power_state_cache = True
 
         self.qubesd = self.loop.run_until_complete(
             qubes.api.create_servers(
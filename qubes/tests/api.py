@@ -19,12 +19,15 @@
 # License along with this library; if not, see <https://www.gnu.org/licenses/>.
 
 import asyncio
+import io
 import socket
+import struct
 import unittest.mock
 
 import qubes.api
 import qubes.exc
 import qubes.tests
+import qubes.tools.qubesd_query
 
 
 class TestMgmt:
@@ -202,6 +205,215 @@ class TC_00_QubesDaemonProtocol(qubes.tests.QubesTestCase):
             b"0\0src: b'src', dest: b'dom0', arg: b'arg', payload: b'payload'",
         )
 
+    def test_007_flush_save_before_response(self):
+        self.app.flush_save.side_effect = lambda: self.assertFalse(
+            self.transport.is_closing()
+        )
+        self.writer.write(b"mgmt.success_none+arg dom0 name dom0\0payload")
+        self.writer.write_eof()
+        with self.assertNotRaises(asyncio.TimeoutError):
+            response = self.loop.run_until_complete(
+                asyncio.wait_for(self.reader.read(), 1)
+            )
+        self.assertEqual(response, b"0\0")
+        self.app.flush_save.assert_called_once_with()
+
+    def test_008_flush_save_before_exception(self):
+        self.writer.write(b"mgmt.qubesexception+arg dom0 name dom0\0payload")
+        self.writer.write_eof()
+        with self.assertNotRaises(asyncio.TimeoutError):
+            response = self.loop.run_until_complete(
+                asyncio.wait_for(self.reader.read(), 1)
+            )
+        self.assertEqual(response, b"2\0QubesException\0\0qubes-exception\0")
+        self.app.flush_save.assert_called_once_with()
+
+    def framed_request(self, tag, request):
+        return struct.pack("!II", tag, len(request)) + request
+
+    def read_frame(self):
+        tag, length = struct.unpack(
+            "!II",
+            self.loop.run_until_complete(
+                asyncio.wait_for(self.reader.readexactly(8), 1)
+            ),
+        )
+        response = self.loop.run_until_complete(
+            asyncio.wait_for(self.reader.readexactly(length), 1)
+        )
+        return tag, response
+
+    def test_010_framed_multiple(self):
+        self.writer.write(qubes.api.QubesDaemonProtocol.framed_magic)
+        self.writer.write(
+            self.framed_request(5, b"mgmt.success+arg src name dest\0p1")
+        )
+        self.writer.write(
+            self.framed_request(3, b"mgmt.success_none+arg dom0 name dom0\0")
+        )
+        self.writer.write(
+            self.framed_request(7, b"mgmt.success+arg2 src name dest\0p2")
+        )
+        self.writer.write_eof()
+        with self.assertNotRaises(asyncio.TimeoutError):
+            responses = [self.read_frame() for _ in range(3)]
+            rest = self.loop.run_until_complete(
+                asyncio.wait_for(self.reader.read(), 1)
+            )
+        self.assertEqual(
+            responses,
+            [
+                (
+                    5,
+                    b"0\0src: b'src', dest: b'dest', arg: b'arg', "
+                    b"payload: b'p1'",
+                ),
+                (3, b"0\0"),
+                (
+                    7,
+                    b"0\0src: b'src', dest: b'dest', arg: b'arg2', "
+                    b"payload: b'p2'",
+                ),
+            ],
+        )
+        self.assertEqual(rest, b"")
+        self.assertEqual(self.app.flush_save.call_count, 3)
+
+    def test_011_framed_in_parts(self):
+        request = self.framed_request(1, b"mgmt.success_none dom0 name dom0\0")
+        data = qubes.api.QubesDaemonProtocol.framed_magic + request
+        for i in range(0, len(data), 3):
+            self.writer.write(data[i : i + 3])
+            self.loop.run_until_complete(self.writer.drain())
+        with self.assertNotRaises(asyncio.TimeoutError):
+            self.assertEqual(self.read_frame(), (1, b"0\0"))
+
+    def test_012_framed_exceptions_keep_connection(self):
+        self.writer.write(qubes.api.QubesDaemonProtocol.framed_magic)
+        self.writer.write(
+            self.framed_request(1, b"mgmt.qubesexception dom0 name dom0\0")
+        )
+        self.writer.write(
+            self.framed_request(2, b"mgmt.exception dom0 name dom0\0")
+        )
+        self.writer.write(
+            self.framed_request(3, b"mgmt.invalid dom0 name dom0\0")
+        )
+        self.writer.write(
+            self.framed_request(4, b"mgmt.success_none dom0 name dom0\0")
+        )
+        with self.assertNotRaises(asyncio.TimeoutError):
+            self.assertEqual(
+                self.read_frame(),
+                (1, b"2\0QubesException\0\0qubes-exception\0"),
+            )
+            self.assertEqual(self.read_frame(), (2, b""))
+            self.assertEqual(
+                self.read_frame(),
+                (3, b"2\0ProtocolError\0\0Invalid method\0"),
+            )
+            self.assertEqual(self.read_frame(), (4, b"0\0"))
+
+    def test_013_framed_too_long(self):
+        self.writer.write(qubes.api.QubesDaemonProtocol.framed_magic)
+        self.writer.write(struct.pack("!II", 1, 65537))
+        with self.assertNotRaises(asyncio.TimeoutError):
+            response = self.loop.run_until_complete(
+                asyncio.wait_for(self.reader.read(), 1)
+            )
+        self.assertEqual(response, b"")
+
+    def test_015_framed_connection_lost(self):
+        self.writer.write(qubes.api.QubesDaemonProtocol.framed_magic)
+        self.writer.write(
+            self.framed_request(1, b"mgmt.event dom0 name dom0\0payload")
+        )
+        with self.assertNotRaises(asyncio.TimeoutError):
+            tag, _ = self.read_frame()
+        self.assertEqual(tag, 1)
+        mgmt = self.protocol.mgmt
+        self.assertIsNotNone(mgmt)
+        # close the connection while the call is still running
+        self.writer.transport.abort()
+        self.loop.run_until_complete(asyncio.sleep(0.2))
+        self.assertIsNone(self.protocol.transport)
+        self.assertTrue(mgmt.task.done())
+        self.assertIsNone(self.protocol.frames_task)
+
+    def test_014_client(self):
+        async def run_client():
+            connection = qubes.api.QubesdConnection(self.reader, self.writer)
+            connection.writer.write(qubes.api.QubesDaemonProtocol.framed_magic)
+            responses = await asyncio.gather(
+                connection.call(
+                    "src", "mgmt.success", "dest", "arg", b"payload"
+                ),
+                connection.call("dom0", "mgmt.qubesexception", "dom0"),
+            )
+            await connection.close()
+            return responses
+
+        with self.assertNotRaises(asyncio.TimeoutError):
+            responses = self.loop.run_until_complete(
+                asyncio.wait_for(run_client(), 1)
+            )
+        self.assertEqual(
+            responses,
+            [
+                b"0\0src: b'src', dest: b'dest', arg: b'arg', "
+                b"payload: b'payload'",
+                b"2\0QubesException\0\0qubes-exception\0",
+            ],
+        )
+
+    def test_016_qubesd_query_framed(self):
+        async def connect(sockpath):
+            # pylint: disable=unused-argument
+            self.writer.write(qubes.api.QubesDaemonProtocol.framed_magic)
+            return qubes.api.QubesdConnection(self.reader, self.writer)
+
+        requests = qubes.tools.qubesd_query.parse_framed_requests(
+            b"src mgmt.success dest arg\n\ndom0 mgmt.success_none dom0\n"
+        )
+        self.assertEqual(
+            requests,
+            [
+                ("src", "mgmt.success", "dest", "arg"),
+                ("dom0", "mgmt.success_none", "dom0"),
+            ],
+        )
+        stdout = unittest.mock.Mock(buffer=io.BytesIO())
+        with unittest.mock.patch(
+            "qubes.api.QubesdConnection.connect", side_effect=connect
+        ), unittest.mock.patch("sys.stdout", stdout):
+            with self.assertNotRaises(asyncio.TimeoutError):
+                returncode = self.loop.run_until_complete(
+                    asyncio.wait_for(
+                        qubes.tools.qubesd_query.qubesd_framed_client(
+                            "/path", requests
+                        ),
+                        1,
+                    )
+                )
+        self.assertEqual(returncode, 0)
+        response = b"0\0src: b'src', dest: b'dest', arg: b'arg', payload: b''"
+        self.assertEqual(
+            stdout.buffer.getvalue(),
+            b"%d\n" % len(response) + response + b"2\n0\0",
+        )
+
+    def test_017_qubesd_query_framed_invalid(self):
+        with self.assertRaises(ValueError):
+            qubes.tools.qubesd_query.parse_framed_requests(b"src method\n")
+        with self.assertRaises(ValueError):
+            qubes.tools.qubesd_query.parse_framed_requests(
+                b"src method dest arg extra\n"
+            )
+        with self.assertRaises(ValueError):
+            qubes.tools.qubesd_query.parse_framed_requests(
+                b"src method dest \xff\n"
+            )
+
 
 class TC_10_QubesAPIValidation(qubes.tests.QubesTestCase):
 
@@ -21,6 +21,7 @@
 """Tests for management calls endpoints"""
 
 import asyncio
+import contextlib
 import operator
 import os
 import re
@@ -537,6 +538,54 @@ netvm default=True type=vm \n"""
             self.assertFalse(mock.called)
         self.assertFalse(self.app.save.called)
 
+    def test_045_vm_property_get_all_for_all(self):
+        self.vm.kernelopts = "opt1\nopt2"
+        with contextlib.ExitStack() as stack:
+            for vm in self.app.domains:
+                list_mock = stack.enter_context(
+                    unittest.mock.patch.object(vm, "property_list")
+                )
+                list_mock.return_value = [
+                    vm.property_get_def("name"),
+                    vm.property_get_def("qid"),
+                ] + (
+                    [vm.property_get_def("kernelopts")]
+                    if hasattr(vm, "kernelopts")
+                    else []
+                )
+            value = self.call_mgmt_func(
+                b"admin.vm.property.GetAllForAll", b"dom0"
+            )
+        self.maxDiff = None
+        expected = """dom0 name default=True type=str dom0
+dom0 qid default=True type=int 0
+test-template name default=False type=str test-template
+test-template qid default=False type=int 1
+test-template kernelopts default=True type=str """
+        expected += qubes.config.defaults["kernelopts"] + """
+test-vm1 name default=False type=str test-vm1
+test-vm1 qid default=False type=int 2
+test-vm1 kernelopts default=False type=str opt1\\nopt2
+"""
+        self.assertEqual(value, expected)
+
+    def test_046_vm_property_get_all_for_all_filtered(self):
+        def permission_handler(subject, event, dest, **kwargs):
+            # pylint: disable=unused-argument
+            if dest is self.template:
+                raise qubes.exc.PermissionDenied()
+            return ((lambda prop: prop.__name__ == "name"),)
+
+        self.emitter.add_handler(
+            "admin-permission:admin.vm.property.GetAll", permission_handler
+        )
+        value = self.call_mgmt_func(b"admin.vm.property.GetAllForAll", b"dom0")
+        self.assertEqual(
+            value,
+            "dom0 name default=True type=str dom0\n"
+            "test-vm1 name default=False type=str test-vm1\n",
+        )
+
     def test_050_vm_property_help(self):
         value = self.call_mgmt_func(
             b"admin.vm.property.Help", b"test-vm1", b"label"
@@ -1531,6 +1580,161 @@ netvm default=True type=vm \n"""
             self.call_mgmt_func(b"admin.vm.Shutdown", b"test-vm1", b"forcewait")
         func_mock.assert_not_called()
 
+    def test_235_start_many(self):
+        netvm = self.app.add_new_vm(
+            "AppVM",
+            label="red",
+            name="test-net",
+            template="test-template",
+            provides_network=True,
+        )
+        vm2 = self.app.add_new_vm(
+            "AppVM", label="red", name="test-vm2", template="test-template"
+        )
+        self.vm.netvm = netvm
+        vm2.netvm = None
+        started = []
+
+        def start_mock(vm):
+            async def coroutine_mock():
+                if vm.netvm is not None:
+                    self.assertIn(vm.netvm, started)
+                await asyncio.sleep(0)
+                started.append(vm)
+
+            return coroutine_mock
+
+        for vm in (netvm, vm2, self.vm):
+            vm.start = start_mock(vm)
+        value = self.call_mgmt_func(
+            b"admin.vm.StartMany",
+            b"dom0",
+            payload=b"test-vm1 test-vm2\ntest-net",
+        )
+        self.assertIsNone(value)
+        self.assertCountEqual(started, [netvm, vm2, self.vm])
+        self.assertLess(started.index(netvm), started.index(self.vm))
+
+    def test_236_start_many_failed(self):
+        netvm = self.app.add_new_vm(
+            "AppVM",
+            label="red",
+            name="test-net",
+            template="test-template",
+            provides_network=True,
+        )
+        self.vm.netvm = netvm
+        func_mock = unittest.mock.Mock()
+
+        async def netvm_start_mock():
+            raise qubes.exc.QubesException("failed")
+
+        async def coroutine_mock(*args, **kwargs):
+            return func_mock(*args, **kwargs)
+
+        netvm.start = netvm_start_mock
+        self.vm.start = coroutine_mock
+        with self.assertRaisesRegex(
+            qubes.exc.QubesException, "test-net: failed"
+        ):
+            self.call_mgmt_func(
+                b"admin.vm.StartMany", b"dom0", payload=b"test-net test-vm1"
+            )
+        func_mock.assert_not_called()
+
+    def test_237_start_many_invalid(self):
+        func_mock = unittest.mock.Mock()
+
+        async def coroutine_mock(*args, **kwargs):
+            return func_mock(*args, **kwargs)
+
+        self.vm.start = coroutine_mock
+        with self.assertRaises(qubes.exc.QubesVMNotFoundError):
+            self.call_mgmt_func(
+                b"admin.vm.StartMany", b"dom0", payload=b"test-vm1 no-such-vm"
+            )
+        with self.assertRaises(qubes.exc.ProtocolError):
+            self.call_mgmt_func(b"admin.vm.StartMany", b"dom0", payload=b"")
+        with self.assertRaises(qubes.exc.QubesValueError):
+            self.call_mgmt_func(
+                b"admin.vm.StartMany", b"dom0", payload=b"test-vm1 -vm"
+            )
+        with self.assertRaises(qubes.exc.ProtocolError):
+            self.call_mgmt_func(
+                b"admin.vm.StartMany", b"test-vm1", payload=b"test-vm1"
+            )
+        func_mock.assert_not_called()
+
+    def test_238_shutdown_many(self):
+        netvm = self.app.add_new_vm(
+            "AppVM",
+            label="red",
+            name="test-net",
+            template="test-template",
+            provides_network=True,
+        )
+        self.vm.netvm = netvm
+        stopped = []
+
+        def shutdown_mock(vm):
+            async def coroutine_mock(force, wait):
+                self.assertFalse(force)
+                self.assertTrue(wait)
+                stopped.append(vm)
+
+            return coroutine_mock
+
+        for vm in (netvm, self.vm, self.template):
+            vm.shutdown = shutdown_mock(vm)
+            vm.is_halted = lambda: False
+        value = self.call_mgmt_func(
+            b"admin.vm.ShutdownMany",
+            b"dom0",
+            payload=b"test-net test-template test-vm1",
+        )
+        self.assertIsNone(value)
+        self.assertEqual(stopped[0], self.vm)
+        self.assertCountEqual(stopped[1:], [netvm, self.template])
+
+    def test_239_shutdown_many_force(self):
+        netvm = self.app.add_new_vm(
+            "AppVM",
+            label="red",
+            name="test-net",
+            template="test-template",
+            provides_network=True,
+        )
+        self.vm.netvm = netvm
+        func_mock = unittest.mock.Mock()
+
+        async def vm_shutdown_mock(force, wait):
+            raise qubes.exc.QubesException("failed")
+
+        async def coroutine_mock(*args, **kwargs):
+            return func_mock(*args, **kwargs)
+
+        netvm.shutdown = coroutine_mock
+        self.vm.shutdown = vm_shutdown_mock
+        for vm in (netvm, self.vm):
+            vm.is_halted = lambda: False
+        with self.assertRaisesRegex(
+            qubes.exc.QubesException, "test-vm1: failed"
+        ):
+            self.call_mgmt_func(
+                b"admin.vm.ShutdownMany",
+                b"dom0",
+                b"force",
+                payload=b"test-net test-vm1",
+            )
+        func_mock.assert_called_once_with(force=True, wait=True)
+        with self.assertRaises(qubes.exc.ProtocolError):
+            self.call_mgmt_func(
+                b"admin.vm.ShutdownMany",
+                b"dom0",
+                b"wait",
+                payload=b"test-net test-vm1",
+            )
+
     def test_240_pause(self):
         func_mock = unittest.mock.Mock()
 
@@ -3895,6 +4099,28 @@ updatevm default=True type=vm \n""".format(maxmem=self.app.maxmem)
                         b"admin.backup.Info", b"dom0", b"testprofile"
                     )
 
+    def test_604_backup_info_profile_invalid_workers(self):
+        backup_profile = (
+            "include:\n"
+            " - test-vm1\n"
+            "destination_vm: test-vm1\n"
+            "destination_path: /var/tmp\n"
+            "passphrase_text: test\n"
+            "workers: 0\n"
+        )
+        with tempfile.TemporaryDirectory() as profile_dir:
+            with open(
+                os.path.join(profile_dir, "testprofile.conf"), "w"
+            ) as profile_file:
+                profile_file.write(backup_profile)
+            with unittest.mock.patch(
+                "qubes.config.backup_profile_dir", profile_dir
+            ):
+                with self.assertRaises(qubes.exc.QubesException):
+                    self.call_mgmt_func(
+                        b"admin.backup.Info", b"dom0", b"testprofile"
+                    )
+
     def test_610_backup_cancel_not_running(self):
         with self.assertRaises(qubes.exc.QubesException):
             self.call_mgmt_func(b"admin.backup.Cancel", b"dom0", b"testprofile")
@@ -3996,6 +4222,41 @@ running and private volume snapshots are disabled. Backup will fail!\n"
         )
         mock_backup.return_value.backup_do.assert_called_once_with()
 
+    @unittest.mock.patch("qubes.backup.Backup")
+    def test_620_backup_execute_incremental(self, mock_backup):
+        backup_profile = (
+            "include:\n"
+            " - test-vm1\n"
+            "destination_vm: test-vm1\n"
+            "destination_path: /home/user\n"
+            "passphrase_text: test\n"
+            "incremental: true\n"
+        )
+        mock_backup.return_value.backup_do.side_effect = self.dummy_coro
+        with tempfile.TemporaryDirectory() as profile_dir:
+            with open(
+                os.path.join(profile_dir, "testprofile.conf"), "w"
+            ) as profile_file:
+                profile_file.write(backup_profile)
+            with unittest.mock.patch(
+                "qubes.config.backup_profile_dir", profile_dir
+            ):
+                result = self.call_mgmt_func(
+                    b"admin.backup.Execute", b"dom0", b"testprofile"
+                )
+        self.assertIsNone(result)
+        mock_backup.assert_called_once_with(
+            self.app,
+            {self.vm},
+            set(),
+            target_vm=self.vm,
+            target_dir="/home/user",
+            compressed=True,
+            passphrase="test",
+            incremental=True,
+            profile_name="testprofile",
+        )
+
     @unittest.mock.patch("qubes.backup.Backup")
     def test_621_backup_execute_passphrase_service(self, mock_backup):
         backup_profile = (
@@ -4313,6 +4574,160 @@ running and private volume snapshots are disabled. Backup will fail!\n"
         ]
         self.assertEqual(send_event.mock_calls, expected)
 
+    def _vm_stats_data(self, vm_info):
+        return {
+            key: vm_info[key] // 1000000 if key == "cpu_time" else vm_info[key]
+            for key in (
+                "memory_kb",
+                "memory_assigned_total",
+                "memory_assigned_usable",
+                "memory_with_swap_used",
+                "cpu_time",
+                "cpu_usage",
+                "online_vcpus",
+                "swap_used",
+            )
+        }
+
+    def test_632_vm_stats_delta(self):
+        send_event = unittest.mock.Mock(spec=[])
+        stats1 = {
+            0: {
+                "name": "dom0",
+                "is_stubdom": False,
+                "memory_kb": 3733212,
+                "memory_assigned_total": 3733244,
+                "memory_assigned_usable": 3733212,
+                "memory_with_swap_used": 3733212,
+                "swap_used": 0,
+                "cpu_time": 243951379111104 // 8,
+                "cpu_usage": 0,
+                "online_vcpus": 16,
+            },
+            1: {
+                "name": "test-template",
+                "is_stubdom": False,
+                "memory_kb": 303916,
+                "memory_assigned_total": 303932,
+                "memory_assigned_usable": 303916,
+                "memory_with_swap_used": 303916,
+                "swap_used": 0,
+                "cpu_time": 2849496569205,
+                "cpu_usage": 0,
+                "online_vcpus": 2,
+            },
+        }
+        stats2 = copy.deepcopy(stats1)
+        stats2[0]["cpu_time"] += 100000000
+        stats2[0]["cpu_usage"] = 10
+        # below thresholds
+        stats2[1]["cpu_time"] += 1000000
+        stats2[1]["memory_with_swap_used"] += 100
+        self.app.host.get_vm_stats = unittest.mock.Mock()
+        self.app.host.get_vm_stats.side_effect = [
+            (0, stats1),
+            (1, stats2),
+        ]
+        self.app.stats_interval = 1
+        mgmt_obj = qubes.api.admin.QubesAdminAPI(
+            self.app,
+            b"dom0",
+            b"admin.vm.Stats",
+            b"dom0",
+            b"delta",
+            send_event=send_event,
+        )
+
+        loop = asyncio.get_event_loop()
+        execute_task = asyncio.ensure_future(
+            mgmt_obj.execute(untrusted_payload=b"")
+        )
+        loop.call_later(1.1, mgmt_obj.cancel)
+        loop.run_until_complete(execute_task)
+        self.assertIsNone(execute_task.result())
+        self.assertEqual(
+            send_event.mock_calls,
+            [
+                unittest.mock.call(self.app, "connection-established"),
+                unittest.mock.call(
+                    "dom0", "vm-stats", **self._vm_stats_data(stats1[0])
+                ),
+                unittest.mock.call(
+                    "test-template",
+                    "vm-stats",
+                    **self._vm_stats_data(stats1[1]),
+                ),
+                unittest.mock.call(
+                    "dom0", "vm-stats", **self._vm_stats_data(stats2[0])
+                ),
+            ],
+        )
+
+    def test_633_vm_stats_shared(self):
+        stats = {
+            0: {
+                "name": "dom0",
+                "is_stubdom": False,
+                "memory_kb": 3733212,
+                "memory_assigned_total": 3733244,
+                "memory_assigned_usable": 3733212,
+                "memory_with_swap_used": 3733212,
+                "swap_used": 0,
+                "cpu_time": 243951379111104 // 8,
+                "cpu_usage": 0,
+                "online_vcpus": 16,
+            },
+        }
+        self.app.host.get_vm_stats = unittest.mock.Mock()
+        self.app.host.get_vm_stats.side_effect = [(0, stats), (1, stats)]
+        self.app.stats_interval = 1
+        send_events = []
+        tasks = []
+        loop = asyncio.get_event_loop()
+        for _ in range(2):
+            send_event = unittest.mock.Mock(spec=[])
+            mgmt_obj = qubes.api.admin.QubesAdminAPI(
+                self.app,
+                b"dom0",
+                b"admin.vm.Stats",
+                b"dom0",
+                b"",
+                send_event=send_event,
+            )
+            send_events.append(send_event)
+            tasks.append(
+                asyncio.ensure_future(mgmt_obj.execute(untrusted_payload=b""))
+            )
+            loop.call_later(1.1, mgmt_obj.cancel)
+        loop.run_until_complete(asyncio.gather(*tasks))
+        # one measurement per interval, for both clients
+        self.assertEqual(
+            self.app.host.get_vm_stats.mock_calls,
+            [
+                unittest.mock.call(None, None, only_vm=None),
+                unittest.mock.call(0, stats, only_vm=None),
+            ],
+        )
+        expected = [
+            unittest.mock.call(self.app, "connection-established"),
+            unittest.mock.call(
+                "dom0", "vm-stats", **self._vm_stats_data(stats[0])
+            ),
+            unittest.mock.call(
+                "dom0", "vm-stats", **self._vm_stats_data(stats[0])
+            ),
+        ]
+        self.assertEqual(send_events[0].mock_calls, expected)
+        self.assertEqual(send_events[1].mock_calls, expected)
+        # stopped after the last client disconnected
+        self.assertIsNone(self.app.host.stats_sampler.sample)
+
+    def test_634_vm_stats_invalid_arg(self):
+        self.app.host.get_vm_stats = unittest.mock.Mock()
+        with self.assertRaises(qubes.exc.ProtocolError):
+            self.call_mgmt_func(b"admin.vm.Stats", b"dom0", b"invalid")
+        self.assertFalse(self.app.host.get_vm_stats.called)
+
     @unittest.mock.patch("qubes.storage.Storage.create")
     def test_640_vm_create_disposable(self, mock_storage):
         mock_storage.side_effect = self.dummy_coro
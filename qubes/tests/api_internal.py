@@ -297,3 +297,110 @@ class TC_00_API_Misc(qubes.tests.QubesTestCase):
             ret,
             expected_data,
         )
+        # only the changed domain got refreshed
+        self.assertEqual(self.dom0.get_power_state.call_count, 1)
+        self.assertEqual(vm.get_power_state.call_count, 2)
+
+    def test_011_get_system_info_add_remove(self):
+        self.dom0.tags = []
+        self.dom0.default_dispvm = None
+        self.dom0.template_for_dispvms = False
+        self.dom0.get_power_state.return_value = "Running"
+        self.dom0.uuid = uuid.UUID("00000000-0000-0000-0000-000000000000")
+        del self.dom0.guivm
+
+        ret = json.loads(self.call_mgmt_func(b"internal.GetSystemInfo"))
+        self.assertEqual(list(ret["domains"]), ["dom0"])
+        handlers = {
+            call[1][0]: call[1][1] for call in self.app.add_handler.mock_calls
+        }
+
+        vm = mock.NonCallableMock(spec=qubes.vm.qubesvm.QubesVM)
+        vm.name = "vm"
+        vm.features = {}
+        vm.tags = ["tag1"]
+        vm.default_dispvm = None
+        vm.template_for_dispvms = False
+        vm.guivm = None
+        vm.get_power_state.return_value = "Halted"
+        vm.uuid = TEST_UUID
+        self.domains["vm"] = vm
+        handlers["domain-add"](self.app, "domain-add", vm=vm)
+        value = self.call_mgmt_func(b"internal.GetSystemInfo")
+        ret = json.loads(value)
+        self.assertEqual(list(ret["domains"]), ["dom0", "vm"])
+        self.assertEqual(ret["domains"]["vm"]["tags"], ["tag1"])
+        self.assertEqual(
+            value,
+            json.dumps(
+                qubes.api.internal.SystemInfoCache.get_system_info(self.app)
+            ),
+        )
+
+        del self.domains["vm"]
+        handlers["domain-delete"](self.app, "domain-delete", vm=vm)
+        ret = json.loads(self.call_mgmt_func(b"internal.GetSystemInfo"))
+        self.assertEqual(list(ret["domains"]), ["dom0"])
+        self.assertEqual(self.dom0.get_power_state.call_count, 1)
+
+    def test_012_get_system_info_power_state(self):
+        self.dom0.tags = []
+        self.dom0.default_dispvm = None
+        self.dom0.template_for_dispvms = False
+        self.dom0.get_power_state.return_value = "Running"
+        self.dom0.uuid = uuid.UUID("00000000-0000-0000-0000-000000000000")
+        del self.dom0.guivm
+
+        vm = mock.NonCallableMock(spec=qubes.vm.qubesvm.QubesVM)
+        vm.name = "vm"
+        vm.features = {}
+        vm.tags = []
+        vm.default_dispvm = None
+        vm.template_for_dispvms = False
+        vm.guivm = None
+        vm.get_power_state.return_value = "Running"
+        vm.uuid = TEST_UUID
+        self.domains["vm"] = vm
+
+        ret = json.loads(self.call_mgmt_func(b"internal.GetSystemInfo"))
+        self.assertEqual(ret["domains"]["vm"]["power_state"], "Running")
+        handlers = {
+            call[1][0]: call[1][1] for call in vm.add_handler.mock_calls
+        }
+        for event, power_state in (
+            ("domain-paused", "Paused"),
+            ("domain-unpaused", "Running"),
+            ("domain-stopped", "Halted"),
+        ):
+            vm.get_power_state.return_value = power_state
+            handlers[event](vm, event)
+            ret = json.loads(self.call_mgmt_func(b"internal.GetSystemInfo"))
+            self.assertEqual(ret["domains"]["vm"]["power_state"], power_state)
+
+    def test_013_get_system_info_policy_generation(self):
+        self.dom0.tags = []
+        self.dom0.default_dispvm = None
+        self.dom0.template_for_dispvms = False
+        self.dom0.get_power_state.return_value = "Running"
+        self.dom0.uuid = uuid.UUID("00000000-0000-0000-0000-000000000000")
+        del self.dom0.guivm
+
+        cache = qubes.api.internal.SystemInfoCache
+        self.call_mgmt_func(b"internal.GetSystemInfo")
+        generation = cache.policy_generation
+        handlers = {
+            call[1][0]: call[1][1] for call in self.dom0.add_handler.mock_calls
+        }
+
+        # power state is not used by policy
+        self.dom0.get_power_state.return_value = "Paused"
+        handlers["domain-paused"](self.dom0, "domain-paused")
+        ret = json.loads(self.call_mgmt_func(b"internal.GetSystemInfo"))
+        self.assertEqual(ret["domains"]["dom0"]["power_state"], "Paused")
+        self.assertEqual(cache.policy_generation, generation)
+
+        # tags are
+        self.dom0.tags = ["tag1"]
+        handlers["domain-tag-add:*"](self.dom0, "domain-tag-add:tag1")
+        self.call_mgmt_func(b"internal.GetSystemInfo")
+        self.assertEqual(cache.policy_generation, generation + 1)
@@ -20,6 +20,7 @@
 # License along with this library; if not, see <https://www.gnu.org/licenses/>.
 #
 
+import asyncio
 import os
 from unittest import mock
 
@@ -1512,6 +1513,165 @@ class TC_90_Qubes(qubes.tests.QubesTestCase):
 
         self.app.default_netvm = None
 
+    def test_209_vms_depending_on(self):
+        netvm = self.app.add_new_vm(
+            "AppVM",
+            name="test-netvm",
+            template=self.template,
+            label="red",
+            provides_network=True,
+            netvm=None,
+        )
+        proxyvm = self.app.add_new_vm(
+            "AppVM",
+            name="test-proxyvm",
+            template=self.template,
+            label="red",
+            provides_network=True,
+            netvm=netvm,
+        )
+        appvm = self.app.add_new_vm(
+            "AppVM",
+            name="test-appvm",
+            template=self.template,
+            label="red",
+            netvm=proxyvm,
+        )
+        self.assertEqual(set(netvm.connected_vms), {proxyvm})
+        self.assertEqual(
+            self.app.domains.get_vms_connected_to(netvm), {proxyvm, appvm}
+        )
+        self.assertEqual(
+            self.app.domains.get_vms_based_on(self.template),
+            {netvm, proxyvm, appvm, self.appvm, self.appvm_alt},
+        )
+        self.assertEqual(
+            self.app.domains.get_vm_dependents(proxyvm), {"netvm": {appvm}}
+        )
+
+        appvm.netvm = netvm
+        self.assertEqual(set(netvm.connected_vms), {proxyvm, appvm})
+        self.assertEqual(set(proxyvm.connected_vms), set())
+
+        # default value
+        self.app.default_netvm = proxyvm
+        del appvm.netvm
+        self.assertEqual(
+            set(proxyvm.connected_vms), {appvm, self.appvm, self.appvm_alt}
+        )
+        self.app.default_netvm = netvm
+        self.assertEqual(
+            set(netvm.connected_vms),
+            {proxyvm, appvm, self.appvm, self.appvm_alt},
+        )
+
+        self.app.default_netvm = None
+        del self.app.domains[appvm]
+        self.assertEqual(
+            self.app.domains.get_vms_connected_to(netvm), {proxyvm}
+        )
+
+    def test_210_vms_depending_on_template_default(self):
+        self.appvm.template_for_dispvms = True
+        self.appvm_alt.template_for_dispvms = True
+        self.assertEqual(
+            self.app.domains.get_vms_depending_on(
+                self.appvm, ("management_dispvm",)
+            ),
+            set(),
+        )
+        # the default value comes from the template
+        self.template.management_dispvm = self.appvm
+        self.assertEqual(
+            self.app.domains.get_vms_depending_on(
+                self.appvm, ("management_dispvm",)
+            ),
+            {self.template, self.appvm, self.appvm_alt},
+        )
+        self.template.management_dispvm = self.appvm_alt
+        self.assertEqual(
+            self.app.domains.get_vms_depending_on(
+                self.appvm, ("management_dispvm",)
+            ),
+            set(),
+        )
+
+    def test_220_start_vms(self):
+        netvm = self.app.add_new_vm(
+            "AppVM",
+            name="test-netvm",
+            template=self.template,
+            label="red",
+            provides_network=True,
+            netvm=None,
+        )
+        self.appvm.netvm = netvm
+        self.appvm_alt.netvm = netvm
+        running = set()
+        started = []
+        max_running = 0
+
+        def start_mock(vm):
+            async def coroutine_mock():
+                nonlocal max_running
+                if vm.netvm is not None:
+                    self.assertIn(vm.netvm, started)
+                running.add(vm)
+                max_running = max(max_running, len(running))
+                await asyncio.sleep(0)
+                running.remove(vm)
+                started.append(vm)
+
+            return coroutine_mock
+
+        for vm in (netvm, self.appvm, self.appvm_alt, self.template):
+            vm.start = start_mock(vm)
+
+        loop = asyncio.get_event_loop()
+        failed = loop.run_until_complete(
+            self.app.start_vms(
+                [self.appvm_alt, self.appvm, netvm, self.template],
+                concurrency=2,
+            )
+        )
+        self.assertEqual(failed, {})
+        self.assertCountEqual(
+            started, [netvm, self.appvm, self.appvm_alt, self.template]
+        )
+        self.assertEqual(max_running, 2)
+
+        # dependency loop
+        netvm.guivm = self.appvm
+        with self.assertRaises(qubes.exc.QubesException):
+            loop.run_until_complete(self.app.start_vms([netvm, self.appvm]))
+
+    def test_211_vms_depending_on_direct_dict(self):
+        netvm = self.app.add_new_vm(
+            "AppVM",
+            name="test-netvm",
+            template=self.template,
+            label="red",
+            provides_network=True,
+            netvm=None,
+        )
+        appvm = self.app.add_new_vm(
+            "AppVM",
+            name="test-appvm",
+            template=self.template,
+            label="red",
+            netvm=None,
+        )
+        # populated directly, bypassing add() (and its event handlers)
+        domains = qubes.app.VMCollection(self.app)
+        self.addCleanup(domains.close)
+        for vm in (netvm, appvm):
+            domains._dict[vm.qid] = vm
+        self.assertEqual(domains.get_vms_connected_to(netvm), set())
+        appvm.netvm = netvm
+        self.assertEqual(domains.get_vms_connected_to(netvm), {appvm})
+        del appvm.netvm
+        self.assertEqual(domains.get_vms_connected_to(netvm), set())
+
     def test_300_preload_default_dispvm(self):
         """Fire event for new setting from no previous one."""
         self.appvm.features["preload-dispvm-max"] = "1"
@@ -1606,6 +1766,62 @@ class TC_90_Qubes(qubes.tests.QubesTestCase):
         self.appvm.template_for_dispvms = True
         self.app.management_dispvm = self.appvm
 
+    def test_400_save_delay(self):
+        self.app.save_delay = 60
+        with mock.patch.object(self.app, "_write_store") as mock_write:
+            self.app.save()
+            self.app.save()
+            self.assertTrue(self.app.save_pending)
+            mock_write.assert_not_called()
+            self.app.flush_save()
+            mock_write.assert_called_once_with(log_level=logging.DEBUG)
+            self.assertFalse(self.app.save_pending)
+            self.app.flush_save()
+            mock_write.assert_called_once_with(log_level=logging.DEBUG)
+
+    def test_401_save_delay_timer(self):
+        self.app.save_delay = 0.01
+        with mock.patch.object(self.app, "_write_store") as mock_write:
+            self.app.save()
+            self.app.save()
+            self.loop.run_until_complete(asyncio.sleep(0.1))
+            mock_write.assert_called_once_with(log_level=logging.DEBUG)
+            self.assertFalse(self.app.save_pending)
+
+    def test_402_save_no_lock_not_delayed(self):
+        self.app.save_delay = 60
+        self.app.save()
+        with mock.patch.object(self.app, "_write_store") as mock_write:
+            self.app.save(lock=False)
+            mock_write.assert_called_once_with(
+                lock=False, log_level=logging.DEBUG
+            )
+        self.assertFalse(self.app.save_pending)
+
+    def test_410_domain_xml_cache(self):
+        xml1 = lxml.etree.tostring(self.appvm.__xml__())
+        with mock.patch.object(
+            self.appvm, "xml_properties", wraps=self.appvm.xml_properties
+        ) as mock_props:
+            xml2 = lxml.etree.tostring(self.appvm.__xml__())
+            self.assertEqual(xml1, xml2)
+            mock_props.assert_not_called()
+
+            self.appvm.memory = 1234
+            xml3 = lxml.etree.tostring(self.appvm.__xml__())
+            self.assertEqual(mock_props.call_count, 1)
+            self.assertIn(b'<property name="memory">1234</property>', xml3)
+
+            self.appvm.features["test-feature"] = "1"
+            xml4 = lxml.etree.tostring(self.appvm.__xml__())
+            self.assertEqual(mock_props.call_count, 2)
+            self.assertIn(b'<feature name="test-feature">1</feature>', xml4)
+
+            self.appvm.tags.add("test-tag")
+            xml5 = lxml.etree.tostring(self.appvm.__xml__())
+            self.assertEqual(mock_props.call_count, 3)
+            self.assertIn(b'<tag name="test-tag"/>', xml5)
+
     @qubes.tests.skipUnlessGit
     def test_900_example_xml_in_doc(self):
         path = os.path.join(qubes.tests.in_git, "doc/example.xml")
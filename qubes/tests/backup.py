@@ -17,9 +17,12 @@
 # License along with this library; if not, see <https://www.gnu.org/licenses/>.
 #
 
+import asyncio
+import itertools
 import os
 import shutil
 import tempfile
+import unittest.mock
 
 import qubes.backup
 import qubes.tests
@@ -104,3 +107,155 @@ class TC_00_BackupHeader(qubes.tests.QubesTestCase):
                 qubes.backup.BackupHeader.header_keys.values(),
                 "init parameter {!r} missing from header_keys".format(attr),
             )
+
+
+class TC_10_BackupWorkers(qubes.tests.QubesTestCase):
+    """Tests for concurrent processing of files in qubes.backup.Backup."""
+
+    def setUp(self):
+        super().setUp()
+        with unittest.mock.patch.object(
+            qubes.backup.Backup, "get_files_to_backup", return_value={}
+        ):
+            self.backup = qubes.backup.Backup(unittest.mock.Mock(), [])
+        self.backup.total_backup_bytes = 60
+        self.progress = []
+        self.backup.progress_callback = self.progress.append
+        self.backup.last_progress_time = -1
+        self.wrap_and_send_file = self.fake_wrap_and_send_file
+        self.running = 0
+        self.max_running = 0
+
+    async def fake_wrap_and_send_file(self, file_info, output_queue, progress):
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        try:
+            # later files finish first
+            for i in range(3):
+                await asyncio.sleep(0.01 * (10 - int(file_info.name)))
+                await output_queue.put("{}.{:03}".format(file_info.name, i))
+                progress(file_info.size / 3)
+        finally:
+            self.running -= 1
+
+    def run_backup(self, workers):
+        self.backup.workers = workers
+        vms = [
+            qubes.backup.Backup.VMToBackup(
+                None,
+                [
+                    qubes.backup.Backup.FileToBackup(
+                        str(name), subdir="vm/", name=str(name), size=10
+                    )
+                    for name in names
+                ],
+                "vm/",
+            )
+            for names in ((1, 2), (3,), (), (4, 5, 6))
+        ]
+        queue = asyncio.Queue()
+        with unittest.mock.patch.object(
+            self.backup,
+            "_wrap_and_send_file",
+            self.wrap_and_send_file,
+        ), unittest.mock.patch("time.time", side_effect=itertools.count()):
+            self.loop.run_until_complete(
+                self.backup._wrap_and_send_files(vms, queue)
+            )
+        result = []
+        while not queue.empty():
+            result.append(queue.get_nowait())
+        return result
+
+    def test_000_order(self):
+        expected = [
+            "{}.{:03}".format(name, i) for name in range(1, 7) for i in range(3)
+        ] + [qubes.backup.QUEUE_FINISHED]
+        self.assertEqual(self.run_backup(1), expected)
+        self.assertEqual(self.max_running, 1)
+        self.assertEqual(self.run_backup(3), expected)
+        self.assertEqual(self.max_running, 3)
+
+    def test_010_progress(self):
+        self.run_backup(4)
+        self.assertEqual(self.progress, sorted(self.progress))
+        self.assertAlmostEqual(self.progress[-1], 100)
+        self.assertEqual(self.backup._done_vms_bytes, 60)
+        self.assertAlmostEqual(self.backup._current_vm_bytes, 0)
+        self.assertEqual(self.backup._vm_bytes, {})
+
+    def test_020_error(self):
+        async def failing_wrap_and_send_file(file_info, output_queue, progress):
+            if file_info.name == "3":
+                raise qubes.exc.QubesException("failed")
+            await self.fake_wrap_and_send_file(
+                file_info, output_queue, progress
+            )
+
+        self.wrap_and_send_file = failing_wrap_and_send_file
+        with self.assertRaises(qubes.exc.QubesException):
+            self.run_backup(3)
+        self.assertEqual(self.running, 0)
+
+
+class TC_20_BackupHeaderVersion(qubes.tests.QubesTestCase):
+    """Tests for backup format version written by qubes.backup.Backup."""
+
+    def setUp(self):
+        super().setUp()
+        with unittest.mock.patch.object(
+            qubes.backup.Backup, "get_files_to_backup", return_value={}
+        ):
+            self.backup = qubes.backup.Backup(unittest.mock.Mock(), [])
+        self.backup.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.backup.tmpdir)
+        self.backup.passphrase = b"test"
+
+    def read_version(self):
+        scrypt = unittest.mock.Mock()
+        scrypt.wait = unittest.mock.AsyncMock(return_value=0)
+        with unittest.mock.patch(
+            "qubes.backup.launch_scrypt",
+            unittest.mock.AsyncMock(return_value=scrypt),
+        ):
+            self.loop.run_until_complete(self.backup._prepare_backup_header())
+        path = os.path.join(self.backup.tmpdir, qubes.backup.HEADER_FILENAME)
+        with open(path, "r", encoding="ascii") as header_f:
+            return header_f.readline().strip()
+
+    def test_000_full(self):
+        self.assertEqual(self.read_version(), "version=4")
+
+    def add_volume(self, base_id, extents):
+        volume = unittest.mock.Mock()
+        volume.export_changes.return_value = ("/dev/exported", base_id, extents)
+        file_info = qubes.backup.Backup.FileToBackup(
+            volume.export, "vm1/", "private.img", 0
+        )
+        file_info.volume = volume
+        self.backup._files_to_backup[1] = qubes.backup.Backup.VMToBackup(
+            None, [file_info], "vm1/"
+        )
+        self.loop.run_until_complete(
+            self.backup._export_volumes_changes(self.backup._files_to_backup)
+        )
+        self.assertEqual(file_info.path, "/dev/exported")
+        self.assertEqual(
+            self.backup._volume_exports, [(volume, "/dev/exported")]
+        )
+        return file_info
+
+    def test_010_incremental_full(self):
+        # the first incremental backup has no base to store deltas against
+        self.backup.incremental = True
+        file_info = self.add_volume(None, None)
+        self.assertIsNone(file_info.extents)
+        self.assertEqual(self.read_version(), "version=4")
+
+    def test_011_incremental_delta(self):
+        # older restore tools must reject backups with delta members
+        self.backup.incremental = True
+        file_info = self.add_volume("base-id", [(0, 512)])
+        self.assertEqual(file_info.base_id, "base-id")
+        self.assertEqual(file_info.extents, [(0, 512)])
+        self.assertEqual(self.read_version(), "version=5")
@@ -240,6 +240,7 @@ class TC_00_Block(qubes.tests.QubesTestCase):
         vm.devices["usb"] = TestDeviceCollection(backend_vm=vm, devclass="usb")
         vm.devices["usb"]._exposed.append(parent)
         vm.is_running = lambda: True
+        vm.app.vmm.configure_mock(**{"offline_mode": False})
 
         dom0 = TestVM(
             {}, name="dom0", domain_xml=domain_xml_template.format("")
@@ -281,6 +282,13 @@ class TC_00_Block(qubes.tests.QubesTestCase):
         self.assertEqual(device_info.interfaces, [DeviceInterface("b******")])
         self.assertEqual(device_info.parent_device, parent)
         self.assertEqual(device_info.attachment, front)
+        self.assertIs(
+            qubes.ext.block.BlockDeviceExtension.get_instance(), self.ext
+        )
+        # looked up in the index, not in libvirt XML again
+        front.libvirt_domain.XMLDesc.reset_mock()
+        self.assertEqual(device_info.attachment, front)
+        front.libvirt_domain.XMLDesc.assert_not_called()
         self.assertEqual(device_info.device_id, "0000:0000::?******:1.0")
         self.assertEqual(
             device_info.data.get("test_frontend_domain", None), None
@@ -1349,3 +1357,131 @@ class TC_00_Block(qubes.tests.QubesTestCase):
         )
         self.ext.detach_and_notify.assert_called_once_with(front, exp_dev.port)
         self.assertEqual(self.ext.devices_cache, {"sys-usb": {}})
+
+    def test_100_attachment_index(self):
+        disk = """
+            <disk type="block" device="disk">
+                <driver name="phy" />
+                <source dev="/dev/sda" />
+                <target dev="xvdi" />
+                <readonly />
+                <backenddomain name="sys-usb" />
+            </disk>
+            """
+        back = TestVM(
+            name="sys-usb",
+            qdb=get_qdb(mode="r"),
+            domain_xml=domain_xml_template.format(""),
+        )
+        front = TestVM(
+            {}, domain_xml=domain_xml_template.format(disk), name="front-vm"
+        )
+        back.app.domains["sys-usb"] = back
+        back.app.domains["front-vm"] = front
+        back.app.domains[0] = TestVM(
+            {}, name="dom0", domain_xml=domain_xml_template.format("")
+        )
+        front.app = back.app
+        back.app.vmm.configure_mock(**{"offline_mode": False})
+
+        for _ in range(2):
+            self.assertEqual(
+                self.ext.get_device_attachments(back), {"sda": front}
+            )
+            devices = list(self.ext.on_device_list_attached(front, ""))
+            self.assertEqual(len(devices), 1)
+            self.assertEqual(devices[0][0].port_id, "sda")
+        # XML parsed only once
+        self.assertEqual(front.libvirt_domain.XMLDesc.call_count, 1)
+        self.assertEqual(back.libvirt_domain.XMLDesc.call_count, 1)
+
+        # detach updates the index
+        front.libvirt_domain.XMLDesc.return_value = domain_xml_template.format(
+            ""
+        )
+        self.ext.on_device_pre_detached_block(
+            front, "", Port(back, "sda", "block")
+        )
+        front.libvirt_domain.detachDevice.assert_called_once()
+        self.assertEqual(self.ext.get_device_attachments(back), {})
+
+        # changes outside of qubesd are found only on resync
+        front.libvirt_domain.XMLDesc.return_value = domain_xml_template.format(
+            disk
+        )
+        self.assertEqual(self.ext.get_device_attachments(back), {})
+        self.ext.resync_attachments(back.app)
+        self.assertEqual(self.ext.get_device_attachments(back), {"sda": front})
+
+        # frontend stopped
+        self.ext.on_domain_start_failed(front, "domain-start-failed")
+        self.assertEqual(self.ext.get_device_attachments(back), {})
+
+    def test_110_on_qdb_watch_coalesced(self):
+        back, _front = self.added_assign_setup()
+        loop = asyncio.get_event_loop()
+        with mock.patch.object(
+            self.ext, "on_qdb_change"
+        ) as on_qdb_change, mock.patch(
+            "qubes.ext.utils.DEVICE_LIST_CHANGE_DELAY", 0.01
+        ):
+            for _ in range(3):
+                self.ext.on_qdb_watch(
+                    back, "domain-qdb-change:/qubes-block-devices", "path"
+                )
+            on_qdb_change.assert_not_called()
+            loop.run_until_complete(asyncio.sleep(0.05))
+            on_qdb_change.assert_called_once_with(
+                back, "domain-qdb-change:/qubes-block-devices", "path"
+            )
+
+            # cancelled on backend shutdown
+            self.ext.on_qdb_watch(
+                back, "domain-qdb-change:/qubes-block-devices", "path"
+            )
+            self.ext.devices_cache = {"sys-usb": {}}
+            loop.run_until_complete(self.ext.on_domain_shutdown(back, None))
+            loop.run_until_complete(asyncio.sleep(0.05))
+            self.assertEqual(on_qdb_change.call_count, 1)
+
+    def test_111_assigned_frontends(self):
+        back, front = self.added_assign_setup()
+
+        exp_dev = qubes.ext.block.BlockDevice(Port(back, "sda", "block"))
+        assign = DeviceAssignment(exp_dev, mode="auto-attach")
+        front.devices["block"]._assigned.append(assign)
+        back.devices["block"]._exposed.append(exp_dev)
+
+        self.assertEqual(self.ext.assigned_frontends.get(back), [front])
+        self.assertEqual(self.ext.assigned_frontends.get(front), [])
+
+        front.devices["block"]._assigned.remove(assign)
+        self.ext.on_device_assign_block(
+            front, "device-unassign:block", device=assign.virtual_device
+        )
+        self.assertEqual(self.ext.assigned_frontends.get(back), [])
+
+        resolver_path = "qubes.ext.utils.resolve_conflicts_and_attach"
+        with mock.patch(resolver_path, new_callable=Mock) as resolver:
+            with mock.patch("asyncio.ensure_future"):
+                self.ext.on_qdb_change(back, None, None)
+            resolver.assert_called_once_with(self.ext, {})
+
+    def test_112_assigned_frontends_remote_vm(self):
+        back, front = self.added_assign_setup()
+        remote = mock.Mock(spec=["name", "klass", "app"])
+        remote.name = "remote-vm"
+        remote.klass = "RemoteVM"
+        remote.app = back.app
+        back.app.domains["remote-vm"] = remote
+
+        exp_dev = qubes.ext.block.BlockDevice(Port(back, "sda", "block"))
+        assign = DeviceAssignment(exp_dev, mode="auto-attach")
+        front.devices["block"]._assigned.append(assign)
+
+        self.assertEqual(self.ext.assigned_frontends.get(back), [front])
+        # a RemoteVM has no devices, adding it must not fail
+        self.ext.on_domain_add(back.app, "domain-add", vm=remote)
+        self.assertEqual(self.ext.assigned_frontends.get(back), [front])
+        self.ext.on_domain_delete(back.app, "domain-delete", vm=remote)
+        self.assertEqual(self.ext.assigned_frontends.get(back), [front])
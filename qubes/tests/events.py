@@ -186,3 +186,55 @@ class TC_00_Emitter(qubes.tests.QubesTestCase):
         self.assertEqual(testevent_fired[0], 4)
         emitter.fire_event("testevent")
         self.assertEqual(testevent_fired[0], 4)
+
+    def test_007_class_handler_added_later(self):
+        class TestEmitter(qubes.events.Emitter):
+            @qubes.events.handler("testevent")
+            def on_testevent_1(self, event):
+                yield "testevent_1"
+
+        def on_testevent_2(subject, event):
+            yield "testevent_2"
+
+        emitter = TestEmitter()
+        emitter.events_enabled = True
+        self.assertEqual(emitter.fire_event("testevent"), ["testevent_1"])
+
+        TestEmitter.__handlers__["testevent"].add(on_testevent_2)
+        self.assertEqual(
+            emitter.fire_event("testevent"), ["testevent_1", "testevent_2"]
+        )
+
+        TestEmitter.__handlers__["testevent"].remove(on_testevent_2)
+        self.assertEqual(emitter.fire_event("testevent"), ["testevent_1"])
+
+    def test_008_subclass_order(self):
+        class TestEmitter(qubes.events.Emitter):
+            @qubes.events.handler("testevent", "test*")
+            def on_testevent_1(self, event):
+                yield "testevent_1"
+
+        class TestEmitter2(TestEmitter):
+            @qubes.events.handler("testevent")
+            def on_testevent_2(self, event):
+                yield "testevent_2"
+
+        def on_testevent_3(subject, event):
+            yield "testevent_3"
+
+        emitter = TestEmitter2()
+        emitter.events_enabled = True
+        emitter.fire_event("testevent")
+        TestEmitter.__handlers__["test*"].add(on_testevent_3)
+
+        self.assertEqual(
+            emitter.fire_event("testevent"),
+            ["testevent_1", "testevent_1", "testevent_3", "testevent_2"],
+        )
+        self.assertEqual(
+            emitter.fire_event("testevent", pre_event=True),
+            ["testevent_2", "testevent_1", "testevent_1", "testevent_3"],
+        )
+        self.assertEqual(
+            emitter.fire_event("test2"), ["testevent_1", "testevent_3"]
+        )
@@ -2730,6 +2730,54 @@ class TC_50_Admin(qubes.tests.QubesTestCase):
                 tag,
             )
 
+    def test_010_policy_decisions_cached(self):
+        vm = mock.Mock(klass="AppVM")
+        vm.name = "test-vm1"
+        subject = mock.Mock()
+        subject.name = "test-vm2"
+        policy = mock.Mock()
+        policy.evaluate.return_value = mock.Mock(
+            spec=qubes.ext.admin.parser.AllowResolution
+        )
+        with mock.patch.object(
+            self.ext.policy_cache, "get_policy", return_value=policy
+        ), mock.patch(
+            "qubes.api.internal.SystemInfoCache.get_system_info",
+            return_value={"domains": {}},
+        ) as mock_system_info:
+            (filter_events,) = self.ext.admin_events(
+                vm, "admin-permission:admin.Events", arg=""
+            )
+            for _ in range(3):
+                self.assertTrue(filter_events((subject, "domain-start", {})))
+            self.assertEqual(policy.evaluate.call_count, 1)
+            self.assertEqual(self.ext.policy_decision_hits, 2)
+            self.assertEqual(self.ext.policy_decision_misses, 1)
+
+            # different event is a different decision
+            self.assertTrue(filter_events((subject, "domain-shutdown", {})))
+            self.assertEqual(policy.evaluate.call_count, 2)
+
+            # system info changed, but not in a way affecting policy
+            mock_system_info.return_value = {"domains": {}}
+            qubes.api.internal.SystemInfoCache.generation += 1
+            self.assertTrue(filter_events((subject, "domain-start", {})))
+            self.assertEqual(policy.evaluate.call_count, 2)
+
+            # system info used by policy changed
+            qubes.api.internal.SystemInfoCache.policy_generation += 1
+            self.assertTrue(filter_events((subject, "domain-start", {})))
+            self.assertEqual(policy.evaluate.call_count, 3)
+
+            # policy reloaded
+            new_policy = mock.Mock()
+            new_policy.evaluate.side_effect = (
+                qubes.ext.admin.parser.AccessDenied("denied")
+            )
+            self.ext.policy_cache.get_policy.return_value = new_policy
+            self.assertFalse(filter_events((subject, "domain-start", {})))
+            new_policy.evaluate.assert_called_once()
+
 
 class TC_60_Audio(qubes.tests.QubesTestCase):
     def setUp(self):
@@ -530,6 +530,49 @@ class TC_30_VMCollection(qubes.tests.QubesTestCase):
             self.app, "domain-delete", kwargs={"vm": self.testvm2}
         )
 
+    def test_009_getitem_uuid(self):
+        self.vms.add(self.testvm1)
+
+        self.assertIs(self.vms[self.testvm1.uuid], self.testvm1)
+        self.assertIn(self.testvm1.uuid, self.vms)
+        with self.assertRaises(KeyError):
+            self.vms[uuid.uuid5(uuid.NAMESPACE_DNS, "no-such-vm")]
+
+    def test_010_index_rename(self):
+        self.vms.add(self.testvm1)
+        self.vms.add(self.testvm2)
+        self.assertEqual(list(self.vms.names()), ["testvm1", "testvm2"])
+        self.assertEqual(list(self.vms), [self.testvm1, self.testvm2])
+
+        self.testvm1.name = "testvm3"
+
+        self.assertIs(self.vms["testvm3"], self.testvm1)
+        self.assertNotIn("testvm1", self.vms)
+        self.assertEqual(list(self.vms), [self.testvm2, self.testvm1])
+
+    def test_011_index_delitem(self):
+        self.vms.add(self.testvm1)
+        self.vms.add(self.testvm2)
+        self.assertEqual(list(self.vms.qids()), [1, 2])
+
+        del self.vms[2]
+
+        self.assertNotIn("testvm2", self.vms)
+        self.assertNotIn(self.testvm2, self.vms)
+        self.assertEqual(list(self.vms.qids()), [1])
+        with self.assertRaises(KeyError):
+            self.vms["testvm2"]
+        # no longer tracked after removal
+        self.testvm2.name = "testvm3"
+        self.assertNotIn("testvm3", self.vms)
+
+    def test_012_index_dict_modified_directly(self):
+        self.vms.add(self.testvm1)
+        self.vms._dict[2] = self.testvm2
+
+        self.assertIs(self.vms["testvm2"], self.testvm2)
+        self.assertIn(self.testvm2, self.vms)
+
     def test_100_get_new_unused_qid(self):
         self.vms.add(self.testvm1)
         self.vms.add(self.testvm2)
@@ -16,8 +16,16 @@
 #
 # You should have received a copy of the GNU General Public
 # License along with this library; if not, see <https://www.gnu.org/licenses/>.
+import importlib
+import io
+import os
+import socket
+import sys
+import tempfile
+import threading
 import unittest.mock
 
+import qubes.qmemman.client
 import qubes.qmemman.domainstate
 import qubes.qmemman.algo
 
@@ -45,6 +53,27 @@ def construct_dominfo(
     return dom
 
 
+def import_without_xen(testcase, name):
+    """Import module *name*, with Xen Python bindings mocked if missing"""
+    modules = {}
+    try:
+        # pylint: disable=import-error,unused-import
+        import xen.lowlevel.xc
+        import xen.lowlevel.xs
+    except ImportError:
+        xen = unittest.mock.MagicMock()
+        modules = {
+            "xen": xen,
+            "xen.lowlevel": xen.lowlevel,
+            "xen.lowlevel.xc": xen.lowlevel.xc,
+            "xen.lowlevel.xs": xen.lowlevel.xs,
+        }
+    patch = unittest.mock.patch.dict(sys.modules, modules)
+    patch.start()
+    testcase.addCleanup(patch.stop)
+    return importlib.import_module(name)
+
+
 class TC_00_Qmemman_algo(qubes.tests.QubesTestCase):
     def test_000_meminfo(self):
         self.assertEqual(
@@ -315,3 +344,722 @@ class TC_00_Qmemman_algo(qubes.tests.QubesTestCase):
                 ("5", 697932185),
             ],
         )
+
+    def test_300_waterfill(self):
+        # domain 0 gets capped first, then the rest is split 1:3
+        targets = qubes.qmemman.algo.waterfill(
+            [100, 100, 300], [150, 1000, 1000], 750
+        )
+        self.assertEqual(targets, [150, 150, 450])
+        # everything capped
+        targets = qubes.qmemman.algo.waterfill([100, 100], [150, 200], 1000)
+        self.assertEqual(targets, [150, 200])
+
+    def test_310_balance_waterfill_enough_mem(self):
+        domains = {
+            "0": construct_dominfo(
+                "0",
+                mem_used=int(1024 * MB),
+                mem_max=int(4096 * MB),
+                mem_actual=int(1736 * MB),
+            ),
+            # at maxmem
+            "2": construct_dominfo(
+                "2",
+                mem_used=int(4096 * MB),
+                mem_max=int(4096 * MB),
+                mem_actual=int(4096 * MB),
+            ),
+            # no meminfo at all
+            "3": construct_dominfo(
+                "3",
+                mem_used=None,
+                mem_max=int(4096 * MB),
+                mem_actual=int(4096 * MB),
+            ),
+            "4": construct_dominfo(
+                "4",
+                mem_used=int(1536 * MB),
+                mem_max=int(4096 * MB),
+                mem_actual=int(1536 * MB),
+            ),
+            # low maxmem
+            "5": construct_dominfo(
+                "5",
+                mem_used=int(512 * MB),
+                mem_max=int(1024 * MB),
+                mem_actual=int(768 * MB),
+            ),
+        }
+        result = qubes.qmemman.algo.balance_waterfill(int(4096 * MB), domains)
+        total_allocated = sum(l[1] - domains[l[0]].mem_actual for l in result)
+        self.assertLessEqual(total_allocated, int(4096 * MB))
+        # up to 0.1% of memory is left for rounding errors
+        self.assertGreater(total_allocated, int(4080 * MB))
+        # no meminfo -> no adjustment
+        self.assertNotIn(("3", unittest.mock.ANY), result)
+        result = dict(result)
+        self.assertEqual(result["2"], domains["2"].mem_actual)
+        self.assertEqual(result["5"], domains["5"].mem_max)
+        # the rest is split proportionally to pref_mem
+        self.assertAlmostEqual(
+            result["4"] / result["0"],
+            qubes.qmemman.algo.pref_mem(domains["4"])
+            / qubes.qmemman.algo.pref_mem(domains["0"]),
+            places=5,
+        )
+
+    def test_320_balance_waterfill_low_on_mem(self):
+        domains = {
+            # below pref_mem
+            "0": construct_dominfo(
+                "0",
+                mem_used=int(1024 * MB),
+                mem_max=int(4096 * MB),
+                mem_actual=int(768 * MB),
+            ),
+            "1": construct_dominfo(
+                "1",
+                mem_used=int(1024 * MB),
+                mem_max=int(4096 * MB),
+                mem_actual=int(1536 * MB),
+            ),
+            # at maxmem
+            "2": construct_dominfo(
+                "2",
+                mem_used=int(4096 * MB),
+                mem_max=int(4096 * MB),
+                mem_actual=int(4096 * MB),
+            ),
+            # low maxmem
+            "5": construct_dominfo(
+                "5",
+                mem_used=int(512 * MB),
+                mem_max=int(1024 * MB),
+                mem_actual=int(768 * MB),
+            ),
+        }
+        # same as the iterative implementation
+        self.assertEqual(
+            qubes.qmemman.algo.balance_waterfill(int(50 * MB), domains),
+            qubes.qmemman.algo.balance(int(50 * MB), domains),
+        )
+        with unittest.mock.patch(
+            "qubes.qmemman.algo.BALANCE_ALGORITHM", "waterfill"
+        ), unittest.mock.patch(
+            "qubes.qmemman.algo.balance_waterfill"
+        ) as balance_waterfill:
+            qubes.qmemman.algo.balance(int(50 * MB), domains)
+            balance_waterfill.assert_called_once_with(int(50 * MB), domains)
+
+
+class TC_10_QMemmanConnection(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super().setUp()
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.sock_path = os.path.join(tmpdir.name, "qmemman.sock")
+        self.server = socket.socket(socket.AF_UNIX)
+        self.server.bind(self.sock_path)
+        self.server.listen(1)
+        self.addCleanup(self.server.close)
+        self.conn = None
+        self.connection = qubes.qmemman.client.QMemmanConnection(self.sock_path)
+        self.addCleanup(self.connection.close)
+
+    def accept(self):
+        self.conn, _ = self.server.accept()
+        self.addCleanup(self.conn.close)
+        return self.conn.makefile("rwb", buffering=0)
+
+    def call_in_thread(self, func, *args):
+        result = []
+        thread = threading.Thread(target=lambda: result.append(func(*args)))
+        thread.start()
+        return thread, result
+
+    def test_000_request_mem(self):
+        thread, result = self.call_in_thread(
+            self.connection.request_mem, 1024 * MB
+        )
+        server = self.accept()
+        self.assertEqual(server.readline(), b"0 reserve 1073741824\n")
+        server.write(b"0 OK\n")
+        thread.join(5)
+        reservation = result[0]
+        self.assertEqual(reservation.req_id, "0")
+        reservation.close()
+        self.assertEqual(server.readline(), b"1 release 0\n")
+
+    def test_001_request_mem_fail(self):
+        thread, result = self.call_in_thread(
+            self.connection.request_mem, 1024 * MB, 30
+        )
+        server = self.accept()
+        self.assertEqual(server.readline(), b"0 reserve 1073741824 30\n")
+        server.write(b"0 FAIL\n")
+        thread.join(5)
+        self.assertEqual(result, [None])
+
+    def test_002_concurrent(self):
+        thread1, result1 = self.call_in_thread(
+            self.connection.request_mem, 1024 * MB
+        )
+        server = self.accept()
+        self.assertEqual(server.readline(), b"0 reserve 1073741824\n")
+        thread2, result2 = self.call_in_thread(
+            self.connection.set_mem, {"3": 400 * MB}
+        )
+        self.assertEqual(server.readline(), b"1 set_mem 3:419430400\n")
+        # second request completes first
+        server.write(b"1 OK\n")
+        thread2.join(5)
+        self.assertEqual(result2, [True])
+        self.assertTrue(thread1.is_alive())
+        server.write(b"0 OK\n")
+        thread1.join(5)
+        self.assertEqual(result1[0].req_id, "0")
+
+    def test_003_connection_lost(self):
+        result = []
+
+        def request():
+            try:
+                self.connection.request_mem(1024 * MB)
+            except IOError as e:
+                result.append(e)
+
+        thread = threading.Thread(target=request)
+        thread.start()
+        server = self.accept()
+        server.readline()
+        server.close()
+        self.conn.close()
+        thread.join(5)
+        self.assertIsInstance(result[0], IOError)
+        # reconnects on next request
+        thread, result = self.call_in_thread(self.connection.set_mem, {"3": 0})
+        server = self.accept()
+        self.assertEqual(server.readline(), b"1 set_mem 3:0\n")
+        server.write(b"1 OK\n")
+        thread.join(5)
+        self.assertEqual(result, [True])
+
+
+class TC_20_SystemState(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.systemstate = import_without_xen(self, "qubes.qmemman.systemstate")
+        self.system_state = self.systemstate.SystemState()
+        self.system_state.xc = unittest.mock.Mock()
+        self.system_state.xs = unittest.mock.Mock()
+        self.system_state.xc.domain_getinfo.return_value = [
+            {"domid": 0, "mem_kb": 1024 * 1024},
+            {"domid": 1, "mem_kb": 512 * 1024},
+        ]
+        self.xenstore = {
+            "/local/domain/0/memory/static-max": "4194304",
+            "/local/domain/1/memory/hotplug-max": "2097152",
+            "/local/domain/1/memory/static-max": "524288",
+        }
+        self.system_state.xs.read.side_effect = (
+            lambda trans, path: self.xenstore.get(path)
+        )
+        self.system_state.add_domain("0")
+        self.system_state.add_domain("1")
+
+    def assertLimitsRead(self, domids):
+        trans = self.system_state.xs.transaction_start.return_value
+        expected = []
+        for domid in domids:
+            expected.extend(
+                [
+                    unittest.mock.call(
+                        trans,
+                        "/local/domain/{}/memory/hotplug-max".format(domid),
+                    ),
+                    unittest.mock.call(
+                        trans,
+                        "/local/domain/{}/memory/static-max".format(domid),
+                    ),
+                ]
+            )
+        self.assertEqual(self.system_state.xs.read.mock_calls, expected)
+        if domids:
+            self.system_state.xs.transaction_start.assert_called_once_with()
+            self.system_state.xs.transaction_end.assert_called_once_with(
+                trans, True
+            )
+        else:
+            self.system_state.xs.transaction_start.assert_not_called()
+            self.system_state.xs.transaction_end.assert_not_called()
+        self.system_state.xs.reset_mock()
+
+    def test_000_refresh_mem_max_initial(self):
+        self.system_state.xs.reset_mock()
+        self.system_state.refresh_mem_actual()
+        self.assertLimitsRead(["0", "1"])
+        dom0 = self.system_state.dom_dict["0"]
+        dom1 = self.system_state.dom_dict["1"]
+        self.assertEqual(dom0.mem_max, 4096 * MB)
+        self.assertFalse(dom0.use_hotplug)
+        self.assertFalse(dom0.mem_max_stale)
+        self.assertEqual(dom1.mem_max, 2048 * MB)
+        self.assertTrue(dom1.use_hotplug)
+        self.assertFalse(dom1.mem_max_stale)
+        self.assertEqual(dom1.mem_actual, 512 * MB)
+
+    def test_001_refresh_mem_max_cached(self):
+        self.system_state.refresh_mem_actual()
+        self.system_state.xs.reset_mock()
+        self.system_state.refresh_mem_actual()
+        self.assertLimitsRead([])
+        self.assertEqual(self.system_state.dom_dict["1"].mem_max, 2048 * MB)
+
+    def test_002_refresh_mem_max_stale(self):
+        self.system_state.refresh_mem_actual()
+        self.system_state.xs.reset_mock()
+        del self.xenstore["/local/domain/1/memory/hotplug-max"]
+        self.system_state.invalidate_mem_max("1")
+        self.assertTrue(self.system_state.dom_dict["1"].mem_max_stale)
+        self.system_state.refresh_mem_actual()
+        self.assertLimitsRead(["1"])
+        self.assertEqual(self.system_state.dom_dict["1"].mem_max, 512 * MB)
+        self.assertFalse(self.system_state.dom_dict["1"].use_hotplug)
+
+    def test_003_refresh_mem_max_fresh(self):
+        self.system_state.refresh_mem_actual()
+        self.system_state.xs.reset_mock()
+        self.system_state.refresh_mem_actual(fresh=True)
+        self.assertLimitsRead(["0", "1"])
+        self.system_state.refresh_mem_actual(domid_list=["1"], fresh=True)
+        self.assertLimitsRead(["1"])
+
+    def test_004_refresh_mem_max_aborts_transaction_on_error(self):
+        self.system_state.xs.reset_mock()
+        self.xenstore["/local/domain/1/memory/hotplug-max"] = "invalid"
+        with self.assertRaises(ValueError):
+            self.system_state.refresh_mem_actual()
+        self.system_state.xs.transaction_end.assert_called_once_with(
+            self.system_state.xs.transaction_start.return_value, True
+        )
+        self.assertTrue(self.system_state.dom_dict["1"].mem_max_stale)
+
+    def test_010_invalidate_mem_max_unknown_domain(self):
+        self.system_state.invalidate_mem_max("2")
+        self.assertNotIn("2", self.system_state.dom_dict)
+
+    def test_020_get_headroom(self):
+        self.system_state.dom_dict = {
+            "1": construct_dominfo(
+                "1", mem_used=1000 * MB, mem_actual=1300 * MB, mem_max=4000 * MB
+            ),
+        }
+        self.assertEqual(self.system_state.get_headroom(550 * MB), 0)
+        self.system_state.headroom_mem = 200 * MB
+        self.assertEqual(self.system_state.get_headroom(550 * MB), 200 * MB)
+        # limited to what is available above preferred memory of domains
+        self.system_state.headroom_mem = 800 * MB
+        self.assertEqual(self.system_state.get_headroom(550 * MB), 500 * MB)
+        self.assertEqual(self.system_state.get_headroom(30 * MB), 0)
+
+    def test_021_do_balance_headroom(self):
+        self.system_state.dom_dict = {
+            "1": construct_dominfo(
+                "1", mem_used=1000 * MB, mem_actual=1300 * MB, mem_max=4000 * MB
+            ),
+        }
+        self.system_state.headroom_mem = 200 * MB
+        xenfree = 550 * MB
+        with unittest.mock.patch.object(
+            self.system_state, "refresh_mem_actual"
+        ), unittest.mock.patch.object(
+            self.system_state, "get_free_xen_mem", return_value=xenfree
+        ), unittest.mock.patch.object(
+            self.system_state, "is_balance_req_significant", return_value=False
+        ) as significant, unittest.mock.patch(
+            "os.path.isfile", return_value=False
+        ), unittest.mock.patch.object(
+            self.systemstate.qubes.qmemman.algo, "balance", return_value=[]
+        ) as balance:
+            self.system_state.do_balance()
+        balance.assert_called_once_with(
+            xenfree - self.systemstate.XEN_FREE_MEM_LEFT - 200 * MB,
+            self.system_state.dom_dict,
+        )
+        significant.assert_called_once_with([], xenfree - 200 * MB)
+
+    def test_022_do_balance_reserved_mem(self):
+        self.system_state.reserved_mem = 400 * MB
+        with unittest.mock.patch.object(
+            self.system_state, "refresh_mem_actual"
+        ) as refresh, unittest.mock.patch(
+            "os.path.isfile", return_value=False
+        ), unittest.mock.patch.object(
+            self.systemstate.qubes.qmemman.algo, "balance"
+        ) as balance:
+            self.system_state.do_balance()
+        refresh.assert_not_called()
+        balance.assert_not_called()
+
+
+class TC_30_XSWatcher(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.qmemmand = import_without_xen(self, "qubes.tools.qmemmand")
+        self.system_state = (
+            self.qmemmand.qubes.qmemman.systemstate.SystemState()
+        )
+        self.system_state.xs = unittest.mock.Mock()
+        self.system_state.xs.read.return_value = None
+        patch = unittest.mock.patch.object(
+            self.qmemmand, "system_state", self.system_state
+        )
+        patch.start()
+        self.addCleanup(patch.stop)
+        patch = unittest.mock.patch.object(self.qmemmand.xen.lowlevel.xs, "xs")
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.watcher = self.qmemmand.XSWatcher()
+        self.handle = self.watcher.handle
+        self.domains = ["0", "1"]
+        self.handle.ls.side_effect = lambda trans, path: list(self.domains)
+        self.handle.read.return_value = "domid"
+
+    def mem_max_calls(self, method, domid, watch):
+        return [
+            getattr(unittest.mock.call, method)(
+                "/local/domain/{}/memory/hotplug-max".format(domid), watch
+            ),
+            getattr(unittest.mock.call, method)(
+                "/local/domain/{}/memory/static-max".format(domid), watch
+            ),
+        ]
+
+    def test_000_watch_mem_max(self):
+        self.handle.reset_mock()
+        self.watcher.domain_list_changed(refresh_only=True)
+        self.assertEqual(set(self.system_state.dom_dict), {"0", "1"})
+        for domid in self.domains:
+            watch = self.watcher.mem_max_watch_token_dict[domid]
+            self.assertEqual(watch.param, domid)
+            for call in self.mem_max_calls("watch", domid, watch):
+                self.assertIn(call, self.handle.mock_calls)
+
+    def test_001_mem_max_changed(self):
+        self.watcher.domain_list_changed(refresh_only=True)
+        for dom in self.system_state.dom_dict.values():
+            dom.mem_max_stale = False
+        watch = self.watcher.mem_max_watch_token_dict["1"]
+        watch.func(self.watcher, watch.param)
+        self.assertFalse(self.system_state.dom_dict["0"].mem_max_stale)
+        self.assertTrue(self.system_state.dom_dict["1"].mem_max_stale)
+
+    def test_002_unwatch_mem_max(self):
+        self.watcher.domain_list_changed(refresh_only=True)
+        watch = self.watcher.mem_max_watch_token_dict["1"]
+        self.handle.reset_mock()
+        self.domains.remove("1")
+        self.watcher.domain_list_changed(refresh_only=True)
+        self.assertEqual(set(self.system_state.dom_dict), {"0"})
+        self.assertNotIn("1", self.watcher.mem_max_watch_token_dict)
+        for call in self.mem_max_calls("unwatch", "1", watch):
+            self.assertIn(call, self.handle.mock_calls)
+        self.assertNotIn(
+            unittest.mock.call.unwatch(
+                "/local/domain/0/memory/static-max", unittest.mock.ANY
+            ),
+            self.handle.mock_calls,
+        )
+
+
+class TC_40_BalloonScheduler(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.scheduler_mod = import_without_xen(self, "qubes.qmemman.scheduler")
+        self.state = unittest.mock.Mock()
+        self.state.reserved_mem = 0
+        self.state.balloon_in_progress = False
+        self.state.dom_dict = {
+            "1": construct_dominfo("1", mem_actual=1000 * MB),
+        }
+        self.xenfree = []
+        self.state.get_free_xen_mem.side_effect = lambda: self.xenfree.pop(0)
+        self.scheduler = self.scheduler_mod.BalloonScheduler(
+            self.state, threading.Lock()
+        )
+        patch = unittest.mock.patch.object(self.scheduler_mod.time, "sleep")
+        patch.start()
+        self.addCleanup(patch.stop)
+        patch = unittest.mock.patch.object(
+            self.scheduler_mod.qubes.qmemman.algo,
+            "balloon",
+            return_value=[("1", 500 * MB)],
+        )
+        self.balloon = patch.start()
+        self.addCleanup(patch.stop)
+
+    def add_requests(self, *sizes):
+        requests = [self.scheduler_mod.BalloonRequest(size) for size in sizes]
+        self.scheduler._pending.extend(requests)
+        return requests
+
+    def test_000_coalesce(self):
+        requests = self.add_requests(100 * MB, 200 * MB)
+        self.xenfree = [50 * MB, 400 * MB]
+        self.scheduler.balloon()
+        # one balloon target for both requests
+        self.balloon.assert_called_once_with(
+            300 * MB + self.scheduler_mod.XEN_FREE_MEM_LEFT - 50 * MB,
+            self.state.dom_dict,
+        )
+        self.state.mem_set.assert_called_once_with("1", 500 * MB)
+        self.assertEqual([req.result for req in requests], [True, True])
+        self.assertEqual(self.state.reserved_mem, 300 * MB)
+        self.state.inhibit_balloon_up.assert_called_once_with()
+        self.assertFalse(self.scheduler._pending)
+        self.assertFalse(self.state.balloon_in_progress)
+
+    def test_001_fifo(self):
+        requests = self.add_requests(300 * MB, 50 * MB)
+        finished = []
+
+        def get_free_xen_mem():
+            finished.append([req.done.is_set() for req in requests])
+            return xenfree.pop(0)
+
+        # the second request would fit in the first iteration already, but
+        # is granted only after the first one
+        xenfree = [200 * MB, 350 * MB, 100 * MB]
+        self.state.get_free_xen_mem.side_effect = get_free_xen_mem
+        self.scheduler.balloon()
+        self.assertEqual(
+            finished, [[False, False], [False, False], [True, False]]
+        )
+        self.assertEqual([req.result for req in requests], [True, True])
+        self.assertEqual(self.state.reserved_mem, 350 * MB)
+
+    def test_002_no_progress(self):
+        requests = self.add_requests(500 * MB, 100 * MB)
+        self.state.get_free_xen_mem.side_effect = None
+        self.state.get_free_xen_mem.return_value = 50 * MB
+        self.scheduler.balloon()
+        self.assertEqual([req.result for req in requests], [False, False])
+        self.assertEqual(
+            self.state.get_free_xen_mem.call_count,
+            self.scheduler_mod.CHECK_PERIOD + 1,
+        )
+        self.assertTrue(self.state.dom_dict["1"].no_progress)
+        self.assertEqual(self.state.reserved_mem, 0)
+        self.assertFalse(self.scheduler._pending)
+        self.assertFalse(self.state.balloon_in_progress)
+
+    def test_003_no_donors(self):
+        requests = self.add_requests(500 * MB)
+        self.xenfree = [50 * MB]
+        self.balloon.return_value = []
+        self.scheduler.balloon()
+        self.assertEqual([req.result for req in requests], [False])
+        self.state.mem_set.assert_not_called()
+
+    def test_004_request_release(self):
+        thread = threading.Thread(target=self.scheduler.run, daemon=True)
+        thread.start()
+        self.xenfree = [400 * MB]
+        self.assertTrue(self.scheduler.request(100 * MB))
+        self.assertEqual(self.state.reserved_mem, 100 * MB)
+        self.scheduler.release(100 * MB)
+        self.assertEqual(self.state.reserved_mem, 0)
+
+
+class TC_41_Reservations(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super().setUp()
+        scheduler_mod = import_without_xen(self, "qubes.qmemman.scheduler")
+        self.scheduler = unittest.mock.Mock()
+        self.scheduler.request.return_value = True
+        self.callback = unittest.mock.Mock()
+        self.reservations = scheduler_mod.Reservations(
+            self.scheduler, self.callback
+        )
+
+    def test_000_reserve_release(self):
+        self.assertTrue(self.reservations.reserve("1", 100 * MB))
+        self.scheduler.request.assert_called_once_with(100 * MB)
+        self.assertTrue(self.reservations.release("1"))
+        self.scheduler.release.assert_called_once_with(100 * MB)
+        self.callback.assert_called_once_with()
+        self.assertFalse(self.reservations.release("1"))
+        self.scheduler.release.assert_called_once_with(100 * MB)
+
+    def test_001_duplicate(self):
+        self.assertTrue(self.reservations.reserve("1", 100 * MB))
+        self.assertFalse(self.reservations.reserve("1", 200 * MB))
+        self.scheduler.request.assert_called_once_with(100 * MB)
+        # the original reservation is kept
+        self.assertTrue(self.reservations.release("1"))
+        self.scheduler.release.assert_called_once_with(100 * MB)
+
+    def test_002_duplicate_pending(self):
+        granted = threading.Event()
+        self.scheduler.request.side_effect = lambda size: granted.wait(5)
+        thread = threading.Thread(
+            target=self.reservations.reserve, args=("1", 100 * MB)
+        )
+        thread.start()
+        try:
+            for _ in range(50):
+                if self.scheduler.request.called:
+                    break
+                threading.Event().wait(0.01)
+            self.assertFalse(self.reservations.reserve("1", 200 * MB))
+            # not granted yet, nothing to release
+            self.assertFalse(self.reservations.release("1"))
+        finally:
+            granted.set()
+            thread.join(5)
+        self.assertTrue(self.reservations.release("1"))
+
+    def test_003_failed(self):
+        self.scheduler.request.return_value = False
+        self.assertFalse(self.reservations.reserve("1", 100 * MB))
+        self.assertFalse(self.reservations.release("1"))
+        self.scheduler.release.assert_not_called()
+        # the key can be used again
+        self.scheduler.request.return_value = True
+        self.assertTrue(self.reservations.reserve("1", 100 * MB))
+
+    def test_004_timeout(self):
+        released = threading.Event()
+        self.callback.side_effect = released.set
+        self.assertTrue(self.reservations.reserve("1", 100 * MB, 0.01))
+        self.assertTrue(released.wait(5))
+        self.scheduler.release.assert_called_once_with(100 * MB)
+        self.assertFalse(self.reservations.release("1"))
+
+
+class TC_42_QMemmanReqHandler(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.qmemmand = import_without_xen(self, "qubes.tools.qmemmand")
+        for name in ("scheduler", "reservations", "system_state"):
+            patch = unittest.mock.patch.object(self.qmemmand, name)
+            patch.start()
+            self.addCleanup(patch.stop)
+        patch = unittest.mock.patch.object(
+            self.qmemmand, "force_refresh_domain_list", False
+        )
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.handler = self.qmemmand.QMemmanReqHandler.__new__(
+            self.qmemmand.QMemmanReqHandler
+        )
+        self.handler.log = unittest.mock.Mock()
+        self.handler.request = unittest.mock.Mock()
+
+    def handle(self, data):
+        self.handler.rfile = io.BytesIO(data)
+        self.handler.handle()
+
+    def test_000_legacy_release_on_disconnect(self):
+        self.qmemmand.scheduler.request.return_value = True
+        self.handle(b"1048576\n")
+        self.qmemmand.scheduler.request.assert_called_once_with(1048576)
+        self.handler.request.send.assert_called_once_with(b"OK\n")
+        self.qmemmand.scheduler.release.assert_called_once_with(1048576)
+        self.assertTrue(self.qmemmand.force_refresh_domain_list)
+
+    def test_001_legacy_fail(self):
+        self.qmemmand.scheduler.request.return_value = False
+        self.handle(b"1048576\n")
+        self.handler.request.send.assert_called_once_with(b"FAIL\n")
+        self.qmemmand.scheduler.release.assert_not_called()
+        self.assertFalse(self.qmemmand.force_refresh_domain_list)
+
+    def test_002_legacy_release_on_connection_error(self):
+        self.qmemmand.scheduler.request.return_value = True
+        self.handler.request.send.side_effect = BrokenPipeError
+        self.handle(b"1048576\n")
+        self.qmemmand.scheduler.release.assert_called_once_with(1048576)
+
+    def command(self, *args):
+        self.handler.handle_command(threading.Lock(), "7", list(args))
+        self.handler.request.sendall.assert_called_once()
+        response = self.handler.request.sendall.call_args[0][0]
+        self.handler.request.sendall.reset_mock()
+        return response
+
+    def test_010_command_reserve(self):
+        self.qmemmand.reservations.reserve.return_value = True
+        self.assertEqual(self.command("reserve", "1048576"), b"7 OK\n")
+        self.qmemmand.reservations.reserve.assert_called_once_with(
+            "7", 1048576, None
+        )
+        self.qmemmand.reservations.reserve.return_value = False
+        self.assertEqual(self.command("reserve", "1048576", "2.5"), b"7 FAIL\n")
+        self.qmemmand.reservations.reserve.assert_called_with("7", 1048576, 2.5)
+
+    def test_011_command_release(self):
+        self.qmemmand.reservations.release.return_value = True
+        self.assertEqual(self.command("release", "3"), b"7 OK\n")
+        self.qmemmand.reservations.release.assert_called_once_with("3")
+        self.qmemmand.reservations.release.return_value = False
+        self.assertEqual(self.command("release", "3"), b"7 FAIL\n")
+
+    def test_012_command_set_mem(self):
+        self.qmemmand.system_state.do_balloon_dom.return_value = True
+        self.assertEqual(
+            self.command("set_mem", "1:1048576", "2:2097152"), b"7 OK\n"
+        )
+        self.qmemmand.system_state.do_balloon_dom.assert_called_once_with(
+            {"1": 1048576, "2": 2097152}
+        )
+        self.qmemmand.system_state.do_balloon_dom.return_value = False
+        self.assertEqual(self.command("set_mem", "1:1048576"), b"7 FAIL\n")
+
+    def test_013_command_invalid(self):
+        for args in (
+            (),
+            ("unknown",),
+            ("reserve",),
+            ("reserve", "abc"),
+            ("reserve", "1048576", "1", "2"),
+            ("reserve", "1048576", "abc"),
+            ("release",),
+            ("release", "1", "2"),
+            ("set_mem",),
+            ("set_mem", "1"),
+            ("set_mem", "1:abc"),
+            ("headroom", "abc"),
+        ):
+            with self.subTest(args=args):
+                self.assertEqual(self.command(*args), b"7 INVALID_ARG\n")
+        self.qmemmand.reservations.reserve.assert_not_called()
+        self.qmemmand.reservations.release.assert_not_called()
+        self.qmemmand.system_state.do_balloon_dom.assert_not_called()
+
+    def test_014_multiplexed_out_of_order(self):
+        granted = threading.Event()
+        responses = []
+        all_sent = threading.Event()
+
+        def sendall(data):
+            responses.append(data)
+            if len(responses) == 2:
+                all_sent.set()
+
+        self.qmemmand.reservations.reserve.side_effect = (
+            lambda key, size, timeout: granted.wait(5)
+        )
+        self.qmemmand.reservations.release.return_value = True
+        self.handler.request.sendall.side_effect = sendall
+        self.handle(b"1 reserve 1048576\n2 release 0\n")
+        # release is answered while reserve is still waiting
+        for _ in range(500):
+            if responses:
+                break
+            threading.Event().wait(0.01)
+        self.assertEqual(responses, [b"2 OK\n"])
+        granted.set()
+        self.assertTrue(all_sent.wait(5))
+        self.assertEqual(responses, [b"2 OK\n", b"1 OK\n"])
@@ -36,7 +36,18 @@ import asyncio
 import qubes.tests
 import qubes.tests.storage
 import qubes.storage
-from qubes.storage.lvm import ThinPool, ThinVolume, qubes_lvm_coro
+from qubes.storage.lvm import (
+    ThinPool,
+    ThinVolume,
+    cancel_cache_reconcile,
+    qubes_lvm_coro,
+    ensure_cache_coro,
+    reset_cache_coro,
+    schedule_cache_reconcile,
+    _parse_thin_delta,
+    _queue_lvm_command,
+    _update_cache,
+)
 
 if "DEFAULT_LVM_POOL" in os.environ.keys():
     DEFAULT_LVM_POOL = os.environ["DEFAULT_LVM_POOL"]
@@ -1603,3 +1614,326 @@ class TC_02_StorageHelpers(ThinPoolBase):
             self.app.pools.values(), self.thin_dir.name
         )
         self.assertEqual(pool, self.pool)
+
+
+class TC_03_ThinDelta(qubes.tests.QubesTestCase):
+    def test_000_parse(self):
+        output = b"""<superblock uuid="" time="3" transaction="5"
+                data_block_size="128" nr_data_blocks="0">
+          <diff left="1" right="2">
+            <same begin="0" length="2"/>
+            <different begin="2" length="1"/>
+            <right_only begin="3" length="2"/>
+            <same begin="5" length="1"/>
+            <left_only begin="6" length="1"/>
+            <right_only begin="7" length="10"/>
+          </diff>
+        </superblock>"""
+        block = 128 * 512
+        self.assertEqual(
+            _parse_thin_delta(output, 8 * block + 4096),
+            [(2 * block, 3 * block), (6 * block, 2 * block + 4096)],
+        )
+
+    def test_001_parse_empty(self):
+        output = b"""<superblock uuid="" time="3" transaction="5"
+                data_block_size="128" nr_data_blocks="0">
+          <diff left="1" right="2">
+            <same begin="0" length="16"/>
+          </diff>
+        </superblock>"""
+        self.assertEqual(_parse_thin_delta(output, 16 * 128 * 512), [])
+
+
+class TC_04_SizeCache(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.cache = {
+            "vg/pool": {
+                "size": 10 * 2**30,
+                "usage": 2**30,
+                "pool_lv": "",
+                "attr": "twi-aotz--",
+                "origin": "",
+                "metadata_size": 2**20,
+                "metadata_usage": 2**10,
+            },
+            "vg/vm-test-private": {
+                "size": 2**30,
+                "usage": 2**20,
+                "pool_lv": "pool",
+                "attr": "Vwi---tz--",
+                "origin": "",
+                "metadata_size": "",
+                "metadata_usage": None,
+            },
+            "vg2/other": {
+                "size": 2**30,
+                "usage": 0,
+                "pool_lv": "pool",
+                "attr": "Vwi-a-tz--",
+                "origin": "",
+                "metadata_size": "",
+                "metadata_usage": None,
+            },
+        }
+        patch = unittest.mock.patch.dict(
+            "qubes.storage.lvm.size_cache", self.cache, clear=True
+        )
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.cache = qubes.storage.lvm.size_cache
+
+    def test_000_update_create(self):
+        _update_cache(["create", "vg/pool", "vm-test-root", "1024"])
+        self.assertEqual(
+            self.cache["vg/vm-test-root"],
+            {
+                "size": 1024,
+                "usage": 0,
+                "pool_lv": "pool",
+                "attr": "Vwi-a-tz--",
+                "origin": "",
+                "metadata_size": "",
+                "metadata_usage": None,
+            },
+        )
+
+    def test_001_update_clone(self):
+        _update_cache(
+            ["clone", "vg/vm-test-private", "vg/vm-test-private-snap"]
+        )
+        snap = self.cache["vg/vm-test-private-snap"]
+        self.assertEqual(snap["size"], 2**30)
+        self.assertEqual(snap["origin"], "vm-test-private")
+        self.assertEqual(snap["attr"], "Vwi-a-tz--")
+        # origin unchanged
+        self.assertEqual(self.cache["vg/vm-test-private"]["origin"], "")
+
+    def test_002_update_rename_remove(self):
+        entry = self.cache["vg/vm-test-private"]
+        _update_cache(
+            ["rename", "vg/vm-test-private", "vg/vm-test-private-1-back"]
+        )
+        self.assertNotIn("vg/vm-test-private", self.cache)
+        self.assertIs(self.cache["vg/vm-test-private-1-back"], entry)
+        _update_cache(["remove", "vg/vm-test-private-1-back"])
+        self.assertNotIn("vg/vm-test-private-1-back", self.cache)
+        # removing unknown volume is not an error
+        _update_cache(["remove", "vg/vm-test-private-1-back"])
+
+    def test_003_update_resize_activate(self):
+        _update_cache(["resize", "vg/vm-test-private", str(2**31)])
+        _update_cache(["activate", "/dev/vg/vm-test-private"])
+        self.assertEqual(self.cache["vg/vm-test-private"]["size"], 2**31)
+        self.assertEqual(self.cache["vg/vm-test-private"]["attr"], "Vwi-a-tz--")
+
+    def test_010_refresh_volume_group(self):
+        new_cache = {"vg/pool": self.cache["vg/pool"]}
+        with unittest.mock.patch(
+            "qubes.storage.lvm.init_cache_coro", return_value=new_cache
+        ) as mock_init:
+            self.loop.run_until_complete(reset_cache_coro("vg"))
+        mock_init.assert_called_once_with(volume_group="vg")
+        self.assertEqual(set(self.cache), {"vg/pool", "vg2/other"})
+
+    def test_011_refresh_coalesce(self):
+        async def init_cache_coro(volume_group=None):
+            await asyncio.sleep(0.1)
+            return {}
+
+        with unittest.mock.patch(
+            "qubes.storage.lvm.init_cache_coro", side_effect=init_cache_coro
+        ) as mock_init:
+            self.loop.run_until_complete(
+                asyncio.gather(*(reset_cache_coro("vg") for _ in range(5)))
+            )
+        # the first call started immediately, all the others share the
+        # second one
+        self.assertEqual(mock_init.call_count, 2)
+        self.assertEqual(set(self.cache), {"vg2/other"})
+
+    def test_012_refresh_concurrent_update(self):
+        calls = []
+
+        async def init_cache_coro(volume_group=None):
+            calls.append(volume_group)
+            if len(calls) == 1:
+                # operation finished while lvs was running
+                _update_cache(["remove", "vg/vm-test-private"])
+                return dict(self.cache, **{"vg/vm-test-private": {}})
+            return {"vg/pool": self.cache["vg/pool"]}
+
+        with unittest.mock.patch(
+            "qubes.storage.lvm.init_cache_coro", side_effect=init_cache_coro
+        ):
+            self.loop.run_until_complete(reset_cache_coro("vg"))
+        self.assertEqual(calls, ["vg", "vg"])
+        self.assertNotIn("vg/vm-test-private", self.cache)
+
+    def test_013_reconcile_coalesce(self):
+        with unittest.mock.patch(
+            "qubes.storage.lvm._cache_reconcile_delay", 0
+        ), unittest.mock.patch(
+            "qubes.storage.lvm.init_cache_coro", return_value={}
+        ) as mock_init:
+            for _ in range(3):
+                schedule_cache_reconcile("vg")
+            tasks = set(qubes.storage.lvm._cache_reconcile_tasks)
+            self.assertEqual(len(tasks), 1)
+            self.loop.run_until_complete(asyncio.wait(tasks))
+        mock_init.assert_called_once_with(volume_group="vg")
+        self.assertFalse(qubes.storage.lvm._cache_reconcile_tasks)
+        self.assertFalse(qubes.storage.lvm._cache_reconcile_scheduled)
+
+    def test_014_reconcile_cancel(self):
+        with unittest.mock.patch(
+            "qubes.storage.lvm.init_cache_coro", return_value={}
+        ) as mock_init:
+            schedule_cache_reconcile("vg")
+            tasks = set(qubes.storage.lvm._cache_reconcile_tasks)
+            cancel_cache_reconcile()
+            self.loop.run_until_complete(asyncio.wait(tasks))
+        mock_init.assert_not_called()
+        self.assertTrue(all(task.cancelled() for task in tasks))
+        self.assertFalse(qubes.storage.lvm._cache_reconcile_tasks)
+        self.assertFalse(qubes.storage.lvm._cache_reconcile_scheduled)
+
+    def test_020_ensure_loaded_once(self):
+        async def init_cache_coro(volume_group=None):
+            await asyncio.sleep(0.1)
+            return {"vg/pool": {}}
+
+        with unittest.mock.patch(
+            "qubes.storage.lvm.size_cache", {}
+        ), unittest.mock.patch(
+            "qubes.storage.lvm.size_cache_time", 0
+        ), unittest.mock.patch(
+            "qubes.storage.lvm.init_cache_coro", side_effect=init_cache_coro
+        ) as mock_init:
+            self.loop.run_until_complete(
+                asyncio.gather(*(ensure_cache_coro() for _ in range(5)))
+            )
+            self.assertEqual(qubes.storage.lvm.size_cache, {"vg/pool": {}})
+            self.loop.run_until_complete(ensure_cache_coro())
+        mock_init.assert_called_once_with(volume_group=None)
+
+    def test_021_load_on_pool_init_and_setup(self):
+        async def init_cache_coro(volume_group=None):
+            await asyncio.sleep(0.1)
+            return {"vg/pool": {"attr": "twi-aotz--"}}
+
+        async def init_pool():
+            return ThinPool(name="test", volume_group="vg", thin_pool="pool")
+
+        with unittest.mock.patch(
+            "qubes.storage.lvm.size_cache", {}
+        ), unittest.mock.patch(
+            "qubes.storage.lvm.size_cache_time", 0
+        ), unittest.mock.patch(
+            "qubes.storage.lvm.init_cache_coro", side_effect=init_cache_coro
+        ) as mock_init:
+            # load is started by creating the pool, and awaited by setup
+            pool = self.loop.run_until_complete(init_pool())
+            self.assertFalse(qubes.storage.lvm._cache_init_task.done())
+            self.loop.run_until_complete(pool.setup())
+            mock_init.assert_called_once_with(volume_group=None)
+            self.assertTrue(qubes.storage.lvm.size_cache_time)
+            # already loaded, setup refreshes only its volume group
+            self.loop.run_until_complete(pool.setup())
+            mock_init.assert_called_with(volume_group="vg")
+            self.assertEqual(mock_init.call_count, 2)
+
+
+class TC_05_LvmBatch(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.log = unittest.mock.Mock()
+        self.proc = unittest.mock.Mock(returncode=0)
+        self.proc.communicate = unittest.mock.AsyncMock(return_value=(b"", b""))
+        patch = unittest.mock.patch(
+            "asyncio.create_subprocess_exec", return_value=self.proc
+        )
+        self.mock_exec = patch.start()
+        self.addCleanup(patch.stop)
+        patch = unittest.mock.patch("os.getuid", return_value=0)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def run_commands(self, *cmds):
+        return self.loop.run_until_complete(
+            asyncio.gather(
+                *(_queue_lvm_command(cmd, self.log) for cmd in cmds),
+                return_exceptions=True,
+            )
+        )
+
+    def test_000_single(self):
+        self.assertEqual(
+            self.run_commands(["resize", "vg/vm-test-root", "1024"]),
+            [True],
+        )
+        self.mock_exec.assert_called_once_with(
+            "lvm",
+            "lvresize",
+            "--size=1024B",
+            "--",
+            "vg/vm-test-root",
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            close_fds=True,
+            env=unittest.mock.ANY,
+        )
+
+    def test_001_single_fail(self):
+        self.proc.returncode = 5
+        self.proc.communicate.return_value = (b"", b"Volume not found")
+        (result,) = self.run_commands(["remove", "vg/vm-test-root"])
+        self.assertIsInstance(result, qubes.exc.StoragePoolException)
+        self.assertEqual(str(result), "Volume not found")
+
+    def test_010_batch(self):
+        ok = '{"log": [{"log_type": "status", "log_ret_code": "1"}]}'
+        fail = (
+            '{"log": [{"log_type": "error", "log_message": "No space"},'
+            ' {"log_type": "status", "log_ret_code": "5"}]}'
+        )
+        self.proc.communicate.return_value = (
+            "lvm> {}\nlvm> {}\nlvm> {}\nlvm> ".format(ok, fail, ok).encode(),
+            b"",
+        )
+        results = self.run_commands(
+            ["remove", "vg/vm-test-volatile"],
+            ["clone", "vg/vm-test-root", "vg/vm-test-root-snap"],
+            ["activate", "vg/vm-test-private"],
+        )
+        self.assertEqual(results[0], True)
+        self.assertIsInstance(results[1], qubes.exc.StoragePoolException)
+        self.assertEqual(str(results[1]), "No space")
+        self.assertEqual(results[2], True)
+        self.mock_exec.assert_called_once_with(
+            "lvm",
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            close_fds=True,
+            env=unittest.mock.ANY,
+        )
+        lines = self.proc.communicate.call_args[0][0].decode().splitlines()
+        self.assertEqual(len(lines), 4)
+        self.assertTrue(lines[0].startswith("lvremove --reportformat=json "))
+        self.assertTrue(lines[0].endswith(" --force -- vg/vm-test-volatile"))
+        self.assertTrue(lines[1].startswith("lvcreate "))
+        self.assertTrue(lines[2].startswith("lvchange "))
+        self.assertEqual(lines[3], "exit")
+
+    def test_011_batch_no_report(self):
+        self.proc.returncode = 5
+        self.proc.communicate.return_value = (b"", b"Unknown option")
+        results = self.run_commands(
+            ["remove", "vg/vm-test-volatile"],
+            ["activate", "vg/vm-test-private"],
+        )
+        for result in results:
+            self.assertIsInstance(result, qubes.exc.StoragePoolException)
+            self.assertEqual(str(result), "Unknown option")
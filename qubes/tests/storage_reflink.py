@@ -378,6 +378,70 @@ class TC_10_ReflinkPool(qubes.tests.QubesTestCase):
         self.loop.run_until_complete(volume.remove())
         volume._copy_file.assert_not_called()
 
+    def test_130_export_changes_tags(self):
+        config = {
+            "name": "private",
+            "pool": self.pool.name,
+            "save_on_stop": True,
+            "rw": True,
+            "size": 1024 * 1024,
+        }
+        vm = qubes.tests.storage.TestVM(self)
+        volume = self.pool.init_volume(vm, config)
+        self.loop.run_until_complete(volume.create())
+
+        def backup(backup_id, base_tag):
+            path, base_id, _ = self.loop.run_until_complete(
+                volume.export_changes(backup_id, base_tag)
+            )
+            self.loop.run_until_complete(volume.export_changes_end(path, True))
+            return base_id
+
+        self.assertIsNone(backup("1", "aa"))
+        # other tag doesn't chain against (nor remove) the first base
+        self.assertIsNone(backup("2", "bb"))
+        self.assertEqual(volume._backup_bases("aa"), ["1"])
+        self.assertEqual(backup("3", "aa"), "1")
+        self.assertEqual(volume._backup_bases("aa"), ["3"])
+        self.assertEqual(volume._backup_bases("bb"), ["2"])
+        self.assertEqual(backup("4", "bb"), "2")
+        self.assertEqual(volume._backup_bases("bb"), ["4"])
+
+        self.loop.run_until_complete(volume.remove())
+        self.assertEqual(volume._paths_backup_bases(), [])
+
+
+class TC_20_ChangedExtents(qubes.tests.QubesTestCase):
+    def test_000_unchanged(self):
+        extents = [(0, 1 << 20, 4096, 0), (8192, 2 << 20, 4096, 0)]
+        self.assertEqual(reflink._diff_extents(extents, extents, 16384), [])
+
+    def test_001_remapped(self):
+        base = [(0, 1 << 20, 16384, 0)]
+        new = [
+            (0, 1 << 20, 4096, 0),
+            (4096, 5 << 20, 8192, 0),
+            (12288, (1 << 20) + 12288, 4096, 0),
+        ]
+        self.assertEqual(
+            reflink._diff_extents(base, new, 16384), [(4096, 8192)]
+        )
+
+    def test_002_allocated_and_punched(self):
+        base = [(0, 1 << 20, 4096, 0)]
+        new = [(8192, 2 << 20, 4096, 0)]
+        self.assertEqual(
+            reflink._diff_extents(base, new, 16384), [(0, 4096), (8192, 4096)]
+        )
+
+    def test_003_uncomparable_and_resized(self):
+        base = [(0, 1 << 20, 8192, reflink.FIEMAP_EXTENT_UNCOMPARABLE)]
+        new = [
+            (0, 1 << 20, 8192, reflink.FIEMAP_EXTENT_UNCOMPARABLE),
+            (8192, 2 << 20, 65536, 0),
+        ]
+        self.assertEqual(reflink._diff_extents(base, new, 16384), [(0, 16384)])
+
 
 def setup_loopdev(img, cleanup_via=None):
     dev = str.strip(cmd("sudo", "losetup", "-f", "--show", img).decode())
@@ -299,6 +299,42 @@ class TC_01_ZFSPool_solidstate(AsyncLoopHolderMixin):
             with self.assertRaises(qubes.exc.StoragePoolException):
                 self.rc(zfs.duplicate_disk(falsesrc, dst, log))
 
+    def test_parse_zstream_dump(self):
+        write = (
+            "WRITE object = {} type = 23 checksum type = 7 compression "
+            "type = 0{}flags = 0 offset = {} logical_size = {} "
+            "compressed_size = 0 payload_size = 0 props = 0 salt = 0 "
+            "iv = 0 mac = 0"
+        )
+        output = "\n".join(
+            [
+                "BEGIN record",
+                "\thdrtype = 1",
+                "\tfromguid = 1234",
+                "OBJECT object = 1 type = 23 bonustype = 0 blksz = 16384",
+                # older versions split WRITE records into two lines
+                write.format(1, "\n    ", 16384, 16384),
+                write.format(1, " ", 32768, 16384),
+                # volume size property
+                write.format(2, " ", 0, 512),
+                "WRITE_EMBEDDED object = 1 offset = 131072 length = 16384",
+                "    toguid = 5678 comp = 0 etype = 0 lsize = 16384",
+                "FREE object = 1 offset = 65536 length = 16384",
+                "FREE object = 1 offset = 1048576 length = -1",
+                "END checksum = 0/0/0/0",
+            ]
+        )
+        self.assertEqual(
+            zfs._parse_zstream_dump(output, 1048576 + 4096),
+            [
+                (16384, 32768),
+                (65536, 16384),
+                (131072, 16384),
+                (1048576, 4096),
+            ],
+        )
+        self.assertEqual(zfs._parse_zstream_dump("", 1048576), [])
+
 
 @skip_unless_zfs_available
 class TC_10_ZFSPool(ZFSBase):
@@ -882,3 +918,44 @@ class TC_10_ZFSPool(ZFSBase):
         self.rc(v1.stop())
         v1.is_running = lambda: False
         self.rc(v2.import_volume(v1))
+
+    def test_030_export_changes(self) -> None:
+        volume = self.get_vol(ONEMEG_SAVE_ON_STOP)
+        self.rc(volume.create())
+
+        # No base yet, full data is exported.
+        path, base_id, extents = self.rc(
+            volume.export_changes("20240101T000000-1", "ab")
+        )
+        self.assertEqual((base_id, extents), (None, None))
+        self.rc(volume.export_changes_end(path, True))
+        self.assertFalse(os.path.exists(path))
+
+        # Nothing changed since the previous backup.
+        path, base_id, extents = self.rc(
+            volume.export_changes("20240101T000000-2", "ab")
+        )
+        self.assertEqual((base_id, extents), ("20240101T000000-1", []))
+        self.rc(volume.export_changes_end(path, True))
+
+        self.rc(volume.start())
+        voldev = os.path.join(zfs.ZVOL_DIR, volume.volume)
+        with open(self.writable(voldev), "r+b") as v:
+            v.seek(65536)
+            v.write(b"x" * 512)
+        self.rc(volume.stop())
+
+        path, base_id, extents = self.rc(
+            volume.export_changes("20240101T000000-3", "ab")
+        )
+        self.assertEqual(base_id, "20240101T000000-2")
+        self.assertEqual(len(extents), 1)
+        offset, size = extents[0]
+        self.assertLessEqual(offset, 65536)
+        self.assertGreaterEqual(offset + size, 65536 + 512)
+        # A failed backup keeps the previous base.
+        self.rc(volume.export_changes_end(path, False))
+        self.assertEqual(
+            list(self.rc(volume._backup_bases("ab"))),
+            ["20240101T000000-2"],
+        )
@@ -155,3 +155,87 @@ class TC_00_TarWriter(qubes.tests.QubesTestCase):
         with self.assertNotRaises(subprocess.CalledProcessError):
             subprocess.check_call(["gzip", "--test", self.output_path])
         self.assertTarExtractable()
+
+    def write_mixed_chunks(self):
+        with open(self.input_path, "wb") as f:
+            # hole, data with zero blocks inside, hole, data not aligned to
+            # the buffer size
+            f.seek(1024 * 1024)
+            f.write(b"a" * 1000 + b"\0" * 4096 + b"b" * 512)
+            f.seek(qubes.tarwriter.BUF_SIZE * 4 - 100)
+            f.write(b"c" * 300)
+            f.write(b"\0" * (qubes.tarwriter.BUF_SIZE + 1000))
+            f.write(b"d" * 336)
+
+    def test_020_sparse_map_seek(self):
+        self.write_mixed_chunks()
+        with open(self.input_path, "rb") as f:
+            sparse_map = list(qubes.tarwriter.get_sparse_map(f))
+        with open(self.input_path, "rb") as f:
+            sparse_map_read = list(qubes.tarwriter.get_sparse_map_read(f))
+        self.assertEqual(sparse_map, sparse_map_read)
+        self.assertEqual(
+            sparse_map,
+            [
+                (1024 * 1024, 1024),
+                (1024 * 1024 + 4608, 1024),
+                (qubes.tarwriter.BUF_SIZE * 4 - 512, 1024),
+                (qubes.tarwriter.BUF_SIZE * 5 + 1024, 512),
+            ],
+        )
+
+    def test_021_sparse_map_trailing_zeros(self):
+        with open(self.input_path, "wb") as f:
+            f.write(b"a" * 512)
+            f.truncate(10000)
+        with open(self.input_path, "rb") as f:
+            self.assertEqual(
+                list(qubes.tarwriter.get_sparse_map(f)),
+                [(0, 512), (10000, 0)],
+            )
+
+    def test_022_sparse_map_fallback(self):
+        read_fd, write_fd = os.pipe()
+        with open(read_fd, "rb") as read_f, open(write_fd, "wb") as write_f:
+            write_f.write(b"\0" * 1024 + b"a" * 512)
+            write_f.close()
+            self.assertEqual(
+                list(qubes.tarwriter.get_sparse_map(read_f)),
+                [(1024, 512)],
+            )
+
+    def test_030_delta(self):
+        with open(self.input_path, "wb") as f:
+            f.write(os.urandom(65536))
+        base_path = self.input_path + ".base"
+        self.addCleanup(os.unlink, base_path)
+        shutil.copy(self.input_path, base_path)
+        with open(self.input_path, "r+b") as f:
+            f.seek(4096)
+            f.write(b"a" * 8192)
+            f.seek(32768)
+            f.write(bytes(4096))
+            f.truncate(81920)
+            f.seek(65536)
+            f.write(b"b" * 4096)
+        extents_path = self.input_path + ".extents"
+        self.addCleanup(os.unlink, extents_path)
+        with open(extents_path, "w") as f:
+            f.write("4096 8192\n32768 4096\n65536 16384\n")
+        qubes.tarwriter.main(
+            [
+                "--extents",
+                extents_path,
+                "--base-backup-id",
+                "20261016T120000-1234",
+                self.input_path,
+                self.output_path,
+            ]
+        )
+        with open(self.output_path, "rb") as input_f, open(
+            base_path, "r+b"
+        ) as output_f:
+            base_id = qubes.tarwriter.apply_delta(input_f, output_f)
+        self.assertEqual(base_id, "20261016T120000-1234")
+        with self.assertNotRaises(subprocess.CalledProcessError):
+            subprocess.check_call(["cmp", self.input_path, base_path])
@@ -23,6 +23,7 @@ import jinja2
 import unittest.mock
 
 import qubes.tests
+import qubes.vm
 
 
 class TestVMM(object):
@@ -57,6 +58,26 @@ class TestVMsCollection(dict):
     def get_vms_connected_to(self, vm):
         return set()
 
+    def get_vm_dependents(self, vm):
+        dependents = {}
+        for other in self:
+            for prop in other.property_list():
+                if not isinstance(prop, qubes.vm.VMProperty):
+                    continue
+                if getattr(other, prop.__name__, None) is vm:
+                    dependents.setdefault(prop.__name__, set()).add(other)
+        return dependents
+
+    def get_vms_depending_on(self, vm, properties=None, recursive=False):
+        # pylint: disable=unused-argument
+        return set().union(
+            *(
+                referring
+                for name, referring in self.get_vm_dependents(vm).items()
+                if properties is None or name in properties
+            )
+        )
+
     def close(self):
         self.clear()
 
@@ -86,6 +107,8 @@ class TestApp(qubes.tests.TestEmitter):
         4: qubes.Label(4, "0xcccccc", "black"),
     }
     check_updates_vm = False
+    domain_events_registered = False
+    check_power_state_cache = False
 
     def get_label(self, label):
         # pylint: disable=unused-argument
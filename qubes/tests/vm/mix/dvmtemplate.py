@@ -544,3 +544,28 @@ class TC_00_DVMTemplateMixin(
         self.appvm.features["supported-rpc.qubes.WaitForSession"] = True
         self.appvm.features["preload-dispvm-max"] = 1
         self.assertEqual(qubes.vm.dispvm.get_preload_max(self.appvm), 1)
+
+    def test_110_dispvm_headroom(self):
+        self.appvm.memory = 400
+        self.assertEqual(self.appvm.get_dispvm_headroom(), 0)
+        for _ in range(3):
+            self.appvm.record_dispvm_demand()
+        # without preloading, one disposable at a time
+        self.assertEqual(self.appvm.get_dispvm_headroom(), 400 * 1024**2)
+        with mock.patch.object(
+            self.appvm, "get_feat_preload_max", return_value=2
+        ):
+            self.assertEqual(self.appvm.get_dispvm_headroom(), 800 * 1024**2)
+            with mock.patch(
+                "qubes.vm.qubesvm.qmemman_connection"
+            ) as connection:
+                connection.headroom = 0
+                self.appvm.update_dispvm_headroom()
+                connection.set_headroom.assert_called_once_with(800 * 1024**2)
+            with mock.patch("qubes.config.dispvm_demand_window", -1):
+                # no recent requests, but preloading is enabled
+                self.assertEqual(
+                    self.appvm.get_dispvm_headroom(), 400 * 1024**2
+                )
+        with mock.patch("qubes.config.dispvm_demand_window", -1):
+            self.assertEqual(self.appvm.get_dispvm_headroom(), 0)
@@ -31,6 +31,7 @@ import datetime
 
 import lxml.etree
 import unittest.mock
+import libvirt
 
 import shutil
 
@@ -3307,6 +3308,73 @@ class TC_90_QubesVM(QubesVMTestsMixin, qubes.tests.QubesTestCase):
             mock_os_path_exists.assert_not_called()
             self.assertEqual(fully_usable, True)
 
+    def test_730_power_state_cache(self):
+        vm = self.get_vm()
+        vm.features["qrexec"] = False
+        self.app.vmm.offline_mode = False
+        self.app.domain_events_registered = True
+        libvirt_domain = unittest.mock.Mock()
+        libvirt_domain.isActive.return_value = True
+        libvirt_domain.state.return_value = [libvirt.VIR_DOMAIN_RUNNING, 0]
+        vm._libvirt_domain = libvirt_domain
+
+        self.assertEqual(vm.get_power_state(), "Running")
+        self.assertTrue(vm.is_running())
+        self.assertFalse(vm.is_paused())
+        self.assertEqual(libvirt_domain.isActive.call_count, 1)
+
+        libvirt_domain.state.return_value = [libvirt.VIR_DOMAIN_PAUSED, 0]
+        self.assertEqual(vm.get_power_state(), "Running")
+        vm.invalidate_power_state()
+        self.assertEqual(vm.get_power_state(), "Paused")
+        self.assertTrue(vm.is_paused())
+        self.assertEqual(libvirt_domain.isActive.call_count, 2)
+
+    def test_731_power_state_cache_transitional(self):
+        vm = self.get_vm()
+        self.app.vmm.offline_mode = False
+        self.app.domain_events_registered = True
+        libvirt_domain = unittest.mock.Mock()
+        libvirt_domain.isActive.return_value = True
+        libvirt_domain.state.return_value = [libvirt.VIR_DOMAIN_SHUTOFF, 0]
+        vm._libvirt_domain = libvirt_domain
+
+        self.assertEqual(vm.get_power_state(), "Dying")
+        libvirt_domain.isActive.return_value = False
+        self.assertEqual(vm.get_power_state(), "Halted")
+        self.assertFalse(vm.is_running())
+        self.assertEqual(libvirt_domain.isActive.call_count, 2)
+
+    def test_732_power_state_cache_no_events(self):
+        vm = self.get_vm()
+        vm.features["qrexec"] = False
+        self.app.vmm.offline_mode = False
+        libvirt_domain = unittest.mock.Mock()
+        libvirt_domain.isActive.return_value = True
+        libvirt_domain.state.return_value = [libvirt.VIR_DOMAIN_RUNNING, 0]
+        vm._libvirt_domain = libvirt_domain
+
+        self.assertEqual(vm.get_power_state(), "Running")
+        libvirt_domain.isActive.return_value = False
+        self.assertEqual(vm.get_power_state(), "Halted")
+
+    def test_733_power_state_cache_check(self):
+        vm = self.get_vm()
+        vm.features["qrexec"] = False
+        self.app.vmm.offline_mode = False
+        self.app.domain_events_registered = True
+        self.app.check_power_state_cache = True
+        libvirt_domain = unittest.mock.Mock()
+        libvirt_domain.isActive.return_value = True
+        libvirt_domain.state.return_value = [libvirt.VIR_DOMAIN_RUNNING, 0]
+        vm._libvirt_domain = libvirt_domain
+
+        self.assertEqual(vm.get_power_state(), "Running")
+        self.assertEqual(vm.get_power_state(), "Running")
+        libvirt_domain.isActive.return_value = False
+        with self.assertLogs(vm.log, "ERROR"):
+            self.assertEqual(vm.get_power_state(), "Halted")
+
     def test_800_reset_icon_event(self):
         class TestVM2(qubes.vm.qubesvm.QubesVM):
             event_fired = False
@@ -34,12 +34,21 @@ import xen.lowlevel.xs  # pylint: disable=import-error
 
 import qubes.qmemman
 import qubes.qmemman.algo
+import qubes.qmemman.scheduler
 import qubes.qmemman.systemstate
 import qubes.utils
 
 SOCK_PATH = "/var/run/qubes/qmemman.sock"
 GLOBAL_LOCK = threading.Lock()
 system_state = qubes.qmemman.systemstate.SystemState()
+scheduler = qubes.qmemman.scheduler.BalloonScheduler(system_state, GLOBAL_LOCK)
+#: commands of the multiplexed protocol, see :py:class:`QMemmanReqHandler`
+MULTIPLEXED_COMMANDS = (
+    [b"reserve"],
+    [b"release"],
+    [b"set_mem"],
+    [b"headroom"],
+)
 # If XSWatcher handles meminfo event before @introduceDomain, it will use
 # incomplete domain list for that and may redistribute memory allocated to some
 # VM, but not yet used (see #1389). To fix that, system_state should be updated
@@ -55,10 +64,34 @@ def unique_per_list(list1, list2):
     return first, second
 
 
+def parse_dom_memset(args):
+    return {
+        str(key): int(value)
+        for key, value in (pair.split(":") for pair in args)
+    }
+
+
+def request_domain_list_refresh():
+    global force_refresh_domain_list
+    force_refresh_domain_list = True
+
+
+reservations = qubes.qmemman.scheduler.Reservations(
+    scheduler, request_domain_list_refresh
+)
+
+
 def get_domain_meminfo_key(domid):
     return "/local/domain/" + domid + "/memory/meminfo"
 
 
+def get_domain_mem_max_keys(domid):
+    return [
+        "/local/domain/" + domid + "/memory/hotplug-max",
+        "/local/domain/" + domid + "/memory/static-max",
+    ]
+
+
 @dataclass
 class WatchType:
     func: Callable
@@ -78,6 +111,7 @@ class XSWatcher:
             "@releaseDomain", WatchType(XSWatcher.domain_list_changed, False)
         )
         self.watch_token_dict = {}
+        self.mem_max_watch_token_dict = {}
 
     def domain_list_changed(self, refresh_only=False):
         """
@@ -122,11 +156,19 @@ class XSWatcher:
                 self.watch_token_dict[domid] = watch
                 self.handle.watch(get_domain_meminfo_key(domid), watch)
                 system_state.add_domain(domid)
+                # memory limits are cached, watch for changes
+                watch = WatchType(XSWatcher.mem_max_changed, domid)
+                self.mem_max_watch_token_dict[domid] = watch
+                for key in get_domain_mem_max_keys(domid):
+                    self.handle.watch(key, watch)
             for domid in destroyed:
                 self.handle.unwatch(
                     get_domain_meminfo_key(domid), self.watch_token_dict[domid]
                 )
                 self.watch_token_dict.pop(domid)
+                watch = self.mem_max_watch_token_dict.pop(domid)
+                for key in get_domain_mem_max_keys(domid):
+                    self.handle.unwatch(key, watch)
                 system_state.del_domain(domid)
 
             if not refresh_only:
@@ -166,6 +208,11 @@ class XSWatcher:
                 self.log.exception("Updating meminfo for %s failed", domid)
         self.log.debug("GLOBAL_LOCK released")
 
+    def mem_max_changed(self, domid):
+        self.log.debug("mem_max_changed(domid={!r})".format(domid))
+        with GLOBAL_LOCK:
+            system_state.invalidate_mem_max(domid)
+
     def watch_loop(self):
         self.log.debug("watch_loop()")
         while True:
@@ -175,63 +222,82 @@ class XSWatcher:
             token.func(self, token.param)
 
 
-class QMemmanReqHandler(socketserver.BaseRequestHandler):
+class QMemmanReqHandler(socketserver.StreamRequestHandler):
     """
     The RequestHandler class for our server.
 
     It is instantiated once per connection to the server, and must override the
     handle() method to implement communication to the client.
+
+    Two protocols are supported, chosen by the first line sent by the client:
+
+     - legacy one: a single request, either a memory amount to free, or
+       ``domid:memory`` pairs to set; memory freed for the client is reserved
+       until it disconnects
+     - multiplexed one: any number of ``<id> <command> [<args>]`` lines, each
+       answered with an ``<id> <result>`` line as soon as it is handled, in
+       any order; commands are:
+
+       - ``reserve <memory> [<timeout>]`` - free and reserve memory; the
+         reservation is identified by the request *id*
+       - ``release <reservation id>`` - release reserved memory
+       - ``set_mem <domid>:<memory> ...`` - set memory of given domains
+       - ``headroom <memory>`` - keep that much memory free when balancing
     """
 
     def handle(self):
         self.log = logging.getLogger("qmemman.daemon.reqhandler")
 
+        line = self.rfile.readline()
+        if line.split()[1:2] in MULTIPLEXED_COMMANDS:
+            self.handle_multiplexed(line)
+        else:
+            self.handle_legacy(line)
+
+    def handle_legacy(self, line):
         got_lock = False
+        reserved_mem = 0
         try:
             # self.request is the TCP socket connected to the client
             while True:
-                self.data = self.request.recv(1024).strip()
-                data_args = self.data.decode("ascii").split()
-                self.log.debug("data=%r", self.data)
-                if len(self.data) == 0:
+                data = line.strip()
+                data_args = data.decode("ascii").split()
+                self.log.debug("data=%r", data)
+                if len(data) == 0:
                     self.log.info("client disconnected, resuming membalance")
-                    if got_lock:
-                        global force_refresh_domain_list
-                        force_refresh_domain_list = True
+                    if got_lock or reserved_mem:
+                        request_domain_list_refresh()
                     return
 
                 # XXX something is wrong here: return without release?
-                if got_lock:
+                if got_lock or reserved_mem:
                     self.log.warning("Second request over qmemman.sock?")
                     return
 
-                self.log.debug("acquiring GLOBAL_LOCK")
-                # pylint: disable=consider-using-with
-                GLOBAL_LOCK.acquire()
-                self.log.debug("GLOBAL_LOCK acquired")
-
-                got_lock = True
-
                 resp = "INVALID_ARG"
-                if self.data.isdigit():
+                if data.isdigit():
                     resp = "FAIL"
                     memory = int(data_args[0])
-                    if system_state.do_balloon(memory):
+                    # do not hold GLOBAL_LOCK while waiting, the scheduler
+                    # handles concurrent requests together
+                    if scheduler.request(memory):
+                        reserved_mem = memory
                         resp = "OK"
                 elif ":" in data_args[0]:
+                    self.log.debug("acquiring GLOBAL_LOCK")
+                    # pylint: disable=consider-using-with
+                    GLOBAL_LOCK.acquire()
+                    self.log.debug("GLOBAL_LOCK acquired")
+                    got_lock = True
+
                     resp = "FAIL"
-                    dom_memset = {
-                        str(key): int(value)
-                        for key, value in (
-                            pair.split(":") for pair in data_args
-                        )
-                    }
-                    if system_state.do_balloon_dom(dom_memset):
+                    if system_state.do_balloon_dom(parse_dom_memset(data_args)):
                         resp = "OK"
                 resp = str(resp + "\n").encode("ascii")
 
                 self.log.debug("resp={!r}".format(resp))
                 self.request.send(resp)
+                line = self.rfile.readline()
         except BaseException as e:
             self.log.exception(
                 "exception while handling request: {!r}".format(e)
@@ -240,6 +306,71 @@ class QMemmanReqHandler(socketserver.BaseRequestHandler):
             if got_lock:
                 GLOBAL_LOCK.release()
                 self.log.debug("GLOBAL_LOCK released")
+            if reserved_mem:
+                scheduler.release(reserved_mem)
+                self.log.debug("released %d reserved bytes", reserved_mem)
+
+    def handle_multiplexed(self, line):
+        send_lock = threading.Lock()
+        try:
+            while line:
+                self.log.debug("data=%r", line)
+                args = line.decode("ascii").split()
+                if args:
+                    # reserve may wait for ballooning, do not block other
+                    # requests meanwhile
+                    threading.Thread(
+                        target=self.handle_command,
+                        args=(send_lock, args[0], args[1:]),
+                        daemon=True,
+                    ).start()
+                line = self.rfile.readline()
+        except BaseException as e:
+            self.log.exception(
+                "exception while handling request: {!r}".format(e)
+            )
+        # reservations are kept until released or expired, not bound to the
+        # connection
+        self.log.info("multiplexed client disconnected")
+
+    def handle_command(self, send_lock, req_id, args):
+        resp = "INVALID_ARG"
+        try:
+            command, cmd_args = args[0], args[1:]
+            if command == "reserve" and len(cmd_args) in (1, 2):
+                mem_size = int(cmd_args[0])
+                timeout = float(cmd_args[1]) if len(cmd_args) == 2 else None
+                resp = "FAIL"
+                if reservations.reserve(req_id, mem_size, timeout):
+                    resp = "OK"
+            elif command == "release" and len(cmd_args) == 1:
+                resp = "OK" if reservations.release(cmd_args[0]) else "FAIL"
+            elif command == "headroom" and len(cmd_args) == 1:
+                headroom = int(cmd_args[0])
+                with GLOBAL_LOCK:
+                    system_state.headroom_mem = headroom
+                    system_state.do_balance()
+                resp = "OK"
+            elif command == "set_mem" and cmd_args:
+                dom_memset = parse_dom_memset(cmd_args)
+                resp = "FAIL"
+                with GLOBAL_LOCK:
+                    if system_state.do_balloon_dom(dom_memset):
+                        resp = "OK"
+        except (ValueError, IndexError):
+            pass
+        except BaseException as e:  # pylint: disable=broad-except
+            self.log.exception(
+                "exception while handling request {}: {!r}".format(req_id, e)
+            )
+            resp = "FAIL"
+        resp = "{} {}\n".format(req_id, resp).encode("ascii")
+        self.log.debug("resp={!r}".format(resp))
+        try:
+            with send_lock:
+                self.request.sendall(resp)
+        except OSError as e:
+            self.log.warning("failed to send response: {!s}".format(e))
 
 
 def main():
@@ -284,6 +415,7 @@ def main():
             "vm-min-mem": str(qubes.qmemman.algo.MIN_PREFMEM),
             "dom0-mem-boost": str(qubes.qmemman.algo.DOM0_MEM_BOOST),
             "cache-margin-factor": str(qubes.qmemman.algo.CACHE_FACTOR),
+            "balance-algorithm": qubes.qmemman.algo.BALANCE_ALGORITHM,
         }
     )
     config.read(args.config)
@@ -298,13 +430,22 @@ def main():
         qubes.qmemman.algo.CACHE_FACTOR = config.getfloat(
             "global", "cache-margin-factor"
         )
+        balance_algorithm = config.get("global", "balance-algorithm")
+        if balance_algorithm not in ("iterative", "waterfill"):
+            parser.error(
+                "invalid balance-algorithm: {}".format(balance_algorithm)
+            )
+        qubes.qmemman.algo.BALANCE_ALGORITHM = balance_algorithm
         loglevel = config.getint("global", "log-level", fallback=30)
         logging.root.setLevel(loglevel)
 
     log.info(
         "MIN_PREFMEM={algo.MIN_PREFMEM}"
         " DOM0_MEM_BOOST={algo.DOM0_MEM_BOOST}"
-        " CACHE_FACTOR={algo.CACHE_FACTOR}".format(algo=qubes.qmemman.algo)
+        " CACHE_FACTOR={algo.CACHE_FACTOR}"
+        " BALANCE_ALGORITHM={algo.BALANCE_ALGORITHM}".format(
+            algo=qubes.qmemman.algo
+        )
     )
 
     try:
@@ -318,7 +459,9 @@ def main():
     # Initialize the connection to Xen and to XenStore.
     system_state.init()
 
-    server = socketserver.UnixStreamServer(SOCK_PATH, QMemmanReqHandler)
+    server = socketserver.ThreadingUnixStreamServer(
+        SOCK_PATH, QMemmanReqHandler
+    )
     os.umask(0o077)
 
     # Notify systemd.
@@ -332,5 +475,6 @@ def main():
         sock.sendall(b"READY=1")
         sock.close()
 
+    threading.Thread(target=scheduler.run, daemon=True).start()
     threading.Thread(target=server.serve_forever).start()
     XSWatcher().watch_loop()
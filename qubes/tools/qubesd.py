@@ -13,6 +13,7 @@ import qubes.api.admin
 import qubes.api.internal
 import qubes.api.misc
 import qubes.log
+import qubes.storage.lvm
 import qubes.utils
 import qubes.vm.qubesvm
 
@@ -23,7 +24,10 @@ os.getrandom(1)
 
 def sighandler(loop, signame, servers, app):
     print("caught {}, exiting".format(signame))
+    # write qubes.xml right away, including any postponed changes
+    app.save_delay = None
     app.save()
+    qubes.storage.lvm.cancel_cache_reconcile()
     for server in servers:
         server.close()
         server.close_clients()
@@ -63,6 +67,15 @@ def main(args=None):
         raise
 
     args.app.register_event_handlers()
+    args.app.save_delay = qubes.config.save_delay
+
+    # Load LVM volumes info in the background, instead of when the first
+    # Admin API call needs it
+    if any(
+        isinstance(pool, qubes.storage.lvm.ThinPool)
+        for pool in args.app.pools.values()
+    ):
+        qubes.storage.lvm.start_cache_load(loop)
 
     # Stop storage for domains not currently running
     loop.run_until_complete(args.app.stop_storage())
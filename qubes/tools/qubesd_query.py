@@ -6,6 +6,8 @@ import os
 import signal
 import sys
 
+import qubes.api
+
 QUBESD_SOCK = "/var/run/qubesd.sock"
 MAX_PAYLOAD_SIZE = 65536
 
@@ -38,9 +40,18 @@ parser.add_argument(
     help="Should non-OK qubesd response result in non-zero exit code",
 )
 
-parser.add_argument("src", metavar="SRC", help="source qube")
-parser.add_argument("method", metavar="METHOD", help="method name")
-parser.add_argument("dest", metavar="DEST", help="destination qube")
+parser.add_argument(
+    "--framed",
+    dest="framed",
+    action="store_true",
+    default=False,
+    help="Read calls from stdin, one per line, and send them all over one "
+    "connection",
+)
+
+parser.add_argument("src", metavar="SRC", nargs="?", help="source qube")
+parser.add_argument("method", metavar="METHOD", nargs="?", help="method name")
+parser.add_argument("dest", metavar="DEST", nargs="?", help="destination qube")
 parser.add_argument(
     "arg", metavar="ARGUMENT", nargs="?", default="", help="argument to method"
 )
@@ -109,9 +120,75 @@ async def qubesd_client(socket, payload, *args):
         writer.close()
 
 
-# pylint: disable=too-many-return-statements
+async def qubesd_framed_client(socket, requests):
+    """
+    Connect to qubesd in framed mode, send all requests over one connection
+    and passthrough responses to stdout, each preceded by its length
+
+    :param socket: path to qubesd socket
+    :param requests: list of (src, method, dest, arg) tuples
+    :return: 0 if all responses are OK, 1 otherwise
+    """
+    try:
+        connection = await qubes.api.QubesdConnection.connect(socket)
+    except asyncio.CancelledError:
+        return 1
+
+    # all requests are sent right away, responses come in the same order
+    calls = [
+        asyncio.ensure_future(connection.call(*request)) for request in requests
+    ]
+    returncode = 0
+    try:
+        for call in calls:
+            response = await call
+            if not response.startswith(b"0"):
+                returncode = 1
+            # pylint: disable=no-member
+            sys.stdout.buffer.write(b"%d\n" % len(response))
+            sys.stdout.buffer.write(response)
+            sys.stdout.flush()
+        await connection.close()
+    except (asyncio.CancelledError, ConnectionError):
+        returncode = 1
+    finally:
+        for call in calls:
+            call.cancel()
+        connection.reader_task.cancel()
+        connection.writer.close()
+    return returncode
+
+
+def parse_framed_requests(untrusted_input):
+    """
+    Parse calls for :option:`--framed` mode, one per line, in the form
+    ``SRC METHOD DEST [ARGUMENT]``
+
+    :raises ValueError: on malformed input
+    """
+    requests = []
+    for untrusted_line in untrusted_input.decode("ascii").splitlines():
+        untrusted_call = untrusted_line.split()
+        if not untrusted_call:
+            continue
+        if len(untrusted_call) not in (3, 4):
+            raise ValueError("Invalid call: {!r}".format(untrusted_line))
+        requests.append(tuple(untrusted_call))
+    return requests
+
+
+# pylint: disable=too-many-return-statements,too-many-branches
 def main(args=None):
     args = parser.parse_args(args)
+    if args.framed:
+        if args.src is not None:
+            parser.error("--framed reads calls from stdin, not arguments")
+        if not args.payload or args.single_line:
+            parser.error(
+                "--framed cannot be used with --empty or --single-line"
+            )
+    elif args.dest is None:
+        parser.error("the following arguments are required: SRC, METHOD, DEST")
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
     max_payload_size = 1024 if args.single_line else MAX_PAYLOAD_SIZE
@@ -170,13 +247,23 @@ def main(args=None):
         payload = b""
     # pylint: enable=no-member
 
-    coro = asyncio.ensure_future(
-        qubesd_client(
-            args.socket,
-            payload,
-            f"{args.method}+{args.arg} {args.src} name {args.dest}",
+    if args.framed:
+        try:
+            requests = parse_framed_requests(payload)
+        except ValueError as e:
+            parser.error(str(e))
+            return 1
+        coro = asyncio.ensure_future(
+            qubesd_framed_client(args.socket, requests)
+        )
+    else:
+        coro = asyncio.ensure_future(
+            qubesd_client(
+                args.socket,
+                payload,
+                f"{args.method}+{args.arg} {args.src} name {args.dest}",
+            )
         )
-    )
 
     for signame in ("SIGINT", "SIGTERM"):
         loop.add_signal_handler(
@@ -23,6 +23,7 @@
 """Qubes Virtual Machines"""
 
 import asyncio
+import copy
 import re
 import string
 import uuid
@@ -286,6 +287,9 @@ class BaseVM(qubes.PropertyHolder):
         #: mother :py:class:`qubes.Qubes` object
         self.app = app
 
+        # cached result of __xml__(), see on_domain_xml_invalidate()
+        self._xml_cache = None
+
         super().__init__(xml, **kwargs)
 
         #: dictionary of features of this qube
@@ -362,6 +366,12 @@ class BaseVM(qubes.PropertyHolder):
         self.log = qubes.log.get_vm_logger(self.name)
 
     def __xml__(self):
+        # Without events, changes cannot be tracked. Don't use the cache then.
+        if not self.events_enabled:
+            self._xml_cache = None
+        elif self._xml_cache is not None:
+            return copy.deepcopy(self._xml_cache)
+
         element = lxml.etree.Element("domain")
         element.set("id", "domain-" + str(self.qid))
         element.set("class", self.__class__.__name__)
@@ -381,8 +391,27 @@ class BaseVM(qubes.PropertyHolder):
             tags.append(node)
         element.append(tags)
 
+        if self.events_enabled:
+            self._xml_cache = copy.deepcopy(element)
         return element
 
+    @qubes.events.handler(
+        "property-set:*",
+        "property-reset:*",
+        "clone-properties",
+        "domain-feature-set:*",
+        "domain-feature-delete:*",
+        "domain-tag-add:*",
+        "domain-tag-delete:*",
+    )
+    def on_domain_xml_invalidate(self, event, **kwargs):
+        """Drop cached properties, features and tags serialization
+
+        Devices and volumes are not cached, see subclasses' :py:meth:`__xml__`.
+        """
+        # pylint: disable=unused-argument
+        self._xml_cache = None
+
     def __repr__(self):
         proprepr = []
         for prop in self.property_list():
@@ -625,10 +625,9 @@ class DispVM(qubes.vm.qubesvm.QubesVM):
         if self.preload_requested:
             return
         break_task = asyncio.create_task(self.preload_requested_event.wait())
-        qmemman_client = qubes.qmemman.client.QMemmanClient()
         qmemman_task = asyncio.create_task(
             asyncio.to_thread(
-                qmemman_client.set_mem,
+                qubes.vm.qubesvm.qmemman_connection.set_mem,
                 {self.xid: 0},
             )
         )
@@ -660,8 +659,6 @@ class DispVM(qubes.vm.qubesvm.QubesVM):
             )
             raise
         finally:
-            if qmemman_client.sock:
-                qmemman_client.close()
             if not result or cancelled:
                 self.log.warning("Failed to set memory")
             if self.preload_requested:
@@ -793,6 +790,10 @@ class DispVM(qubes.vm.qubesvm.QubesVM):
         if not cls.can_gen_disposable(appvm, preload=preload):
             return None
 
+        if not preload:
+            appvm.record_dispvm_demand()
+            appvm.update_dispvm_headroom()
+
         if (
             not preload
             and (dispvm := appvm.request_preload())
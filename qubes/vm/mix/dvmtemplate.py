@@ -19,6 +19,8 @@
 # with this program; if not, see <http://www.gnu.org/licenses/>.
 
 import asyncio
+import collections
+import time
 from typing import Optional, Union, Iterator, Tuple
 
 import qubes.config
@@ -41,6 +43,12 @@ class DVMTemplateMixin(qubes.events.Emitter):
         doc="Should this VM be allowed to start as Disposable VM",
     )
 
+    def __init__(self, *args, **kwargs):
+        #: times of recent requests for disposables, see
+        # :py:meth:`record_dispvm_demand`
+        self._dispvm_demand = collections.deque()
+        super().__init__(*args, **kwargs)
+
     @property
     def dispvms(self) -> Iterator["qubes.vm.dispvm.DispVM"]:
         """
@@ -49,9 +57,9 @@ class DVMTemplateMixin(qubes.events.Emitter):
         :rtype: Iterator[qubes.vm.dispvm.DispVM]
         """
         assert isinstance(self, qubes.vm.BaseVM)
-        for vm in self.app.domains:
-            if getattr(vm, "template", None) == self:
-                yield vm
+        yield from sorted(
+            self.app.domains.get_vms_depending_on(self, ("template",))
+        )
 
     @qubes.events.handler("domain-load")
     def on_domain_loaded(self, event) -> None:
@@ -206,6 +214,7 @@ class DVMTemplateMixin(qubes.events.Emitter):
         if self.is_global_preload_set():
             return
         self.remove_preload_excess(0, reason="local feature was deleted")
+        self.update_dispvm_headroom()
 
     @qubes.events.handler("domain-feature-pre-set:preload-dispvm-max")
     def on_feature_pre_set_preload_dispvm_max(
@@ -494,6 +503,7 @@ class DVMTemplateMixin(qubes.events.Emitter):
         if delay:
             event_log += " with a delay of %s second(s)" % f"{delay:.1f}"
         self.log.info(event_log)
+        self.update_dispvm_headroom()
 
         supported, missing_services = self.supports_preload()
         if not supported:
@@ -564,6 +574,65 @@ class DVMTemplateMixin(qubes.events.Emitter):
                 )
             )
 
+    def record_dispvm_demand(self) -> None:
+        """
+        Record a request for a disposable based on this qube, whether it is
+        served by a preloaded disposable or not. Preloading itself is not
+        a request.
+        """
+        now = time.monotonic()
+        self._dispvm_demand.append(now)
+        while self._dispvm_demand[0] < now - qubes.config.dispvm_demand_window:
+            self._dispvm_demand.popleft()
+
+    def get_dispvm_headroom(self) -> int:
+        """
+        Get amount of memory (in bytes) which should be kept free for new
+        disposables based on this qube.
+
+        It is memory of as many disposables as were requested recently (see
+        :py:meth:`record_dispvm_demand`), at least one if preloading is
+        enabled, but no more than ``preload-dispvm-max`` (or one, if it is
+        not set), as preloaded disposables are refilled one at a time anyway.
+
+        :rtype: int
+        """
+        assert isinstance(self, qubes.vm.BaseVM)
+        if not getattr(self, "template_for_dispvms", False):
+            return 0
+        window_start = time.monotonic() - qubes.config.dispvm_demand_window
+        demand = sum(1 for t in self._dispvm_demand if t >= window_start)
+        preload_max = self.get_feat_preload_max()
+        if preload_max:
+            demand = max(demand, 1)
+        count = min(demand, max(preload_max, 1))
+        return count * getattr(self, "memory", 0) * 1024**2
+
+    def update_dispvm_headroom(self) -> None:
+        """
+        Ask qmemman to keep free enough memory for disposables based on all
+        the disposable templates, so starting them does not need to wait
+        for other qubes to balloon down.
+        """
+        assert isinstance(self, qubes.vm.BaseVM)
+        if not qubes.vm.qubesvm.qmemman_present:
+            return
+        headroom = sum(
+            vm.get_dispvm_headroom()
+            for vm in self.app.domains
+            if isinstance(vm, DVMTemplateMixin)
+        )
+        connection = qubes.vm.qubesvm.qmemman_connection
+        if headroom == connection.headroom:
+            return
+        try:
+            connection.set_headroom(headroom)
+        except OSError as e:
+            # sent again on reconnection
+            self.log.warning(
+                "Failed to set qmemman memory headroom: %s", str(e)
+            )
+
     def get_feat_preload_delay(self) -> float:
         """
         Get the ``preload-dispvm-delay`` feature as float.
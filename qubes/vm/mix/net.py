@@ -264,9 +264,9 @@ class NetVMMixin(qubes.events.Emitter):
         """Return a generator containing all domains connected to the current
         NetVM.
         """
-        for vm in self.app.domains:
-            if getattr(vm, "netvm", None) is self:
-                yield vm
+        yield from sorted(
+            self.app.domains.get_vms_depending_on(self, ("netvm",))
+        )
 
     #
     # used in both
@@ -54,6 +54,8 @@ try:
     import qubes.qmemman.client  # pylint: disable=wrong-import-position
 
     qmemman_present = True
+    #: connection to qmemman shared by all qubes, connected on first use
+    qmemman_connection = qubes.qmemman.client.QMemmanConnection()
 except ImportError:
     pass
 
@@ -1175,6 +1177,8 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.LocalVM):
 
         self._libvirt_domain = None
         self._qdb_connection = None
+        #: cached libvirt state, see :py:meth:`_get_libvirt_power_state`
+        self._power_state = None
 
         # We assume a fully halted VM here. The 'domain-init' handler will
         # check if the VM is already running.
@@ -1496,6 +1500,7 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.LocalVM):
                 self.libvirt_domain.createWithFlags(
                     libvirt.VIR_DOMAIN_START_PAUSED
                 )
+                self.invalidate_power_state()
                 self.create_xs_entries()
 
                 # the above allocates xid, lets announce that
@@ -1565,6 +1570,7 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.LocalVM):
                 )
                 self.skip_unpause_event = True
                 self.libvirt_domain.resume()
+                self.invalidate_power_state()
                 await self.fire_event_async("domain-unpaused")
 
                 if (
@@ -1687,6 +1693,7 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.LocalVM):
 
             if self.is_paused():
                 self.libvirt_domain.destroy()
+                self.invalidate_power_state()
             else:
                 # Some libvirt actions have a global lock on a domain, blocking
                 # a lot of libvirt operations and even qubesd. When possible to
@@ -1757,6 +1764,8 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.LocalVM):
             if e.get_error_code() == libvirt.VIR_ERR_OPERATION_INVALID:
                 raise qubes.exc.QubesVMNotStartedError(self)
             raise
+        finally:
+            self.invalidate_power_state()
 
         await waiter
 
@@ -1801,6 +1810,8 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.LocalVM):
             else:
                 self.log.warning("Failed to suspend qube")
                 raise
+        finally:
+            self.invalidate_power_state()
 
         return self
 
@@ -1812,6 +1823,7 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.LocalVM):
 
         await self.fire_event_async("domain-pre-paused", pre_event=True)
         self.libvirt_domain.suspend()
+        self.invalidate_power_state()
 
         return self
 
@@ -1824,6 +1836,7 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.LocalVM):
 
         if self.get_power_state() == "Suspended":
             self.libvirt_domain.pMWakeup()
+            self.invalidate_power_state()
             if self.features.check_with_template("qrexec", False):
                 try:
                     await asyncio.wait_for(
@@ -1859,6 +1872,7 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.LocalVM):
         await self.fire_event_async("domain-pre-unpaused", pre_event=True)
         self.skip_unpause_event = True
         self.libvirt_domain.resume()
+        self.invalidate_power_state()
         await self.fire_event_async("domain-unpaused")
 
         return self
@@ -2136,7 +2150,6 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.LocalVM):
             initial_memory = self.memory
             mem_required = int(initial_memory + stubdom_mem) * 1024 * 1024
 
-        qmemman_client = qubes.qmemman.client.QMemmanClient()
         try:
             mem_required_with_overhead = (
                 mem_required
@@ -2149,16 +2162,17 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.LocalVM):
                 # 2 pages per 1MB of RAM, see
                 # libxl__get_required_paging_memory()
                 mem_required_with_overhead += maxmem * 8192
-            got_memory = qmemman_client.request_mem(mem_required_with_overhead)
+            reservation = qmemman_connection.request_mem(
+                mem_required_with_overhead
+            )
 
         except IOError as e:
             raise IOError("Failed to connect to qmemman: {!s}".format(e))
 
-        if not got_memory:
-            qmemman_client.close()
+        if reservation is None:
             raise qubes.exc.QubesMemoryError(self)
 
-        return qmemman_client
+        return reservation
 
     @staticmethod
     async def start_daemon(*command, input=None, **kwargs):
@@ -2371,6 +2385,7 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.LocalVM):
         if self._libvirt_domain is not None:
             self._libvirt_domain.close()
             self._libvirt_domain = None
+        self.invalidate_power_state()
 
     #
     # methods for querying domain state
@@ -2494,12 +2509,27 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.LocalVM):
                 Libvirt's enum describing precise state of a domain.
         """  # pylint: disable=too-many-return-statements
 
+        if self.app.vmm.offline_mode:
+            return "Halted"
+
+        state = self._get_libvirt_power_state()
+        if state == "Running" and not self.is_fully_usable():
+            return "Transient"
+        return state
+
+    def _query_libvirt_power_state(self):
+        """Ask libvirt about the domain state.
+
+        Returns the same values as :py:meth:`get_power_state`, except that
+        ``'Transient'`` is never returned - a domain which is active, but
+        not in any of the special states, is reported as ``'Running'``.
+        """
+        # pylint: disable=too-many-return-statements
+
         # don't try to define libvirt domain, if it isn't there, VM surely
         # isn't running
         # reason for this "if": allow vm.is_running() in PCI (or other
         # device) extension while constructing libvirt XML
-        if self.app.vmm.offline_mode:
-            return "Halted"
         if self._libvirt_domain is None:
             try:
                 self._libvirt_domain = self.app.vmm.libvirt_conn.lookupByUUID(
@@ -2524,11 +2554,7 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.LocalVM):
                     libvirt.VIR_DOMAIN_PMSUSPENDED: "Suspended",  # 0x7
                 }
                 state = libvirt_domain.state()[0]
-                if state in state_dict:
-                    return state_dict[state]
-                if not self.is_fully_usable():
-                    return "Transient"
-                return "Running"  # 0x1
+                return state_dict.get(state, "Running")  # 0x1
 
             return "Halted"
         except libvirt.libvirtError as e:
@@ -2536,7 +2562,42 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.LocalVM):
                 return "Halted"
             raise
 
-        assert False
+    def _get_libvirt_power_state(self):
+        """Return libvirt domain state, from the cache if possible.
+
+        The cache is used only when libvirt lifecycle events are delivered
+        to this process (see :py:meth:`qubes.Qubes.register_event_handlers`),
+        as those are what invalidates it. ``'Halting'`` and ``'Dying'`` are
+        never cached, because libvirt may leave them without sending any
+        event.
+        """
+        if not self.app.domain_events_registered:
+            return self._query_libvirt_power_state()
+
+        state = self._power_state
+        if state is None:
+            state = self._query_libvirt_power_state()
+            if state not in ("Halting", "Dying"):
+                self._power_state = state
+        elif self.app.check_power_state_cache:
+            actual = self._query_libvirt_power_state()
+            if actual != state:
+                self.log.error(
+                    "Cached power state %s does not match libvirt state %s",
+                    state,
+                    actual,
+                )
+                self._power_state = None
+                state = actual
+        return state
+
+    def invalidate_power_state(self):
+        """Forget cached domain state, so the next query asks libvirt.
+
+        This is called on every libvirt lifecycle event for this domain and
+        after qubesd itself changes domain state.
+        """
+        self._power_state = None
 
     def is_halted(self):
         """ Check whether this domain's state is 'Halted'
@@ -2557,6 +2618,9 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.LocalVM):
         if self.app.vmm.offline_mode:
             return False
 
+        if self.app.domain_events_registered:
+            return self._get_libvirt_power_state() != "Halted"
+
         # don't try to define libvirt domain, if it isn't there, VM surely
         # isn't running
         # reason for this "if": allow vm.is_running() in PCI (or other
@@ -2581,6 +2645,9 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.LocalVM):
         :rtype: bool
         """
 
+        if self.app.domain_events_registered:
+            return self._get_libvirt_power_state() == "Paused"
+
         return (
             self.libvirt_domain
             and self.libvirt_domain.state()[0] == libvirt.VIR_DOMAIN_PAUSED
@@ -2930,6 +2997,7 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.LocalVM):
     def _update_libvirt_domain(self):
         """Re-initialise :py:attr:`libvirt_domain`."""
         domain_config = self.create_config_file()
+        self.invalidate_power_state()
         try:
             self._libvirt_domain = self.app.vmm.libvirt_conn.defineXML(
                 domain_config
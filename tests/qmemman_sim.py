@@ -0,0 +1,248 @@
+#!/usr/bin/python3
+#
+# The Qubes OS Project, https://www.qubes-os.org/
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation; either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with this program; if not, see <http://www.gnu.org/licenses/>.
+"""Replay meminfo traces through qmemman balancing algorithms.
+
+Compares implementations of :py:func:`qubes.qmemman.algo.balance` offline,
+without Xen. Domains are simulated to reach memory targets immediately, but
+memory is given to a domain only if Xen has enough of it free, like in
+:py:meth:`qubes.qmemman.systemstate.SystemState.do_balance`. After each
+meminfo change, balancing is repeated until the requested change is not
+significant anymore.
+
+A trace is a file with one JSON object per line. The first one describes
+the initial state::
+
+    {"xen_free": bytes,
+     "domains": {"domid": {"mem_max": bytes, "mem_actual": bytes}, ...}}
+
+and the following ones are events, for example meminfo (in KiB, like in
+xenstore) reported by a domain::
+
+    {"domid": "3", "meminfo": 409600}
+
+Domains can also be started (``"mem_max"`` and ``"mem_actual"`` given for
+a new domid) or stopped (``"stopped": true``). Without a trace file,
+a random one is generated.
+
+Results are printed as ``algorithm;metric;value`` lines: number of balance
+rounds (total and max per event), ``mem_set`` calls, time spent in the
+algorithm, memory left free, and how final allocations differ from the first
+algorithm.
+"""
+
+import argparse
+import json
+import random
+import sys
+import time
+
+import qubes.qmemman.algo
+from qubes.qmemman.domainstate import DomainState
+
+MiB = 1024 * 1024
+# same as in qubes.qmemman.systemstate
+XEN_FREE_MEM_LEFT = 50 * MiB
+MIN_TOTAL_MEMORY_TRANSFER = 150 * MiB
+#: give up on an event after that many balance rounds
+MAX_ROUNDS = 20
+
+ALGORITHMS = ("iterative", "waterfill")
+
+
+def generate_trace(num_domains, num_events, seed, xen_mem_per_domain):
+    """Random trace: domains with random memory usage, drifting over time"""
+    rnd = random.Random(seed)
+    domains = {
+        str(domid): {
+            "mem_max": rnd.choice((1000, 2000, 4000, 8000)) * MiB,
+            "mem_actual": 400 * MiB,
+        }
+        for domid in range(num_domains)
+    }
+    trace = [
+        {
+            "xen_free": num_domains * xen_mem_per_domain * MiB,
+            "domains": domains,
+        }
+    ]
+    used = {domid: rnd.randint(100, 1500) for domid in domains}
+    for domid in domains:
+        trace.append({"domid": domid, "meminfo": used[domid] * 1024})
+    for _ in range(num_events):
+        domid = rnd.choice(list(domains))
+        used[domid] = max(50, used[domid] + rnd.randint(-300, 300))
+        trace.append({"domid": domid, "meminfo": used[domid] * 1024})
+    return trace
+
+
+def load_trace(path):
+    with open(path, encoding="ascii") as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+class Simulation:
+    def __init__(self, algorithm, initial):
+        self.algorithm = algorithm
+        self.xen_free = initial["xen_free"]
+        self.dom_dict = {}
+        for domid, info in initial["domains"].items():
+            self.add_domain(domid, info)
+        self.rounds = 0
+        self.max_rounds = 0
+        self.mem_set_calls = 0
+        self.elapsed = 0.0
+
+    def add_domain(self, domid, info):
+        dom = DomainState(domid)
+        dom.mem_max = info["mem_max"]
+        dom.mem_actual = dom.mem_current = dom.last_target = info["mem_actual"]
+        self.dom_dict[domid] = dom
+
+    def mem_set(self, domid, target):
+        dom = self.dom_dict[domid]
+        if target > dom.mem_actual:
+            # can't give more than there is free
+            target = min(
+                target, dom.mem_actual + self.xen_free - XEN_FREE_MEM_LEFT
+            )
+            if target <= dom.mem_actual:
+                return
+        self.mem_set_calls += 1
+        self.xen_free -= target - dom.mem_actual
+        dom.mem_actual = dom.mem_current = dom.last_target = target
+
+    def balance(self):
+        start = time.perf_counter()
+        saved_algorithm = qubes.qmemman.algo.BALANCE_ALGORITHM
+        qubes.qmemman.algo.BALANCE_ALGORITHM = self.algorithm
+        try:
+            memset_reqs = qubes.qmemman.algo.balance(
+                self.xen_free - XEN_FREE_MEM_LEFT, self.dom_dict
+            )
+        finally:
+            qubes.qmemman.algo.BALANCE_ALGORITHM = saved_algorithm
+        self.elapsed += time.perf_counter() - start
+        return memset_reqs
+
+    def is_significant(self, memset_reqs):
+        """Simplified version of SystemState.is_balance_req_significant()"""
+        transfer = sum(
+            abs(target - self.dom_dict[domid].mem_actual)
+            for domid, target in memset_reqs
+        )
+        return transfer > MIN_TOTAL_MEMORY_TRANSFER
+
+    def handle_event(self, event):
+        domid = event["domid"]
+        if event.get("stopped"):
+            dom = self.dom_dict.pop(domid)
+            self.xen_free += dom.mem_actual
+        elif domid not in self.dom_dict:
+            self.xen_free -= event["mem_actual"]
+            self.add_domain(domid, event)
+        if "meminfo" in event:
+            qubes.qmemman.algo.refresh_meminfo_for_domain(
+                self.dom_dict[domid], str(event["meminfo"]).encode()
+            )
+        for rounds in range(1, MAX_ROUNDS + 1):
+            memset_reqs = self.balance()
+            if not self.is_significant(memset_reqs):
+                break
+            for req_domid, target in memset_reqs:
+                self.mem_set(req_domid, target)
+        self.rounds += rounds
+        self.max_rounds = max(self.max_rounds, rounds)
+
+    def run(self, events):
+        for event in events:
+            self.handle_event(event)
+
+    def allocations(self):
+        return {domid: dom.mem_actual for domid, dom in self.dom_dict.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--domains",
+        type=int,
+        default=30,
+        help="domains in a generated trace (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--events",
+        type=int,
+        default=1000,
+        help="events in a generated trace (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--xen-memory",
+        type=int,
+        default=1500,
+        help="free Xen memory per domain at the start of a generated trace, "
+        "in MiB (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="random seed for a generated trace (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--save-trace",
+        metavar="FILE",
+        help="save the generated trace, to replay it later",
+    )
+    parser.add_argument("trace", nargs="?", help="trace file to replay")
+    args = parser.parse_args()
+
+    if args.trace:
+        trace = load_trace(args.trace)
+    else:
+        trace = generate_trace(
+            args.domains, args.events, args.seed, args.xen_memory
+        )
+        if args.save_trace:
+            with open(args.save_trace, "w", encoding="ascii") as file:
+                for line in trace:
+                    file.write(json.dumps(line) + "\n")
+
+    reference = None
+    for algorithm in ALGORITHMS:
+        sim = Simulation(algorithm, trace[0])
+        sim.run(trace[1:])
+        allocations = sim.allocations()
+        if reference is None:
+            reference = allocations
+        diff = max(
+            (abs(allocations[domid] - reference[domid]) for domid in reference),
+            default=0,
+        )
+        for metric, value in (
+            ("rounds", sim.rounds),
+            ("max_rounds", sim.max_rounds),
+            ("mem_set_calls", sim.mem_set_calls),
+            ("seconds", "{:.6f}".format(sim.elapsed)),
+            ("xen_free_mib", sim.xen_free // MiB),
+            ("max_allocation_diff_mib", diff // MiB),
+        ):
+            print("{};{};{}".format(algorithm, metric, value))
+        sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,316 @@
+#!/usr/bin/python3
+#
+# The Qubes OS Project, https://www.qubes-os.org/
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation; either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with this program; if not, see <http://www.gnu.org/licenses/>.
+"""Benchmark qubesd hot paths without a Qubes host.
+
+Generates synthetic qubes.xml stores with the requested number of qubes and
+measures loading and saving them, and calling a few Admin API methods
+through the real :py:class:`qubes.api.admin.QubesAdminAPI` handlers.
+Neither libvirt nor Xen is needed: like in :py:mod:`qubes.tests.api_admin`,
+the VMM connection is a mock reporting all qubes as halted, and all the
+files are kept in a temporary directory.
+
+Device listing uses the "testclass" device class, registered only when
+the package is installed with ``QUBES_TEST=1`` set.
+
+Results are printed as ``benchmark;vms;iterations;min;mean;max`` lines
+(times in seconds). Set ``QUBES_TEST_PERF_FILE`` to additionally save them
+as JSON, to compare between releases.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import tempfile
+import time
+import unittest.mock
+
+import libvirt
+
+import qubes
+import qubes.api.admin
+import qubes.app
+import qubes.config
+import qubes.device_protocol
+import qubes.vm.appvm
+import qubes.vm.templatevm
+
+#: number of qubes for which one template is created
+VMS_PER_TEMPLATE = 50
+#: devices exposed by each qube to the device listing benchmark
+DEVICES_PER_VM = 10
+
+BENCHMARKS = {}
+
+_VMMConnection = qubes.app.VMMConnection
+
+
+def fake_vmm(offline_mode=None, libvirt_reconnect_cb=None):
+    """Replacement for :py:class:`qubes.app.VMMConnection`"""
+    # pylint: disable=unused-argument
+    vmm = unittest.mock.Mock(spec=_VMMConnection)
+    vmm.configure_mock(
+        **{
+            # like in qubes.tests.api_admin, do not connect to QubesDB
+            "offline_mode": True,
+            "is_xen": True,
+            "libvirt_conn.lookupByUUID.return_value.isActive.return_value": (
+                False
+            ),
+            "libvirt_conn.lookupByUUID.return_value.state.return_value": [
+                libvirt.VIR_DOMAIN_SHUTOFF
+            ],
+        }
+    )
+    return vmm
+
+
+def benchmark(func):
+    """Register benchmark; *func* gets :py:class:`Bench` and returns
+    a callable to time"""
+    BENCHMARKS[func.__name__.replace("_", "-")] = func
+    return func
+
+
+class Bench:
+    """Benchmark environment with a synthetic store"""
+
+    def __init__(self, tmpdir, num_vms):
+        self.tmpdir = tmpdir
+        self.num_vms = num_vms
+        self.store = os.path.join(tmpdir, "qubes.xml")
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self._app = None
+        self._create_store()
+
+    def _create_store(self):
+        app = qubes.Qubes.create_empty_store(self.store)
+        self.loop.run_until_complete(app.setup_pools())
+        app.default_kernel = "1.0"
+        templates = []
+        for i in range(max(1, self.num_vms // VMS_PER_TEMPLATE)):
+            templates.append(
+                app.add_new_vm(
+                    qubes.vm.templatevm.TemplateVM,
+                    name="template-{}".format(i),
+                    label="black",
+                )
+            )
+        app.default_template = templates[0]
+        netvm = app.add_new_vm(
+            qubes.vm.appvm.AppVM,
+            name="sys-net",
+            label="red",
+            template=templates[0],
+            provides_network=True,
+            netvm=None,
+        )
+        app.default_netvm = netvm
+        for i in range(self.num_vms - len(templates) - 1):
+            vm = app.add_new_vm(
+                qubes.vm.appvm.AppVM,
+                name="vm-{}".format(i),
+                label=("red", "green", "blue")[i % 3],
+                template=templates[i % len(templates)],
+            )
+            vm.features["service.example"] = "1"
+            vm.tags.add("group-{}".format(i % 10))
+        app.save()
+        app.close()
+
+    @property
+    def app(self):
+        """Application object loaded from the store (cached)"""
+        if self._app is None:
+            self._app = self.load()
+        return self._app
+
+    def load(self):
+        return qubes.Qubes(self.store)
+
+    def call(self, method, dest, arg=b""):
+        """Call Admin API method as dom0"""
+        mgmt = qubes.api.admin.QubesAdminAPI(
+            self.app, b"dom0", method, dest, arg
+        )
+        return self.loop.run_until_complete(mgmt.execute(untrusted_payload=b""))
+
+    def close(self):
+        if self._app is not None:
+            self._app.close()
+        self.loop.close()
+
+
+@benchmark
+def app_load(bench):
+    def run():
+        bench.load().close()
+
+    return run
+
+
+@benchmark
+def app_save(bench):
+    return bench.app.save
+
+
+@benchmark
+def admin_vm_list(bench):
+    return lambda: bench.call(b"admin.vm.List", b"dom0")
+
+
+@benchmark
+def admin_vm_property_getall(bench):
+    names = [vm.name.encode() for vm in bench.app.domains]
+
+    def run():
+        for name in names:
+            bench.call(b"admin.vm.property.GetAll", name)
+
+    return run
+
+
+@benchmark
+def event_dispatch(bench):
+    vms = list(bench.app.domains)
+
+    def run():
+        for vm in vms:
+            vm.fire_event(
+                "domain-feature-set:benchmark",
+                feature="benchmark",
+                value="1",
+                oldvalue=None,
+            )
+
+    return run
+
+
+@benchmark
+def admin_vm_device_available(bench):
+    # "testclass" device class is registered by setup.py for tests
+    def device_list(vm, event):
+        # pylint: disable=unused-argument
+        for i in range(DEVICES_PER_VM):
+            yield qubes.device_protocol.DeviceInfo(
+                qubes.device_protocol.Port(vm, str(i), "testclass"),
+                product="Device {}".format(i),
+            )
+
+    names = []
+    for vm in bench.app.domains:
+        vm.add_handler("device-list:testclass", device_list)
+        names.append(vm.name.encode())
+
+    def run():
+        for name in names:
+            bench.call(b"admin.vm.device.testclass.Available", name)
+
+    return run
+
+
+def run_benchmark(name, bench, iterations):
+    func = BENCHMARKS[name](bench)
+    times = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--vms",
+        type=int,
+        nargs="+",
+        default=[10, 100, 1000],
+        help="store sizes to test (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--iterations",
+        type=int,
+        default=5,
+        help="iterations of each benchmark (default: %(default)s)",
+    )
+    parser.add_argument(
+        "benchmarks",
+        nargs="*",
+        help="benchmarks to run: {}; all by default".format(
+            ", ".join(BENCHMARKS)
+        ),
+    )
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark: {}".format(name))
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmpdir, unittest.mock.patch.dict(
+        qubes.config.system_path, {"qubes_base_dir": tmpdir}
+    ), unittest.mock.patch(
+        "qubes.config.qubes_base_dir", tmpdir
+    ), unittest.mock.patch.dict(
+        qubes.config.defaults["pool_configs"]["varlibqubes"],
+        {"dir_path": tmpdir},
+    ), unittest.mock.patch(
+        "qubes.app.validate_kernel", lambda obj, key, value: None
+    ), unittest.mock.patch(
+        "qubes.app.VMMConnection", fake_vmm
+    ):
+        for num_vms in args.vms:
+            bench = Bench(tmpdir, num_vms)
+            try:
+                for name in args.benchmarks or BENCHMARKS:
+                    try:
+                        times = run_benchmark(name, bench, args.iterations)
+                    except qubes.api.ProtocolError as e:
+                        # for example device class not registered
+                        print("{};{};SKIPPED;{}".format(name, num_vms, e))
+                        continue
+                    results.setdefault(name, {})[num_vms] = {
+                        "iterations": args.iterations,
+                        "min": min(times),
+                        "mean": statistics.mean(times),
+                        "max": max(times),
+                    }
+                    print(
+                        "{};{};{};{:.6f};{:.6f};{:.6f}".format(
+                            name,
+                            num_vms,
+                            args.iterations,
+                            min(times),
+                            statistics.mean(times),
+                            max(times),
+                        ),
+                        flush=True,
+                    )
+            finally:
+                bench.close()
+                os.unlink(bench.store)
+
+    results_file = os.environ.get("QUBES_TEST_PERF_FILE")
+    if results_file:
+        with open(results_file, "w", encoding="ascii") as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
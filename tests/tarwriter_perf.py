@@ -0,0 +1,128 @@
+#!/usr/bin/python3
+#
+# The Qubes OS Project, https://www.qubes-os.org/
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation; either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with this program; if not, see <http://www.gnu.org/licenses/>.
+"""Compare sparse map engines of qubes.tarwriter.
+
+Creates a few test images and prints time spent by
+:py:func:`qubes.tarwriter.get_sparse_map` and
+:py:func:`qubes.tarwriter.get_sparse_map_read` on each of them, as
+``image;engine;seconds;entries`` lines.
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+import qubes.tarwriter
+
+MiB = 1024 * 1024
+
+
+def create_sparse(path, size):
+    """Mostly empty image, with a 4k block of data every 16 MiB"""
+    with open(path, "wb") as f:
+        f.truncate(size)
+        for offset in range(0, size, 16 * MiB):
+            f.seek(offset)
+            f.write(os.urandom(4096))
+
+
+def create_dense(path, size):
+    """Image full of data"""
+    with open(path, "wb") as f:
+        for _ in range(size // MiB):
+            f.write(os.urandom(MiB))
+
+
+def create_zeros(path, size):
+    """Image of allocated, but zeroed blocks, interleaved with data"""
+    with open(path, "wb") as f:
+        for _ in range(size // MiB):
+            f.write(os.urandom(MiB // 4))
+            f.write(bytes(MiB * 3 // 4))
+
+
+images = {
+    "sparse": create_sparse,
+    "dense": create_dense,
+    "zeros": create_zeros,
+}
+
+engines = {
+    "seek": qubes.tarwriter.get_sparse_map,
+    "read": qubes.tarwriter.get_sparse_map_read,
+}
+
+
+def run_engine(engine, path):
+    with open(path, "rb") as f:
+        start = time.perf_counter()
+        sparse_map = list(engines[engine](f))
+        elapsed = time.perf_counter() - start
+    return elapsed, sparse_map
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--size",
+        type=int,
+        default=1024,
+        help="size of each test image in MiB (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--dense-size",
+        type=int,
+        default=128,
+        help="size of test images with data in MiB (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--dir",
+        default=None,
+        help="directory to create test images in; should not be tmpfs",
+    )
+    parser.add_argument(
+        "images",
+        nargs="*",
+        help="images to test: {}; all by default".format(", ".join(images)),
+    )
+    args = parser.parse_args()
+    for image in args.images:
+        if image not in images:
+            parser.error("unknown image: {}".format(image))
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmpdir:
+        for image in args.images or images:
+            path = os.path.join(tmpdir, image)
+            size = args.size if image == "sparse" else args.dense_size
+            images[image](path, size * MiB)
+            results = {}
+            for engine in engines:
+                elapsed, results[engine] = run_engine(engine, path)
+                print(
+                    "{};{};{:.3f};{}".format(
+                        image, engine, elapsed, len(results[engine])
+                    ),
+                    flush=True,
+                )
+            if results["seek"] != results["read"]:
+                print("{};MISMATCH".format(image))
+            os.unlink(path)
+
+
+if __name__ == "__main__":
+    main()